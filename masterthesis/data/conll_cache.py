@@ -0,0 +1,88 @@
+"""Content-addressed cache of UDPipe output.
+
+Entries are keyed by the SHA-256 of the UDPipe model name and the input
+text, and stored gzipped as <folder>/<key[:2]>/<key>.conllu.gz. Reading
+an entry updates its modification time, so eviction removes the least
+recently used entries first.
+"""
+import gzip
+import hashlib
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple  # noqa: F401
+
+from masterthesis.utils import atomic_write
+
+SUFFIX = '.conllu.gz'
+
+
+class ConllCache:
+    """Cache of CoNLL-U output keyed by text content and model name.
+
+    Args:
+        folder: The folder to keep the cache in
+        max_bytes: Size limit used by evict, or None for no limit
+    """
+
+    def __init__(self, folder: Path, max_bytes: Optional[int] = None) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        sha256 = hashlib.sha256()
+        sha256.update(model.encode('utf-8'))
+        sha256.update(b'\0')
+        sha256.update(text.encode('utf-8'))
+        return sha256.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.folder / key[:2] / (key + SUFFIX)
+
+    def get(self, text: str, model: str) -> Optional[str]:
+        """Return the cached output for text, or None on a cache miss."""
+        path = self._path(self.key(text, model))
+        try:
+            with gzip.open(str(path), 'rb') as f:
+                conllu = f.read().decode('utf-8')
+        except (EOFError, OSError):
+            return None
+        os.utime(str(path), None)
+        return conllu
+
+    def put(self, text: str, model: str, conllu: str) -> None:
+        """Store the output for text."""
+        path = self._path(self.key(text, model))
+        with atomic_write(path) as f, gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(conllu.encode('utf-8'))
+
+    def size(self) -> int:
+        """Total size of the cache entries in bytes."""
+        return sum(path.stat().st_size for path in self.folder.glob('*/*' + SUFFIX))
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """Remove least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            max_bytes: Size limit, defaults to the limit given to the constructor
+
+        Returns:
+            The number of removed entries.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+        entries = []  # type: List[Tuple[float, int, Path]]
+        for path in self.folder.glob('*/*' + SUFFIX):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for __, size, __ in entries)
+        removed = 0
+        for __, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            path.unlink()
+            total -= size
+            removed += 1
+        return removed
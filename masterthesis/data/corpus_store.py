@@ -0,0 +1,219 @@
+"""Compile the ASK txt and CoNLL files into a memory-mapped corpus store.
+
+Reading the corpus means opening a couple of thousand small files, which
+is slow on a shared file system. This script packs the tokens of every
+document into a few flat integer arrays instead:
+
+    store/strings.txt         String table, one string per line
+    store/docs.txt            Document names, one per line
+    store/<stream>.ids.npy    String ids of all tokens, document by document
+    store/<stream>.offsets.npy  Start offset of every document (+ end)
+    store/<stream>.present.npy  Whether the document exists in the stream
+    store/manifest.json       Written last, marks the store as complete, and
+                              holds a SHA-1 digest of the contents
+
+The streams are 'txt' (whitespace separated tokens of the .txt files),
+'form' and 'upos' (the FORM and UPOS columns of the .conll files).
+Re-run the script whenever the txt or conll folders change.
+"""
+import argparse
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple  # noqa: F401
+
+import numpy as np
+
+from masterthesis.utils import conll_reader, DATA_DIR
+
+STORE_VERSION = 2
+STREAMS = ('txt', 'form', 'upos')
+MANIFEST = 'manifest.json'
+
+_open_stores = {}  # type: Dict[Path, Tuple[float, CorpusStore]]
+
+
+class CorpusStore:
+    """Read-only view of a compiled corpus store."""
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+        with (folder / 'strings.txt').open(encoding='utf-8', newline='\n') as f:
+            strings = f.read().split('\n')[:-1]
+        self.strings = np.array(strings, dtype=object)
+        with (folder / 'docs.txt').open(encoding='utf-8', newline='\n') as f:
+            docs = f.read().split('\n')[:-1]
+        self.doc_index = {name: row for row, name in enumerate(docs)}
+        with (folder / MANIFEST).open() as f:
+            # Stores from before version 2 have no digest
+            self.digest = json.load(f).get('digest')  # type: Optional[str]
+        self._streams = {}  # type: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+    def _stream(self, stream: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if stream not in self._streams:
+            if stream not in STREAMS:
+                raise ValueError('Stream must be one of %s' % (STREAMS,))
+            self._streams[stream] = tuple(
+                np.load(str(self.folder / ('%s.%s.npy' % (stream, part))), mmap_mode='r')
+                for part in ('ids', 'offsets', 'present')
+            )
+        return self._streams[stream]
+
+    def has(self, doc: str, stream: str) -> bool:
+        """Whether the document is in the store for the given stream."""
+        row = self.doc_index.get(doc)
+        if row is None:
+            return False
+        __, __, present = self._stream(stream)
+        return bool(present[row])
+
+    def ids(self, doc: str, stream: str) -> np.ndarray:
+        """Return the string ids of the tokens in a document."""
+        ids, offsets, __ = self._stream(stream)
+        row = self.doc_index[doc]
+        return ids[offsets[row]:offsets[row + 1]]
+
+    def tokens(self, doc: str, stream: str) -> List[str]:
+        """Return the tokens in a document as strings."""
+        return self.strings[self.ids(doc, stream)].tolist()
+
+
+def open_corpus_store(folder: Path) -> Optional[CorpusStore]:
+    """Open the corpus store in folder, or return None if there is none.
+
+    Stores are cached per process and reopened if they are recompiled.
+    """
+    manifest = folder / MANIFEST
+    try:
+        mtime = manifest.stat().st_mtime
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    cached = _open_stores.get(folder)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, CorpusStore(folder))
+        _open_stores[folder] = cached
+    return cached[1]
+
+
+def _txt_tokens(path: Path) -> Iterable[str]:
+    with path.open(encoding='utf-8') as stream:
+        for line in stream:
+            yield from line.split()
+
+
+def _conll_tokens(path: Path) -> Tuple[List[str], List[str]]:
+    forms = []  # type: List[str]
+    tags = []  # type: List[str]
+    for sent in conll_reader(path, cols=['FORM', 'UPOS'], tags=False):
+        for form, pos in sent:
+            forms.append(form)
+            tags.append(pos)
+    return forms, tags
+
+
+class _StreamBuilder:
+    def __init__(self, string_ids: Dict[str, int]) -> None:
+        self.string_ids = string_ids
+        self.ids = []  # type: List[int]
+        self.offsets = [0]
+        self.present = []  # type: List[bool]
+
+    def add(self, tokens: Optional[Iterable[str]]) -> None:
+        if tokens is not None:
+            string_ids = self.string_ids
+            for token in tokens:
+                if token not in string_ids:
+                    string_ids[token] = len(string_ids)
+                self.ids.append(string_ids[token])
+        self.offsets.append(len(self.ids))
+        self.present.append(tokens is not None)
+
+    def save(self, folder: Path, stream: str, sha1) -> None:
+        arrays = (
+            ('ids', np.array(self.ids, dtype=np.int32)),
+            ('offsets', np.array(self.offsets, dtype=np.int64)),
+            ('present', np.array(self.present, dtype=bool)),
+        )
+        for part, array in arrays:
+            sha1.update(array.tobytes())
+            np.save(str(folder / ('%s.%s.npy' % (stream, part))), array)
+
+
+def compile_corpus_store(data_dir: Path, store_dir: Optional[Path] = None) -> Path:
+    """Pack all documents in data_dir/txt and data_dir/conll into a store.
+
+    Returns:
+        The folder the store was written to.
+    """
+    txt_dir = data_dir / 'txt'
+    conll_dir = data_dir / 'conll'
+    if store_dir is None:
+        store_dir = data_dir / 'store'
+    if not store_dir.is_dir():
+        store_dir.mkdir(parents=True)
+    manifest = store_dir / MANIFEST
+    if manifest.exists():
+        manifest.unlink()
+
+    docs = sorted(
+        set(p.stem for p in txt_dir.glob('*.txt')) | set(p.stem for p in conll_dir.glob('*.conll'))
+    )
+    string_ids = {}  # type: Dict[str, int]
+    builders = {stream: _StreamBuilder(string_ids) for stream in STREAMS}
+    for doc in docs:
+        txt_path = txt_dir / (doc + '.txt')
+        builders['txt'].add(_txt_tokens(txt_path) if txt_path.is_file() else None)
+        conll_path = conll_dir / (doc + '.conll')
+        if conll_path.is_file():
+            forms, tags = _conll_tokens(conll_path)
+            builders['form'].add(forms)
+            builders['upos'].add(tags)
+        else:
+            builders['form'].add(None)
+            builders['upos'].add(None)
+
+    sha1 = hashlib.sha1()
+    for stream in STREAMS:
+        builders[stream].save(store_dir, stream, sha1)
+    strings = sorted(string_ids, key=string_ids.__getitem__)
+    with (store_dir / 'strings.txt').open('w', encoding='utf-8', newline='\n') as f:
+        for string in strings:
+            f.write(string + '\n')
+            sha1.update(string.encode('utf-8') + b'\n')
+    with (store_dir / 'docs.txt').open('w', encoding='utf-8', newline='\n') as f:
+        for doc in docs:
+            f.write(doc + '\n')
+            sha1.update(doc.encode('utf-8') + b'\n')
+    with manifest.open('w') as f:
+        json.dump(
+            {
+                'version': STORE_VERSION,
+                'streams': list(STREAMS),
+                'num_docs': len(docs),
+                'num_strings': len(string_ids),
+                'digest': sha1.hexdigest(),
+            },
+            f,
+        )
+    return store_dir
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR)
+    parser.add_argument('--output', '-o', type=Path, help='Defaults to <data-dir>/store')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store_dir = compile_corpus_store(args.data_dir, args.output)
+    store = open_corpus_store(store_dir)
+    print(
+        'Wrote %d documents and %d strings to %s'
+        % (len(store.doc_index), len(store.strings), store_dir)
+    )
+
+
+if __name__ == '__main__':
+    main()
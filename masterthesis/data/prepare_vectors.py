@@ -1,56 +1,158 @@
-"""Store pre-trained vectors for the vocabulary in training set"""
+"""Store pre-trained vectors for the vocabulary in training set
+
+The input vectors are streamed, and only the vectors of the vocabulary
+are kept, so the memory use is that of the output. Supported inputs are
+fastText binaries, word2vec binaries, text vectors (.vec or .txt) and
+ZIP archives from the NLPL vector repository, whose members are read
+without extracting them.
+"""
 import argparse
+import io
 from itertools import chain
 import logging
 from pathlib import Path
+import struct
+from typing import BinaryIO, Iterable, List, Set, TextIO, Tuple  # noqa: F401
+import zipfile
 
-from gensim.models.keyedvectors import WordEmbeddingsKeyedVectors
 import numpy as np
-import tqdm
 
+from masterthesis.fasttext import FASTTEXT_MAGIC, StreamReader, word_vectors
 from masterthesis.features.build_features import iterate_tokens
-from masterthesis.gensim_utils import load_fasttext_embeddings
+from masterthesis.vectors import save_vectors, unit_normalize
 
 logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Members of NLPL archives, in order of preference
+ARCHIVE_MEMBERS = ['parameters.bin', 'model.bin', 'model.txt']
+
+WordVectors = Tuple[List[str], np.ndarray]
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('input', type=Path)
+    parser.add_argument('input', type=Path, nargs='+')
     parser.add_argument('outputdir', type=Path)
     parser.add_argument('--outputname', type=str)
+    parser.add_argument('--format', choices={'pkl', 'npy'}, default='pkl',
+                        help='Gensim keyed vectors or the memory mapped native format')
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument("--splits", type=str.split, default=["train"])
     args = parser.parse_args()
+    if args.outputname and len(args.input) > 1:
+        parser.error('--outputname requires a single input')
     if args.verbose:
         logging.getLogger(None).setLevel(logging.DEBUG)
     return args
 
 
+def read_text_vectors(f: TextIO, vocab: Set[str]) -> WordVectors:
+    """Read vectors of the vocabulary from text, skipping a word2vec header."""
+    words = []
+    vectors = []
+    dim = None
+    for line in f:
+        parts = line.rstrip('\n').rstrip(' ').split(' ')
+        if dim is None:
+            dim = len(parts) - 1
+            if len(parts) == 2 and all(part.isdigit() for part in parts):
+                dim = int(parts[1])
+                continue
+        # Words may contain spaces, so the vector is the last dim fields
+        word = ' '.join(parts[:-dim])
+        if word in vocab:
+            words.append(word)
+            vectors.append(np.array(parts[-dim:], dtype=np.float32))
+    return words, np.array(vectors, dtype=np.float32).reshape(len(words), dim or 0)
+
+
+def read_word2vec_binary(f: BinaryIO, vocab: Set[str]) -> WordVectors:
+    """Read vectors of the vocabulary from the word2vec binary format."""
+    reader = StreamReader(f)
+    count, dim = map(int, reader.read_until(b'\n').split())
+    words = []
+    vectors = []
+    for __ in range(count):
+        # Some writers end every vector with a newline
+        word = reader.read_until(b' ').lstrip(b'\n').decode('utf-8', errors='replace')
+        data = reader.read(4 * dim)
+        if word in vocab:
+            words.append(word)
+            vectors.append(np.frombuffer(data, dtype='<f4'))
+    return words, np.array(vectors, dtype=np.float32).reshape(len(words), dim)
+
+
+def read_binary(f: BinaryIO, vocab: Set[str]) -> WordVectors:
+    """Read a fastText or word2vec binary, telling them apart by the magic number."""
+    # Both files and archive members can peek without consuming
+    if f.peek(4)[:4] == struct.pack('<i', FASTTEXT_MAGIC):
+        # fastText gives vectors for any word, also those outside its dictionary
+        return word_vectors(f, sorted(vocab))
+    return read_word2vec_binary(f, vocab)
+
+
+def read_stream(f: BinaryIO, name: str, vocab: Set[str]) -> WordVectors:
+    if name.endswith('.bin'):
+        return read_binary(f, vocab)
+    text = io.TextIOWrapper(f, encoding='utf-8', errors='replace')
+    return read_text_vectors(text, vocab)
+
+
+def read_vectors(path: Path, vocab: Set[str]) -> WordVectors:
+    """Read the vectors of the vocabulary from a file or an NLPL archive."""
+    if path.suffix == '.zip':
+        with zipfile.ZipFile(str(path)) as archive:
+            names = set(archive.namelist())
+            member = next((name for name in ARCHIVE_MEMBERS if name in names), None)
+            if member is None:
+                raise ValueError('No vectors in %s, expected one of %s' % (path, ARCHIVE_MEMBERS))
+            with archive.open(member) as f:
+                return read_stream(f, member, vocab)
+    if path.suffix not in {'.bin', '.vec', '.txt'}:
+        raise ValueError('Unknown vector format: %s' % path)
+    with path.open('rb') as f:
+        return read_stream(f, path.name, vocab)
+
+
+def save_gensim(path: Path, words: List[str], vectors: np.ndarray) -> None:
+    from gensim.models.keyedvectors import KeyedVectors
+
+    vectors = unit_normalize(vectors)
+    kv = KeyedVectors(vectors.shape[1])
+    if hasattr(kv, 'add_vectors'):
+        kv.add_vectors(words, vectors)
+    else:
+        # Gensim 3
+        kv.add(words, vectors)
+    kv.save(str(path))
+
+
+def output_path(args: argparse.Namespace, input_path: Path) -> Path:
+    if args.outputname:
+        return args.outputdir / args.outputname
+    return args.outputdir / (input_path.stem + '-small.' + args.format)
+
+
 def main():
     args = parse_args()
-    if not args.input.is_file():
-        raise FileNotFoundError('%r is not a file' % args.input)
+    for path in args.input:
+        if not path.is_file():
+            raise FileNotFoundError('%r is not a file' % path)
     if not args.outputdir.is_dir():
         raise FileNotFoundError('%r is not a directory' % args.outputdir)
-    if args.outputname:
-        outfile = args.outputdir / args.outputname
-    else:
-        name = args.input.stem + '-small.pkl'
-        outfile = args.outputdir / name
-
-    kv = load_fasttext_embeddings(args.input)
 
-    vector_size = kv.vector_size
     token_iter = chain.from_iterable(iterate_tokens(s) for s in args.splits)
-    words = list(set(token_iter)) + ["__UNK__", "__PAD__"]
-    embeddings = np.zeros((len(words), vector_size))
-    for row, word in tqdm.tqdm(enumerate(words)):
-        embeddings[row, :] = kv.word_vec(word)
-
-    new_kv = WordEmbeddingsKeyedVectors(vector_size)
-    new_kv.add(words, embeddings)
-    new_kv.save(str(outfile))
+    vocab = set(token_iter) | {"__UNK__", "__PAD__"}
+    for path in args.input:
+        words, vectors = read_vectors(path, vocab)
+        logger.info('%s: %d of %d words have vectors', path, len(words), len(vocab))
+        outfile = output_path(args, path)
+        if args.format == 'npy':
+            save_vectors(outfile, words, vectors)
+        else:
+            save_gensim(outfile, words, vectors)
+        print('Saved %s' % outfile)
 
 
 if __name__ == '__main__':
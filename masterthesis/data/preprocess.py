@@ -1,6 +1,11 @@
 import argparse
 from collections import defaultdict
+from functools import partial
+import hashlib
+import json
+from multiprocessing import Pool
 from pathlib import Path
+from typing import Any, Dict, List, Optional  # noqa: F401
 from xml.etree import ElementTree
 
 import pandas as pd
@@ -48,9 +53,31 @@ dev_topics = {
 }
 
 
+CACHE_FILE = DATA_DIR / 'xml-cache.json'
+# Increase when the parsing changes, so that cached rows are parsed again
+CACHE_VERSION = 1
+PERSON_PATH = ['teiHeader', 'profileDesc', 'particDesc', 'person']
+METADATA_FIELDS = {
+    'language': 'lang',
+    'CEFRscore': 'cefr',
+    'testlevel': 'testlevel',
+    'age': 'age',
+    'gender': 'gender',
+    'tema': 'topic',
+}
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('--output', '-o', action='store_true', help='Output text files')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1, help='Number of files to parse in parallel'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only parse files that changed since the last incremental run',
+    )
     return parser.parse_args()
 
 
@@ -66,19 +93,6 @@ def ensure_dirs():
     return input_dir, output_dir
 
 
-def parse_file_and_return_root(input_file: Path):
-    if input_file.suffix != '.xml':
-        print('Skipping ' + str(input_file))
-        return None
-    try:
-        tree = ElementTree.parse(input_file.open(encoding='utf8'))
-    except Exception as e:
-        print('Unable to parse ' + str(input_file))
-        print(str(e))
-        raise
-    return tree.getroot()
-
-
 def assign_split(cefr_score, topic, test_topics, dev_topics):
     if cefr_score == 'N/A':
         return 'N/A'
@@ -90,83 +104,239 @@ def assign_split(cefr_score, topic, test_topics, dev_topics):
         return 'train'
 
 
+def file_digest(input_file: Path) -> str:
+    sha1 = hashlib.sha1()
+    with input_file.open('rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class _TeiDocument:
+    """Collects metadata and sentences from iterparse events of a TEI file."""
+
+    def __init__(self) -> None:
+        self.fields = {}  # type: Dict[str, str]
+        self.found_person = False
+        self.found_text = False
+        self.title = None  # type: Optional[str]
+        self.head_sents = []  # type: List[List[str]]
+        self.paragraphs = []  # type: List[List[List[str]]]
+        self.num_words = 0
+        self._path = []  # type: List[str]
+        self._heads_seen = 0
+        self._in_first_head = False
+        self._open_paragraphs = 0
+
+    def _in_body(self) -> bool:
+        return self._path[1:3] == ['text', 'body']
+
+    def start(self, elem: ElementTree.Element) -> None:
+        self._path.append(elem.tag)
+        if not self._in_body():
+            return
+        if elem.tag == 'head':
+            self._heads_seen += 1
+            self._in_first_head = self._heads_seen == 1
+        elif elem.tag == 'p':
+            self._open_paragraphs += 1
+            self.paragraphs.append([])
+
+    def end(self, elem: ElementTree.Element) -> None:
+        rel_path = self._path[1:]
+        if rel_path == PERSON_PATH:
+            self.found_person = True
+        elif rel_path[:-1] == PERSON_PATH and elem.tag == 'p':
+            name = METADATA_FIELDS.get(elem.get('n'))
+            if name is not None:
+                self.fields.setdefault(name, elem.text)
+        elif rel_path == ['text', 'front', 'div']:
+            if elem.get('type') == 'title' and self.title is None:
+                self.title = elem.text
+        elif rel_path == ['text']:
+            self.found_text = True
+        elif elem.tag == 'word' and rel_path[:1] == ['text']:
+            self.num_words += 1
+
+        if self._in_body():
+            self._end_body_element(elem)
+        self._path.pop()
+
+    def _end_body_element(self, elem: ElementTree.Element) -> None:
+        if elem.tag == 's':
+            words = [w.text for w in elem.iter('word') if w.text]
+            if self._in_first_head:
+                self.head_sents.append(words)
+            if self._open_paragraphs:
+                self.paragraphs[-1].append(words)
+            # Sentences are not needed after this, keep memory use bounded
+            elem.clear()
+        elif elem.tag == 'head':
+            self._in_first_head = False
+        elif elem.tag == 'p':
+            self._open_paragraphs -= 1
+
+
+def extract_document(input_file: Path, output_dir: Path, output: bool) -> Dict[str, Any]:
+    """Parse a TEI file incrementally and return its metadata.
+
+    Args:
+        input_file: The XML file to parse
+        output_dir: Folder to write the text file to
+        output: Whether to write the text to output_dir/<stem>.txt
+
+    Returns:
+        The metadata row for the document.
+    """
+    doc = _TeiDocument()
+    try:
+        for event, elem in ElementTree.iterparse(str(input_file), events=('start', 'end')):
+            if event == 'start':
+                doc.start(elem)
+            else:
+                doc.end(elem)
+    except Exception as e:
+        print('Unable to parse ' + str(input_file))
+        print(str(e))
+        raise
+    assert doc.found_person, "Could not find metadata in file " + str(input_file)
+    assert doc.found_text, "Missing text in file " + str(input_file)
+
+    row = {
+        name: doc.fields.get(name) or 'N/A'
+        for name in ('lang', 'cefr', 'testlevel', 'gender', 'topic')
+    }  # type: Dict[str, Any]
+    try:
+        row['age'] = int(doc.fields['age'])
+    except (KeyError, TypeError, ValueError):
+        row['age'] = -1
+    row['filename'] = input_file.stem
+    row['title'] = doc.title or 'N/A'
+
+    if output:
+        output_file = str(output_dir / input_file.stem) + '.txt'
+        row['num_tokens'] = write_text(doc, output_file)
+    else:
+        row['num_tokens'] = doc.num_words
+    return row
+
+
+def write_text(doc: _TeiDocument, output_file: str) -> int:
+    """Write the sentences of doc to a text file and return the number of tokens."""
+    num_tokens = 0
+    with open(output_file, 'w', encoding='utf-8') as outfile:
+        for words in doc.head_sents:
+            num_tokens += len(words)
+            outfile.write(' '.join(words) + '\n')
+        for paragraph in doc.paragraphs:
+            outfile.write('\n')
+            for words in paragraph:
+                num_tokens += len(words)
+                outfile.write(' '.join(words) + '\n')
+    return num_tokens
+
+
+def load_cache() -> Dict[str, Dict[str, Any]]:
+    """Return the cached entries, or none if another CACHE_VERSION made them."""
+    if not CACHE_FILE.is_file():
+        return {}
+    with CACHE_FILE.open(encoding='utf-8') as f:
+        cache = json.load(f)
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['files']
+
+
+def save_cache(entries: Dict[str, Dict[str, Any]]) -> None:
+    with CACHE_FILE.open('w', encoding='utf-8') as f:
+        json.dump({'version': CACHE_VERSION, 'files': entries}, f, ensure_ascii=False)
+
+
+def is_fresh(
+    entry: Optional[Dict[str, Any]], input_file: Path, output_file: Optional[Path] = None
+) -> bool:
+    """Whether the cached entry for input_file can be used as is.
+
+    Args:
+        entry: The cached entry from the last incremental run
+        input_file: The XML file
+        output_file: The text file, if the text should be output
+    """
+    if entry is None:
+        return False
+    if output_file is not None and not (entry['output'] and output_file.is_file()):
+        return False
+    if entry['mtime'] == input_file.stat().st_mtime:
+        return True
+    if entry['sha1'] == file_digest(input_file):
+        entry['mtime'] = input_file.stat().st_mtime
+        return True
+    return False
+
+
+def cache_entry(input_file: Path, row: Dict[str, Any], output: bool, incremental: bool):
+    """The cache entry of a parsed file.
+
+    Only incremental runs hash the file, since that reads it again.
+    """
+    entry = {'row': row}  # type: Dict[str, Any]
+    if incremental:
+        entry.update(
+            sha1=file_digest(input_file), mtime=input_file.stat().st_mtime, output=output
+        )
+    return entry
+
+
 def main():
     args = parse_args()
 
     input_dir, output_dir = ensure_dirs()
 
-    metadata_dict = defaultdict(list)
-
-    for input_file in input_dir.iterdir():
-        root = parse_file_and_return_root()
-        if root is None:
+    input_files = []
+    for input_file in sorted(input_dir.iterdir()):
+        if input_file.suffix != '.xml':
+            print('Skipping ' + str(input_file))
             continue
+        input_files.append(input_file)
+
+    cache = load_cache() if args.incremental else {}
+    new_cache = {}  # type: Dict[str, Dict[str, Any]]
+    stale_files = []
+    for input_file in input_files:
+        entry = cache.get(input_file.stem)
+        output_file = (output_dir / input_file.stem).with_suffix('.txt') if args.output else None
+        if is_fresh(entry, input_file, output_file):
+            new_cache[input_file.stem] = entry
+        else:
+            stale_files.append(input_file)
+    print(
+        'Parsing %d of %d files (%d unchanged)'
+        % (len(stale_files), len(input_files), len(input_files) - len(stale_files))
+    )
+
+    extract = partial(extract_document, output_dir=output_dir, output=args.output)
+    if args.jobs > 1 and len(stale_files) > 1:
+        with Pool(args.jobs) as pool:
+            rows = pool.map(extract, stale_files, chunksize=16)
+    else:
+        rows = [extract(input_file) for input_file in stale_files]
 
-        metadata_node = root.find('./teiHeader/profileDesc/particDesc/person')
-        assert metadata_node, "Could not find metadata in file " + str(input_file)
-
-        language_node = metadata_node.find("./p[@n='language']")
-        cefr_score_node = metadata_node.find("./p[@n='CEFRscore']")
-        testlevel_node = metadata_node.find("./p[@n='testlevel']")
-        age_node = metadata_node.find("./p[@n='age']")
-        gender_node = metadata_node.find("./p[@n='gender']")
-        topic_node = metadata_node.find("./p[@n='tema']")
-
-        language = language_node.text if language_node is not None else 'N/A'
-        cefr_score = cefr_score_node.text if cefr_score_node is not None else 'N/A'
-        testlevel = testlevel_node.text if testlevel_node is not None else 'N/A'
-        try:
-            age = int(age_node.text) if age_node is not None else -1
-        except ValueError:
-            age = -1
-        gender = gender_node.text if gender_node is not None else 'N/A'
-        topic = topic_node.text if topic_node is not None else 'N/A'
-
-        split = assign_split(cefr_score, topic, test_topics, dev_topics)
-
-        metadata_dict['lang'].append(language)
-        metadata_dict['cefr'].append(cefr_score)
-        metadata_dict['testlevel'].append(testlevel)
-        metadata_dict['age'].append(age)
-        metadata_dict['gender'].append(gender)
-        metadata_dict['topic'].append(topic)
-        metadata_dict['split'].append(split)
-        metadata_dict['filename'].append(input_file.stem)
-
-        text = root.find('text')
-        assert text, "Missing text in file " + str(input_file)
-
-        title_node = text.find("./front/div[@type='title']")
-        title = title_node.text if topic_node is not None else 'N/A'
-
-        metadata_dict['title'].append(title)
+    for input_file, row in zip(stale_files, rows):
+        new_cache[input_file.stem] = cache_entry(input_file, row, args.output, args.incremental)
+    if args.incremental:
+        save_cache(new_cache)
 
-        if not args.output:
-            num_tokens = sum(1 for _ in text.iter('word'))
-        else:
-            num_tokens = 0
-            output_file = str(output_dir / input_file.stem) + '.txt'
-            with open(output_file, 'w', encoding='utf-8') as outfile:
-                body = text.find('body')
-
-                head = body.find('.//head')
-                if head is not None:
-                    for sentence in head.iter('s'):
-                        words = [w.text for w in sentence.iter('word') if w.text]
-                        num_tokens += len(words)
-                        joined = ' '.join(words)
-                        outfile.write(joined + '\n')
-
-                for paragraph in body.iter('p'):
-                    outfile.write('\n')
-                    for sentence in paragraph.iter('s'):
-                        words = [w.text for w in sentence.iter('word') if w.text]
-                        num_tokens += len(words)
-                        joined = ' '.join(words)
-                        outfile.write(joined + '\n')
-        metadata_dict['num_tokens'].append(num_tokens)
+    metadata_dict = defaultdict(list)
+    for input_file in input_files:
+        row = new_cache[input_file.stem]['row']
+        # Split assignment is not cached, the topic lists may have changed
+        split = assign_split(row['cefr'], row['topic'], test_topics, dev_topics)
+        for key, value in row.items():
+            metadata_dict[key].append(value)
+        metadata_dict['split'].append(split)
 
     metadata_df = pd.DataFrame(metadata_dict)
+    metadata_df = metadata_df.reindex(sorted(metadata_df.columns), axis='columns')
     metadata_df.sort_values('filename').to_csv(DATA_DIR / 'metadata.csv', index=False)
     cefr_by_lang = metadata_df.groupby(['lang', 'cefr']).size().unstack(fill_value=0)
 
@@ -1,11 +1,29 @@
+"""Search for a topic-based dev/test split with representative label distributions.
+
+Every candidate split assigns each topic to train (0), dev (1) or test
+(2). A candidate is penalized by the squared KL divergences of the CEFR
+and L1 distributions of dev and test from the whole corpus, and by how
+far the dev and test sizes are from the target size. An evolutionary
+algorithm keeps the best candidates of every generation and mutates
+them.
+
+Documents only enter the penalty through per-topic label counts, so
+SplitProblem counts them once and scores a whole population with one
+product of the one-hot topic assignments and the count matrix.
+"""
+import argparse
 from functools import partial
-from itertools import chain
-from typing import Tuple
+import multiprocessing
+from pathlib import Path
+import pickle
+from typing import Any, Dict, List, Optional, Sequence, Tuple  # noqa: F401
 
 import numpy as np
 import pandas as pd
 from scipy.stats import entropy
 
+from masterthesis.utils import atomic_write
+
 CEFR_LABELS = ['A2', 'A2/B1', 'B1', 'B1/B2', 'B2', 'B2/C1', 'C1']
 LANG_LABELS = [
     'russisk',
@@ -16,6 +34,7 @@ LANG_LABELS = [
     'spansk',
     'somali',
 ]
+TARGET_SIZE = 121
 
 
 def cefr_distribution(df):
@@ -68,8 +87,344 @@ def evaluate_candidate(df, sample_topics, topics, overall_cefr, overall_lang):
     }
 
 
+def kl_divergence(counts: np.ndarray, overall: np.ndarray) -> np.ndarray:
+    """KL divergence of count distributions from an overall distribution.
+
+    Computes the same as scipy.stats.entropy(counts, overall) along the
+    last axis, for any number of leading axes. Empty distributions give
+    NaN, like scipy.
+    """
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = counts / totals
+        q = overall / overall.sum()
+        terms = np.where(p > 0, p * np.log(p / q), 0.0)
+    return np.where(totals[..., 0] > 0, terms.sum(axis=-1), np.nan)
+
+
+class SplitProblem:
+    """Per-topic label counts for scoring candidate splits.
+
+    Args:
+        df: Metadata of the documents with a CEFR score
+        topics: The topics that candidates assign, defaults to all
+            topics in df in order of appearance
+        target_size: The number of documents wanted in dev and test
+
+    Attributes:
+        counts: A (topics, CEFR labels + L1 labels + 1) matrix with the
+            number of documents of every topic with each CEFR score and
+            L1, and the total number of documents of the topic
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        topics: Optional[Sequence[str]] = None,
+        target_size: int = TARGET_SIZE,
+    ) -> None:
+        if topics is None:
+            topics = df.topic.unique()
+        self.topics = np.asarray(topics)
+        self.target_size = target_size
+        self.overall_cefr = cefr_distribution(df)
+        self.overall_lang = lang_distribution(df)
+        topic_codes = pd.Categorical(df.topic, categories=self.topics).codes
+        cefr_codes = pd.Categorical(df.cefr, categories=CEFR_LABELS).codes
+        lang_codes = pd.Categorical(df.lang, categories=LANG_LABELS).codes
+        num_topics = len(self.topics)
+        counts = np.zeros((num_topics, len(CEFR_LABELS) + len(LANG_LABELS) + 1))
+        in_topics = topic_codes >= 0
+        # Unknown labels count towards the size, but not the distributions
+        rows = in_topics & (cefr_codes >= 0)
+        np.add.at(counts, (topic_codes[rows], cefr_codes[rows]), 1)
+        rows = in_topics & (lang_codes >= 0)
+        np.add.at(counts, (topic_codes[rows], len(CEFR_LABELS) + lang_codes[rows]), 1)
+        np.add.at(counts[:, -1], topic_codes[in_topics], 1)
+        self.counts = counts
+
+    def distributions(self, population: np.ndarray) -> np.ndarray:
+        """Count the labels in dev and test of every candidate.
+
+        Args:
+            population: A (candidates, topics) array of split assignments
+
+        Returns:
+            A (candidates, 2, CEFR labels + L1 labels + 1) array of
+            counts for dev and test, laid out like counts.
+        """
+        splits = np.array([1, 2])[:, None]
+        one_hot = (population[:, None, :] == splits).astype(self.counts.dtype)
+        return one_hot @ self.counts
+
+    def score(self, population: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Score every candidate in a population.
+
+        Returns:
+            The penalty of every candidate, a (candidates, 4) array of
+            the KL divergences of dev CEFR, test CEFR, dev L1 and test
+            L1, and a (candidates, 2) array of dev and test sizes.
+            Candidates with an empty dev or test set get an infinite
+            penalty.
+        """
+        dists = self.distributions(np.asarray(population))
+        num_cefr = len(CEFR_LABELS)
+        cefr_kl = kl_divergence(dists[:, :, :num_cefr], self.overall_cefr)
+        lang_kl = kl_divergence(dists[:, :, num_cefr:-1], self.overall_lang)
+        entropies = np.stack(
+            [cefr_kl[:, 0], cefr_kl[:, 1], lang_kl[:, 0], lang_kl[:, 1]], axis=1
+        )
+        sizes = dists[:, :, -1]
+        size_penalty = np.abs(sizes - self.target_size).sum(axis=1) / self.target_size
+        penalties = np.sum(entropies ** 2, axis=1) + size_penalty
+        penalties[np.isnan(penalties)] = np.inf
+        return penalties, entropies, sizes.astype(int)
+
+    def describe(self, individual: np.ndarray) -> Dict[str, Any]:
+        """Return the same summary of a candidate as evaluate_candidate."""
+        penalties, entropies, sizes = self.score(individual[None, :])
+        return {
+            'dev_topics': set(self.topics[individual == 1]),
+            'test_topics': set(self.topics[individual == 2]),
+            'entropies': entropies[0],
+            'sample_sizes': tuple(int(size) for size in sizes[0]),
+            'penalty': penalties[0],
+        }
+
+
+class EvolutionState:
+    """Everything needed to continue an evolution run.
+
+    Attributes:
+        population: The candidates of the next generation
+        rng: The random state
+        best: The best candidate seen so far
+        best_penalty: Its penalty
+        generations: The number of generations evaluated
+        stale: The number of generations since best improved
+    """
+
+    def __init__(self, population: np.ndarray, rng: np.random.RandomState) -> None:
+        self.population = population
+        self.rng = rng
+        self.best = None  # type: Optional[np.ndarray]
+        self.best_penalty = np.inf
+        self.generations = 0
+        self.stale = 0
+
+
+def initial_state(
+    num_topics: int, pop_size: int = 100, seed: Optional[int] = None
+) -> EvolutionState:
+    rng = np.random.RandomState(seed)
+    population = rng.choice([0, 1, 2], (pop_size, num_topics), p=[0.8, 0.1, 0.1])
+    return EvolutionState(population, rng)
+
+
+def mutate(individual, rng=np.random):
+    """Reassign each topic at random with a probability of 0.2.
+
+    Also works on a whole population at once.
+    """
+    shape = np.shape(individual)
+    mask = rng.random_sample(shape) > 0.2
+    new_individual = rng.choice([0, 1, 2], shape)
+    new_individual[mask] = individual[mask]
+    return new_individual
+
+
+def step(
+    problem: SplitProblem, state: EvolutionState, elite_size: int = 20, tol: float = 0.0
+) -> bool:
+    """Evaluate one generation and breed the next.
+
+    Returns:
+        Whether the best candidate improved by more than tol.
+    """
+    population = state.population
+    penalties, __, __ = problem.score(population)
+    best_idx = np.argmin(penalties)
+    improved = penalties[best_idx] < state.best_penalty - tol
+    if penalties[best_idx] < state.best_penalty:
+        state.best = population[best_idx].copy()
+        state.best_penalty = penalties[best_idx]
+    state.stale = 0 if improved else state.stale + 1
+    state.generations += 1
+
+    elite_indices = np.argpartition(penalties, elite_size)[:elite_size]
+    mutants_per_cand = len(population) // elite_size
+    elite = np.repeat(population[elite_indices], mutants_per_cand, axis=0)
+    state.population = mutate(elite, state.rng)
+    return improved
+
+
+def save_checkpoint(path: Path, states: List[EvolutionState]) -> None:
+    with atomic_write(path) as f:
+        pickle.dump(states, f)
+
+
+def load_checkpoint(path: Path) -> List[EvolutionState]:
+    with path.open('rb') as f:
+        return pickle.load(f)
+
+
+def evolve(
+    problem: SplitProblem,
+    state: EvolutionState,
+    max_generations: Optional[int] = None,
+    patience: Optional[int] = 200,
+    elite_size: int = 20,
+    tol: float = 0.0,
+    verbose: bool = False,
+) -> EvolutionState:
+    """Run generations until max_generations or patience generations without improvement."""
+    while not _should_stop(state, max_generations, patience):
+        improved = step(problem, state, elite_size=elite_size, tol=tol)
+        if improved and verbose:
+            print('Generation %d: %r' % (state.generations, problem.describe(state.best)))
+    return state
+
+
+def _should_stop(
+    state: EvolutionState, max_generations: Optional[int], patience: Optional[int]
+) -> bool:
+    if max_generations is not None and state.generations >= max_generations:
+        return True
+    return patience is not None and state.stale >= patience
+
+
+def _migrate(states: List[EvolutionState]) -> None:
+    """Send the best candidate of every island to the next island in a ring."""
+    bests = [state.best for state in states]
+    for i, state in enumerate(states):
+        best = bests[i - 1]
+        if best is not None:
+            state.population[0] = best
+
+
+def _run_island_round(run_island, state: EvolutionState, limit: int) -> EvolutionState:
+    return run_island(state, max_generations=limit)
+
+
+def _run_round(
+    run_island,
+    states: List[EvolutionState],
+    pool,
+    migration_interval: int,
+    max_generations: Optional[int],
+) -> List[EvolutionState]:
+    """Run every island for migration_interval generations."""
+    round_states = []
+    for state in states:
+        limit = state.generations + migration_interval
+        if max_generations is not None:
+            limit = min(limit, max_generations)
+        round_states.append((state, limit))
+    if pool is None:
+        return [run_island(state, max_generations=limit) for state, limit in round_states]
+    return pool.starmap(
+        _run_island_round, [(run_island, state, limit) for state, limit in round_states]
+    )
+
+
+def evolution(
+    df,
+    topics,
+    overall_cefr=None,
+    overall_lang=None,
+    pop_size: int = 100,
+    elite_size: int = 20,
+    max_generations: Optional[int] = None,
+    patience: Optional[int] = 200,
+    tol: float = 0.0,
+    seed: Optional[int] = None,
+    islands: int = 1,
+    migration_interval: int = 50,
+    jobs: int = 1,
+    checkpoint: Optional[Path] = None,
+    resume: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """Search for the best split of topics into train, dev and test.
+
+    The overall distributions are computed from df, the arguments are
+    only kept for backwards compatibility. With several islands, each
+    runs its own population in a process pool for migration_interval
+    generations at a time, after which the best candidate of every
+    island migrates to the next. The search stops when every island has
+    reached max_generations or gone patience generations without
+    improving, or on Ctrl-C. The state is checkpointed after every
+    round (every migration_interval generations), and can be resumed.
+
+    Returns:
+        The summary of the best candidate, see evaluate_candidate, or
+        None if no candidate had a finite penalty (e.g. on Ctrl-C before
+        the first generation).
+    """
+    problem = SplitProblem(df, topics)
+    if resume and checkpoint is not None and checkpoint.is_file():
+        states = load_checkpoint(checkpoint)
+        print('Resuming after %d generations' % max(s.generations for s in states))
+    else:
+        states = [
+            initial_state(len(topics), pop_size, None if seed is None else seed + i)
+            for i in range(islands)
+        ]
+    run_island = partial(
+        evolve,
+        problem,
+        max_generations=max_generations,
+        patience=patience,
+        elite_size=elite_size,
+        tol=tol,
+    )
+    print('Starting evolution algorithm ... Ctrl-C to end')
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(states) > 1 else None
+    try:
+        while not all(_should_stop(s, max_generations, patience) for s in states):
+            states = _run_round(run_island, states, pool, migration_interval, max_generations)
+            if len(states) > 1:
+                _migrate(states)
+            best = min(states, key=lambda s: s.best_penalty)
+            if best.best is not None:
+                print('Generation %d: %r' % (best.generations, problem.describe(best.best)))
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, states)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print('Stopped after {} generations.'.format(max(s.generations for s in states)))
+    best = min(states, key=lambda s: s.best_penalty)
+    if best.best is None:
+        return None
+    return problem.describe(best.best)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--metadata', type=Path, default=Path('metadata.csv'))
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--population-size', type=int, default=100)
+    parser.add_argument('--elite-size', type=int, default=20)
+    parser.add_argument('--max-generations', type=int)
+    parser.add_argument(
+        '--patience',
+        type=int,
+        default=200,
+        help='Stop after this many generations without improvement',
+    )
+    parser.add_argument('--islands', type=int, default=1)
+    parser.add_argument('--migration-interval', type=int, default=50)
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--checkpoint', type=Path)
+    parser.add_argument('--resume', action='store_true')
+    return parser.parse_args()
+
+
 def main():
-    df = pd.read_csv('metadata.csv').dropna(subset=['cefr'])
+    args = parse_args()
+    df = pd.read_csv(str(args.metadata)).dropna(subset=['cefr'])
     overall_cefr = cefr_distribution(df)
     overall_lang = lang_distribution(df)
 
@@ -78,7 +433,25 @@ def main():
     print(overall_cefr)
     print(overall_lang)
 
-    best_split = evolution(df, topics, overall_cefr, overall_lang)
+    best_split = evolution(
+        df,
+        topics,
+        overall_cefr,
+        overall_lang,
+        pop_size=args.population_size,
+        elite_size=args.elite_size,
+        max_generations=args.max_generations,
+        patience=args.patience,
+        seed=args.seed,
+        islands=args.islands,
+        migration_interval=args.migration_interval,
+        jobs=args.jobs,
+        checkpoint=args.checkpoint,
+        resume=args.resume,
+    )
+    if best_split is None:
+        print('No split with a finite penalty was found.')
+        return
 
     dev_set = topics_to_df(df, best_split['dev_topics'])
     test_set = topics_to_df(df, best_split['test_topics'])
@@ -92,52 +465,5 @@ def main():
     print(test_set.lang.value_counts().reindex(LANG_LABELS, fill_value=0))
 
 
-def mutate(individual):
-    n = len(individual)
-    mask = np.random.random(n) > 0.2
-    new_individual = np.random.choice([0, 1, 2], n)
-    new_individual[mask] = individual[mask]
-    return new_individual
-
-
-def evolution(df, topics, overall_cefr, overall_lang):
-    evaluate_f = partial(
-        evaluate_candidate,
-        df=df,
-        topics=topics,
-        overall_cefr=overall_cefr,
-        overall_lang=overall_lang,
-    )
-    pop_size = 100
-    elite_size = 20
-    mutants_per_cand = pop_size // elite_size
-    best_ever = None
-    generations = 0
-    population = [
-        np.random.choice([0, 1, 2], len(topics), p=[0.8, 0.1, 0.1])
-        for _ in range(pop_size)
-    ]
-    print('Starting evolution algorithm ... Ctrl-C to end')
-    try:
-        while True:
-            results = [evaluate_f(sample_topics=cand) for cand in population]
-            penalties = [r['penalty'] for r in results]
-            best = results[np.argmin(penalties)]
-            if best_ever is None or best['penalty'] < best_ever['penalty']:
-                best_ever = best
-                print(best_ever)
-            elite_indices = np.argpartition(penalties, elite_size)[:elite_size]
-            elite = [population[i] for i in elite_indices]
-            population = list(
-                chain.from_iterable(
-                    (mutate(cand) for _ in range(mutants_per_cand)) for cand in elite
-                )
-            )
-            generations += 1
-    except KeyboardInterrupt:
-        print('Stopped after {} generations.'.format(generations))
-        return best_ever
-
-
 if __name__ == '__main__':
     main()
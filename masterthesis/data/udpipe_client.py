@@ -0,0 +1,230 @@
+"""In-process client for the UDPipe REST API.
+
+Documents are sent from a pool of worker threads, each of which keeps a
+persistent HTTP connection, so the number of requests in flight is
+bounded by the number of workers. Failed requests are retried with
+exponential backoff. Several documents can be packed into one request,
+in which case the CoNLL-U output is split back into documents by
+counting sentences: with horizontal input, every non-empty input line
+is one sentence in the output.
+"""
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import http.client
+import json
+import logging
+import re
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple  # noqa: F401
+from urllib.parse import urlencode, urlsplit
+
+from masterthesis.data.conll_cache import ConllCache
+
+UDPIPE_URL = 'https://lindat.mff.cuni.cz/services/udpipe/api/process'
+UDPIPE_MODEL = 'norwegian-bokmaal-ud-2.3-181115'  # Norwegian (bokmål)
+
+logger = logging.getLogger(__name__)
+
+_sent_id_re = re.compile(r'^# sent_id = \d+$', re.MULTILINE)
+
+
+class UDPipeError(Exception):
+    pass
+
+
+def count_sentences(text: str) -> int:
+    """Count the sentences in a text in horizontal format."""
+    return sum(1 for line in text.split('\n') if line.strip())
+
+
+def split_conllu(conllu: str, sentence_counts: Sequence[int]) -> List[str]:
+    """Split the CoNLL-U output of a batch request into documents.
+
+    Args:
+        conllu: The output of a request with several documents
+        sentence_counts: The number of sentences in each document
+
+    Returns:
+        The CoNLL-U output of each document, with sentence ids
+        numbered from 1 in each document.
+    """
+    sentences = [block for block in conllu.strip('\n').split('\n\n') if block]
+    if len(sentences) != sum(sentence_counts):
+        raise UDPipeError(
+            'Expected %d sentences, got %d' % (sum(sentence_counts), len(sentences))
+        )
+    docs = []
+    start = 0
+    for count in sentence_counts:
+        doc_sentences = [
+            _sent_id_re.sub('# sent_id = %d' % sent_id, sentence)
+            for sent_id, sentence in enumerate(sentences[start:start + count], start=1)
+        ]
+        docs.append(''.join(sentence + '\n\n' for sentence in doc_sentences))
+        start += count
+    return docs
+
+
+class UDPipeClient:
+    """Tag and parse tokenized text with a UDPipe server.
+
+    Args:
+        url: URL of the process endpoint of the API
+        model: Name of the UDPipe model to use
+        max_workers: Maximum number of requests in flight
+        retries: Number of times to retry a failed request
+        backoff: Seconds to wait before the first retry, doubled for
+            each following retry
+        timeout: Socket timeout in seconds
+        cache: Cache to look texts up in before sending them, and to
+            store the output of new texts in
+    """
+
+    def __init__(
+        self,
+        url: str = UDPIPE_URL,
+        model: str = UDPIPE_MODEL,
+        max_workers: int = 4,
+        retries: int = 3,
+        backoff: float = 1.0,
+        timeout: float = 120.0,
+        cache: Optional[ConllCache] = None,
+    ) -> None:
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            self._connection_class = http.client.HTTPSConnection
+        elif parts.scheme == 'http':
+            self._connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError('Unsupported URL scheme in %r' % url)
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        self.model = model
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self._local = threading.local()
+        self._connections = []  # type: List[http.client.HTTPConnection]
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'UDPipeClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close all open connections."""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connection_class(self.host, timeout=self.timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _post(self, body: bytes) -> Tuple[int, bytes]:
+        connection = self._connection()
+        try:
+            connection.request(
+                'POST',
+                self.path,
+                body=body,
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            )
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            # Start over with a fresh connection on the next attempt
+            connection.close()
+            raise
+
+    def process(self, text: str) -> str:
+        """Tag and parse a text in horizontal format.
+
+        Returns:
+            The CoNLL-U output of UDPipe.
+        """
+        body = urlencode(
+            {'data': text, 'input': 'horizontal', 'tagger': '', 'parser': '', 'model': self.model}
+        ).encode('utf-8')
+        for attempt in range(self.retries + 1):
+            try:
+                status, content = self._post(body)
+            except (http.client.HTTPException, OSError) as e:
+                error = UDPipeError('Request failed: %s' % e)  # type: UDPipeError
+            else:
+                if status == 200:
+                    return json.loads(content.decode('utf-8'))['result']
+                error = UDPipeError(
+                    'HTTP %d: %s' % (status, content.decode('utf-8', errors='replace'))
+                )
+                if status < 500 and status != 429:
+                    raise error
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                logger.warning('%s, retrying in %.1f s', error, delay)
+                time.sleep(delay)
+        raise error
+
+    def _process_batch(self, texts: Sequence[str]) -> List[str]:
+        counts = [count_sentences(text) for text in texts]
+        if sum(counts) == 0:
+            return ['' for __ in texts]
+        if len(texts) == 1:
+            return [self.process(texts[0])]
+        batch_text = '\n\n'.join(text.strip('\n') for text in texts) + '\n'
+        try:
+            return split_conllu(self.process(batch_text), counts)
+        except UDPipeError as e:
+            logger.warning('Could not split batch (%s), processing documents one by one', e)
+            return [self.process(text) if count else '' for text, count in zip(texts, counts)]
+
+    def process_many(
+        self, texts: Sequence[str], batch_size: int = 1
+    ) -> Iterator[Tuple[int, str]]:
+        """Tag and parse many texts concurrently.
+
+        Args:
+            texts: Texts in horizontal format
+            batch_size: Number of texts to send in each request
+
+        Yields:
+            Pairs of the index of a text and its CoNLL-U output, cache
+            hits first and the rest in the order they are completed.
+            Texts in failed requests are logged and not yielded.
+        """
+        misses = []
+        for index, text in enumerate(texts):
+            conllu = None if self.cache is None else self.cache.get(text, self.model)
+            if conllu is None:
+                misses.append(index)
+            else:
+                yield index, conllu
+        if self.cache is not None:
+            logger.info('%d cache hits, %d misses', len(texts) - len(misses), len(misses))
+        batches = [misses[start:start + batch_size] for start in range(0, len(misses), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._process_batch, [texts[i] for i in batch]): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    results = future.result()
+                except UDPipeError as e:
+                    logger.error('Failed to process documents %s: %s', batch, e)
+                    continue
+                for index, conllu in zip(batch, results):
+                    if self.cache is not None:
+                        self.cache.put(texts[index], self.model, conllu)
+                    yield index, conllu
@@ -2,11 +2,37 @@
 the UDPipe API.
 """
 
+import argparse
+import logging
 import pathlib
-import subprocess
+
+from masterthesis.data.conll_cache import ConllCache
+from masterthesis.data.udpipe_client import UDPIPE_MODEL, UDPIPE_URL, UDPipeClient
+
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=UDPIPE_URL)
+    parser.add_argument('--model', default=UDPIPE_MODEL)
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=4, help='Maximum number of requests in flight'
+    )
+    parser.add_argument(
+        '--batch-size', '-b', type=int, default=1, help='Number of documents per request'
+    )
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument(
+        '--cache-dir', type=pathlib.Path, default=pathlib.Path('ASK') / 'udpipe-cache'
+    )
+    parser.add_argument('--cache-size', type=int, default=1024, help='Cache size limit in MB')
+    parser.add_argument('--no-cache', action='store_true')
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     data_dir = pathlib.Path('ASK')
     assert data_dir.is_dir()
 
@@ -17,18 +43,32 @@ def main():
     if not output_dir.is_dir():
         output_dir.mkdir()
 
-    for input_file in input_dir.iterdir():
+    input_files = []
+    for input_file in sorted(input_dir.iterdir()):
         if input_file.suffix != '.txt':
             print('Skipping ' + str(input_file))
             continue
+        input_files.append(input_file)
+    texts = [f.read_text(encoding='utf-8') for f in input_files]
 
-        output_file = (output_dir / input_file.stem).with_suffix('.conll')
-        print(str(output_file))
-        cmd = ['./rest-udpipe', str(input_file), str(output_file)]
-        try:
-            subprocess.run(cmd).check_returncode()
-        except subprocess.CalledProcessError as e:
-            print(str(e))
+    if args.no_cache:
+        cache = None
+    else:
+        cache = ConllCache(args.cache_dir, max_bytes=args.cache_size * 2 ** 20)
+    client = UDPipeClient(
+        args.url, args.model, max_workers=args.jobs, retries=args.retries, cache=cache
+    )
+    num_written = 0
+    with client:
+        for index, conllu in client.process_many(texts, batch_size=args.batch_size):
+            output_file = (output_dir / input_files[index].stem).with_suffix('.conll')
+            print(str(output_file))
+            output_file.write_text(conllu, encoding='utf-8')
+            num_written += 1
+    if num_written < len(input_files):
+        print('Failed to annotate %d documents' % (len(input_files) - num_written))
+    if cache is not None:
+        cache.evict()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+"""Word vectors from fastText model binaries, without Gensim.
+
+A fastText binary holds the dictionary of the model and its input
+matrix, which has a row for every word in the dictionary followed by
+`bucket` rows for hashed character n-grams. The vector of a word is the
+average of its own row, if it is in the dictionary, and the rows of its
+n-grams, which also gives vectors for words outside the dictionary.
+
+The binary is read sequentially, so it can be streamed from an archive
+member, and only the matrix rows that the requested words need are kept.
+"""
+from pathlib import Path
+import struct
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+
+FASTTEXT_MAGIC = 793712314
+BOW = '<'
+EOW = '>'
+EOS = '</s>'
+ROW_CHUNK_SIZE = 16384
+
+
+class StreamReader:
+    """Buffered reading of sized and delimited fields from a binary stream."""
+
+    def __init__(self, f: BinaryIO, buffer_size: int = 1 << 20) -> None:
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = b''
+        self.pos = 0
+
+    def _fill(self, size: int) -> None:
+        if len(self.buffer) - self.pos >= size:
+            return
+        chunks = [self.buffer[self.pos:]]
+        available = len(chunks[0])
+        while available < size:
+            chunk = self.f.read(max(self.buffer_size, size - available))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        self.buffer = b''.join(chunks)
+        self.pos = 0
+
+    def read(self, size: int) -> bytes:
+        self._fill(size)
+        data = self.buffer[self.pos:self.pos + size]
+        if len(data) < size:
+            raise EOFError('Expected %d bytes, got %d' % (size, len(data)))
+        self.pos += size
+        return data
+
+    def peek(self, size: int) -> bytes:
+        self._fill(size)
+        return self.buffer[self.pos:self.pos + size]
+
+    def unpack(self, fmt: str) -> Tuple:
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def read_until(self, delimiter: bytes) -> bytes:
+        """Read up to a delimiter, which is consumed but not returned."""
+        end = self.buffer.find(delimiter, self.pos)
+        while end < 0:
+            searched = len(self.buffer) - self.pos
+            self._fill(searched + self.buffer_size)
+            if len(self.buffer) - self.pos == searched:
+                raise EOFError('Delimiter %r not found' % delimiter)
+            end = self.buffer.find(delimiter, self.pos + searched)
+        data = self.buffer[self.pos:end]
+        self.pos = end + len(delimiter)
+        return data
+
+
+def fasttext_hashes(data: np.ndarray, begins: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """The 32 bit FNV-1a hashes of fastText of many byte ranges at once.
+
+    fastText hashes the bytes of a string as signed chars, so bytes of
+    multibyte UTF-8 characters are sign extended before the XOR.
+
+    Args:
+        data: uint8 bytes that the ranges are in
+        begins: Start offsets of the ranges
+        ends: End offsets of the ranges
+    """
+    extended = data.view(np.int8).astype(np.int32).view(np.uint32)
+    hashes = np.full(len(begins), 2166136261, dtype=np.uint32)
+    lengths = ends - begins
+    for offset in range(lengths.max() if len(lengths) else 0):
+        active = np.flatnonzero(lengths > offset)
+        hashes[active] = (hashes[active] ^ extended[begins[active] + offset]) * np.uint32(16777619)
+    return hashes
+
+
+def ngram_hashes(words: List[str], minn: int, maxn: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash the character n-grams of a batch of words, like fastText's computeSubwords.
+
+    Returns:
+        The index of the word of every n-gram, and the hashes of the n-grams.
+        There are none if maxn is 0.
+    """
+    if maxn <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32)
+    marked = [BOW + word + EOW for word in words]
+    data = np.frombuffer(''.join(marked).encode('utf-8'), dtype=np.uint8)
+    # Byte offsets of the characters, which do not start with a continuation byte
+    char_starts = np.append(np.flatnonzero((data & 0xC0) != 0x80), len(data))
+    lengths = np.array([len(word) for word in marked], dtype=np.int64)
+    char_words = np.repeat(np.arange(len(words)), lengths)
+    positions = np.arange(len(char_words)) - (np.cumsum(lengths) - lengths)[char_words]
+    remaining = lengths[char_words] - positions
+    has_ngrams = np.array([word != EOS for word in words], dtype=bool)[char_words]
+    word_idx = []
+    begins = []
+    ends = []
+    for n in range(max(minn, 1), maxn + 1):
+        keep = has_ngrams & (remaining >= n)
+        if n == 1:
+            # The boundary markers are not n-grams of their own
+            keep &= (positions > 0) & (remaining > 1)
+        chars = np.flatnonzero(keep)
+        word_idx.append(char_words[chars])
+        begins.append(char_starts[chars])
+        ends.append(char_starts[chars + n])
+    if not word_idx:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32)
+    begins = np.concatenate(begins)
+    ends = np.concatenate(ends)
+    return np.concatenate(word_idx), fasttext_hashes(data, begins, ends)
+
+
+def average_rows(
+    matrix: np.ndarray,
+    word_idx: np.ndarray,
+    rows: np.ndarray,
+    num_words: int,
+) -> np.ndarray:
+    """Average rows of a matrix for every word with a single sparse product.
+
+    Rows are counted as often as they occur for a word, and words
+    without rows get zeros.
+    """
+    counts = np.bincount(word_idx, minlength=num_words)
+    weights = 1 / counts[word_idx]
+    averages = sp.csr_matrix((weights, (word_idx, rows)), shape=(num_words, len(matrix)))
+    return np.asarray(averages.dot(matrix), dtype=np.float32)
+
+
+class FastTextDictionary:
+    """The words and n-gram settings of a fastText model.
+
+    Args:
+        words: The words of the dictionary, in row order
+        minn: Smallest n-gram length, in characters
+        maxn: Largest n-gram length, 0 if the model has no n-grams
+        bucket: Number of n-gram rows
+        pruneidx: Map from n-gram hashes to rows of a pruned model
+    """
+
+    def __init__(
+        self,
+        words: List[str],
+        minn: int,
+        maxn: int,
+        bucket: int,
+        pruneidx: Optional[Dict[int, int]] = None,
+    ) -> None:
+        self.words = words
+        self.word_index = {word: idx for idx, word in enumerate(words)}
+        self.minn = minn
+        self.maxn = maxn
+        self.bucket = bucket
+        self.pruneidx = pruneidx
+        if pruneidx is not None:
+            self._pruned_hashes = np.array(sorted(pruneidx), dtype=np.int64)
+            self._pruned_rows = np.array([pruneidx[h] for h in self._pruned_hashes.tolist()],
+                                         dtype=np.int64)
+
+    @property
+    def nwords(self) -> int:
+        return len(self.words)
+
+    def _prune(self, word_idx: np.ndarray, ngrams: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Keep the n-grams of a pruned model, mapped to their rows."""
+        if not len(self._pruned_hashes):
+            return word_idx[:0], ngrams[:0]
+        pos = np.minimum(np.searchsorted(self._pruned_hashes, ngrams), len(self._pruned_hashes) - 1)
+        kept = self._pruned_hashes[pos] == ngrams
+        return word_idx[kept], self._pruned_rows[pos[kept]]
+
+    def rows(self, words: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows that are averaged into the vectors of a batch of words.
+
+        Returns:
+            The index of the word of every row, and the rows.
+        """
+        if self.maxn > 0 and self.bucket > 0:
+            word_idx, hashes = ngram_hashes(words, self.minn, self.maxn)
+            ngrams = (hashes % self.bucket).astype(np.int64)
+            if self.pruneidx is not None:
+                word_idx, ngrams = self._prune(word_idx, ngrams)
+        else:
+            word_idx = ngrams = np.empty(0, dtype=np.int64)
+        in_dictionary = np.array([self.word_index.get(word, -1) for word in words], dtype=np.int64)
+        known = np.flatnonzero(in_dictionary >= 0)
+        return (
+            np.concatenate([known, word_idx]),
+            np.concatenate([in_dictionary[known], self.nwords + ngrams]),
+        )
+
+
+def read_dictionary(reader: StreamReader) -> Tuple[FastTextDictionary, int, int]:
+    """Read a fastText binary up to the input matrix.
+
+    Returns:
+        The dictionary and the shape of the input matrix.
+    """
+    magic, version = reader.unpack('<ii')
+    if magic != FASTTEXT_MAGIC:
+        raise ValueError('Not a fastText binary')
+    (dim, __, __, __, __, __, __, model, bucket, minn, maxn, __) = reader.unpack('<12i')
+    reader.unpack('<d')
+    if version == 11 and model == 3:
+        # Supervised models of this version have no n-grams
+        maxn = 0
+    size, nwords, __, __, pruneidx_size = reader.unpack('<iiiqq')
+    words = []
+    for __ in range(size):
+        words.append(reader.read_until(b'\0').decode('utf-8', errors='replace'))
+        reader.read(9)
+    # Labels of supervised models come after the words and have no rows
+    del words[nwords:]
+    pruneidx = None
+    if pruneidx_size >= 0:
+        pairs = np.frombuffer(reader.read(8 * pruneidx_size), dtype='<i4').reshape(-1, 2)
+        pruneidx = dict(pairs.tolist())
+    (quant_input,) = reader.unpack('<?')
+    if quant_input:
+        raise ValueError('Quantized fastText models are not supported')
+    num_rows, num_cols = reader.unpack('<qq')
+    if num_cols != dim:
+        raise ValueError('Input matrix has %d columns, expected %d' % (num_cols, dim))
+    return FastTextDictionary(words, minn, maxn, bucket, pruneidx), num_rows, num_cols
+
+
+def read_rows(reader: StreamReader, num_rows: int, num_cols: int, rows: np.ndarray) -> np.ndarray:
+    """Read the given sorted, distinct rows of a float32 matrix, chunk by chunk."""
+    if len(rows) and rows[-1] >= num_rows:
+        raise ValueError('Row %d is outside a matrix of %d rows' % (rows[-1], num_rows))
+    out = np.empty((len(rows), num_cols), dtype=np.float32)
+    row_size = 4 * num_cols
+    for start in range(0, num_rows, ROW_CHUNK_SIZE):
+        end = min(start + ROW_CHUNK_SIZE, num_rows)
+        chunk = np.frombuffer(reader.read(row_size * (end - start)), dtype='<f4')
+        first, last = np.searchsorted(rows, [start, end])
+        if first < last:
+            out[first:last] = chunk.reshape(-1, num_cols)[rows[first:last] - start]
+    return out
+
+
+def vector_matrix(f: BinaryIO, words: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the vectors of some words from a fastText binary into a matrix.
+
+    Returns:
+        Whether each word has a vector, which is only false for words
+        outside the dictionary of models without n-grams, and the
+        vectors, with zeros for words without one.
+    """
+    reader = StreamReader(f)
+    dictionary, num_rows, num_cols = read_dictionary(reader)
+    word_idx, rows = dictionary.rows(words)
+    needed, compact_rows = np.unique(rows, return_inverse=True)
+    matrix = read_rows(reader, num_rows, num_cols, needed)
+    has_vector = np.bincount(word_idx, minlength=len(words)) > 0
+    return has_vector, average_rows(matrix, word_idx, compact_rows.ravel(), len(words))
+
+
+def word_vectors(f: BinaryIO, words: Iterable[str]) -> Tuple[List[str], np.ndarray]:
+    """Read the vectors of some words from a fastText binary.
+
+    Returns:
+        The words that have a vector, which are all words unless the
+        model has no n-grams, and their vectors.
+    """
+    words = list(words)
+    has_vector, vectors = vector_matrix(f, words)
+    found = np.flatnonzero(has_vector)
+    return [words[idx] for idx in found.tolist()], vectors[found]
+
+
+def is_fasttext_binary(path: Path) -> bool:
+    """Whether a file is a fastText model binary."""
+    if path.suffix != '.bin':
+        return False
+    with path.open('rb') as f:
+        return f.read(4) == struct.pack('<i', FASTTEXT_MAGIC)
@@ -1,17 +1,25 @@
-from itertools import chain
+import hashlib
+from itertools import chain, islice
+import multiprocessing
 from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Mapping, Optional
+import pickle
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 import numpy as np
+import pandas as pd
 from sklearn.feature_extraction.text import CountVectorizer
 import tqdm
 
+from masterthesis.data.corpus_store import open_corpus_store
+from masterthesis.features.vectorize import count_vectorize, default_jobs
 from masterthesis.utils import (
-    conll_reader,
+    atomic_write,
     get_split_len,
     get_stopwords,
     load_split,
+    MODEL_DIR,
     PROJECT_ROOT,
+    read_conll_columns,
 )
 
 try:
@@ -21,6 +29,11 @@ except ImportError:
 
 
 data_folder = PROJECT_ROOT / 'ASK'
+vocab_folder = MODEL_DIR / 'vocab'
+VOCAB_VERSION = 3
+VOCAB_KINDS = ('words', 'pos', 'mixed_pos')
+
+_corpus_digests = {}  # type: Dict[Tuple[Path, str], str]
 
 
 def iterate_tokens(split: str = 'train') -> Iterable[str]:
@@ -35,66 +48,104 @@ def iterate_pos_tags(split: str = 'train') -> Iterable[str]:
     return chain.from_iterable(iterate_pos_docs(split))
 
 
-def iterate_pos_docs(split: str = 'train') -> Iterable[Iterable[str]]:
-    def _inner_iter(stream):
-        for sent in sents:
-            for (pos,) in sent:
-                yield pos
+def _iterate_conll_docs(meta, cols: List[str]) -> Iterable[List[np.ndarray]]:
+    """Yield the requested CoNLL columns of each document as flat arrays.
 
-    meta = load_split(split)
-    filenames = filename_iter(meta, suffix='conll')
-    for filename in filenames:
-        sents = conll_reader(filename, cols=['UPOS'], tags=False)
-        yield _inner_iter(sents)
+    Documents are read from the corpus store if possible. The remaining
+    CoNLL files are read in one batch with read_conll_columns.
+    """
+    store = open_corpus_store(data_folder / 'store')
+    streams = [col.lower() for col in cols]
+    in_store = [store is not None and store.has(name, streams[0]) for name in meta.filename]
+    filenames = [
+        filename
+        for filename, stored in zip(filename_iter(meta, suffix='conll'), in_store)
+        if not stored
+    ]
+    if filenames:
+        conll = read_conll_columns(filenames, cols=cols, tags=False)
+    file_row = 0
+    for name, stored in zip(meta.filename, in_store):
+        if stored:
+            yield [store.strings[store.ids(name, stream)] for stream in streams]
+        else:
+            start, end = conll.doc_offsets[file_row:file_row + 2]
+            yield [conll.columns[col][start:end] for col in cols]
+            file_row += 1
+
+
+def _iterate_pos_docs(meta) -> Iterable[Iterable[str]]:
+    for (pos,) in _iterate_conll_docs(meta, ['UPOS']):
+        yield iter(pos.tolist())
 
 
-def iterate_docs(split: str = 'train') -> Iterable[Iterable[str]]:
+def iterate_pos_docs(split: str = 'train') -> Iterable[Iterable[str]]:
+    return _iterate_pos_docs(load_split(split))
+
+
+def _iterate_txt_docs(meta) -> Iterable[Iterable[str]]:
     def _inner_iter(stream):
         for line in stream:
             for token in line.split():
                 yield token
 
-    meta = load_split(split)
+    store = open_corpus_store(data_folder / 'store')
     for filename in meta.filename:
+        if store is not None and store.has(filename, 'txt'):
+            yield iter(store.tokens(filename, 'txt'))
+            continue
         path = (data_folder / 'txt' / filename).with_suffix('.txt')
         with path.open(encoding='utf-8') as stream:
             yield _inner_iter(stream)
 
 
+def iterate_docs(split: str = 'train') -> Iterable[Iterable[str]]:
+    return _iterate_txt_docs(load_split(split))
+
+
+def _sorted_stopwords() -> np.ndarray:
+    return np.array(sorted(get_stopwords()), dtype=str)
+
+
+def _sorted_stopwords_if_available() -> Optional[np.ndarray]:
+    try:
+        return _sorted_stopwords()
+    except FileNotFoundError:
+        return None
+
+
+def _mix_pos(form: np.ndarray, pos: np.ndarray, stopwords: np.ndarray) -> np.ndarray:
+    """Replace every token that is not a function word by its POS tag."""
+    is_function_word = np.isin(np.char.lower(form.astype(str)), stopwords)
+    return np.where(is_function_word, form, pos)
+
+
 def iterate_mixed_pos_docs(split: str = 'train'):
     """Mixed POS-Function Word n-grams.
 
     E.g. NOUN kan også VERB NOUN til å VERB dem
     """
-    sw = get_stopwords()
-
-    def _inner_iter(stream):
-        for sent in sents:
-            for (form, pos) in sent:
-                if form.lower() in sw:
-                    yield form
-                else:
-                    yield pos
-
+    sw = _sorted_stopwords()
     meta = load_split(split)
-    filenames = filename_iter(meta, suffix='conll')
-    for filename in filenames:
-        sents = conll_reader(filename, cols=['FORM', 'UPOS'], tags=False)
-        yield _inner_iter(sents)
+    for form, pos in _iterate_conll_docs(meta, ['FORM', 'UPOS']):
+        yield iter(_mix_pos(form, pos, sw).tolist())
 
 
-def bag_of_words(split, **kwargs):
+def bag_of_words(split, jobs: int = 1, **kwargs):
     """Fit a CountVectorizer on a split.
 
     Args:
         split: Name of the split {'train', 'test', 'dev}
+        jobs: Number of processes to read and count the documents in
         **kwargs: Are passed to CountVectorizer's constructor
 
     Returns:
         The transformed documents and the trained vectorizer.
     """
-    vectorizer = CountVectorizer(input='filename', **kwargs)
     meta = load_split(split)
+    if jobs > 1:
+        return count_vectorize(list(filename_iter(meta)), jobs, input='filename', **kwargs)
+    vectorizer = CountVectorizer(input='filename', **kwargs)
     x = vectorizer.fit_transform(filename_iter(meta))
     return x, vectorizer
 
@@ -111,27 +162,183 @@ def _make_any2i(tokens_by_rank: Iterable[str]) -> Dict[str, int]:
     return any2i
 
 
-def make_w2i(vocab_size: Optional[int]) -> Dict[str, int]:
-    print('Counting tokens ...')
-    tokens = Counter(tqdm.tqdm(iterate_tokens('train')))
+def _count_shard(filenames: Sequence[str]) -> Dict[str, Counter]:
+    """Count the words, POS tags and mixed POS tags in some documents."""
+    meta = pd.DataFrame({'filename': list(filenames)})
+    counts = {kind: Counter() for kind in VOCAB_KINDS}  # type: Dict[str, Counter]
+    for doc in _iterate_txt_docs(meta):
+        counts['words'].update(doc)
+    # Without stop words there is no mixed POS table, only the others
+    sw = _sorted_stopwords_if_available()
+    if sw is None:
+        del counts['mixed_pos']
+    for form, pos in _iterate_conll_docs(meta, ['FORM', 'UPOS']):
+        counts['pos'].update(pos.tolist())
+        if sw is not None:
+            counts['mixed_pos'].update(_mix_pos(form, pos, sw).tolist())
+    return counts
+
+
+def _file_digest(sha1, path: Path, store, name: str, streams: Sequence[str]) -> None:
+    if path.is_file():
+        sha1.update(path.read_bytes())
+    elif store is not None and store.has(name, streams[0]):
+        for stream in streams:
+            sha1.update('\n'.join(store.tokens(name, stream)).encode('utf-8'))
+    else:
+        sha1.update(b'\0missing')
+    sha1.update(b'\0')
+
+
+def _corpus_digest(split: str) -> str:
+    sha1 = hashlib.sha1()
+    sha1.update(('%d\0' % VOCAB_VERSION).encode('utf-8'))
+    sw = _sorted_stopwords_if_available()
+    if sw is not None:
+        sha1.update('\n'.join(sw.tolist()).encode('utf-8'))
+    sha1.update(b'\0')
+    store = open_corpus_store(data_folder / 'store')
+    store_digest = store.digest if store is not None else None
+    if store_digest is not None:
+        sha1.update(('store %s\0' % store_digest).encode('utf-8'))
+    for name in load_split(split).filename:
+        sha1.update(name.encode('utf-8') + b'\0')
+        # Documents are read from the store before the files
+        for folder, streams in (('txt', ['txt']), ('conll', ['form', 'upos'])):
+            if store_digest is not None and store.has(name, streams[0]):
+                continue
+            _file_digest(sha1, data_folder / folder / (name + '.' + folder), store, name, streams)
+    return sha1.hexdigest()
+
+
+def corpus_digest(split: str = 'train') -> str:
+    """Hash the contents of the documents in a split, and the stop words.
+
+    The documents in the corpus store are identified by the content
+    digest in its manifest, and the names of the documents in the split
+    from the metadata, so only documents outside the store are read.
+    The digest of a split is computed once per process.
+    """
+    key = (data_folder, split)
+    if key not in _corpus_digests:
+        _corpus_digests[key] = _corpus_digest(split)
+    return _corpus_digests[key]
+
+
+def count_vocabularies(split: str = 'train', jobs: Optional[int] = None) -> Dict[str, Counter]:
+    """Count words, POS tags and mixed POS tags in a split in one pass.
+
+    The documents are divided into contiguous shards that are counted in
+    parallel and merged in order, so ties in the counts are ranked the
+    same as when counting serially.
+    """
+    filenames = list(load_split(split).filename)
+    if jobs is None:
+        jobs = default_jobs()
+    jobs = max(1, min(jobs, len(filenames) // 50))
+    if jobs == 1:
+        return _count_shard(filenames)
+    shards = [list(shard) for shard in np.array_split(filenames, jobs)]
+    with multiprocessing.Pool(jobs) as pool:
+        shard_counts = pool.map(_count_shard, shards)
+    counts = shard_counts[0]
+    for shard in shard_counts[1:]:
+        for kind, counter in counts.items():
+            counter.update(shard[kind])
+    return counts
+
+
+def get_frequency_tables(
+    split: str = 'train', jobs: Optional[int] = None
+) -> Dict[str, List[Tuple[str, int]]]:
+    """Return the words, POS tags and mixed POS tags in a split by frequency.
+
+    The tables are saved in vocab_folder, keyed by corpus_digest, and
+    only counted if the documents have changed.
+
+    Returns:
+        A dict from each of VOCAB_KINDS to a list of (token, count)
+        pairs, most common first. There is no 'mixed_pos' table if
+        the stop word list is missing.
+    """
+    path = vocab_folder / (corpus_digest(split) + '.pkl')
+    if path.is_file():
+        with path.open('rb') as f:
+            return pickle.load(f)
+    print('Counting tokens, POS tags and mixed POS tags ...')
+    counts = count_vocabularies(split, jobs)
+    tables = {kind: counter.most_common() for kind, counter in counts.items()}
+    with atomic_write(path) as f:
+        pickle.dump(tables, f)
+    return tables
+
+
+def make_w2i(vocab_size: Optional[int], split: str = 'train') -> Dict[str, int]:
+    tokens = get_frequency_tables(split)['words']
     # If vocab_size is not None, make room for __PAD__ and __UNK__
-    vocab_size = vocab_size and vocab_size - 2
-    most_common = (token for (token, __) in tokens.most_common(vocab_size))
-    return _make_any2i(most_common)
+    vocab_size = vocab_size and max(vocab_size - 2, 0)
+    return _make_any2i(token for (token, __) in tokens[:vocab_size])
+
 
+def make_pos2i(split: str = 'train') -> Dict[str, int]:
+    tokens = get_frequency_tables(split)['pos']
+    return _make_any2i(token for (token, __) in tokens)
 
-def make_pos2i() -> Dict[str, int]:
-    print('Counting POS tags ...')
-    tokens = Counter(tqdm.tqdm(iterate_pos_tags('train')))
-    most_common = (token for (token, __) in tokens.most_common())
-    return _make_any2i(most_common)
 
+def make_mixed_pos2i(split: str = 'train') -> Dict[str, int]:
+    tables = get_frequency_tables(split)
+    if 'mixed_pos' not in tables:
+        get_stopwords()  # Raises the error for the missing stop word list
+    tokens = tables['mixed_pos']
+    return _make_any2i(token for (token, __) in tokens)
 
-def make_mixed_pos2i() -> Dict[str, int]:
-    print('Counting mixed POS tags ...')
-    tokens = Counter(tqdm.tqdm(iterate_mixed_pos_tags('train')))
-    most_common = (token for (token, __) in tokens.most_common())
-    return _make_any2i(most_common)
+
+def _id_dtype(mapping: Mapping[str, int]) -> type:
+    """Return the smallest signed integer type that holds all ids in mapping."""
+    highest_id = max(mapping.values(), default=0)
+    if highest_id <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+def encode_sequences(
+    docs: Iterable[Iterable[str]], mapping: Mapping[str, int], seq_len: int
+) -> np.ndarray:
+    """Encode documents as rows of token ids, truncated and padded to seq_len.
+
+    Tokens are mapped to ids in a single pass over the whole token stream:
+    the stream is factorized into unique tokens, only those are looked up
+    in the mapping, and the ids are scattered into the output matrix.
+
+    Args:
+        docs: Iterable of documents, each an iterable of tokens
+        mapping: Token to id mapping with entries for __PAD__ and __UNK__
+        seq_len: Length of the output rows
+
+    Returns:
+        An int16 or int32 array with one row per document.
+    """
+    tokens = []  # type: List[str]
+    lengths = []  # type: List[int]
+    for doc in docs:
+        doc_tokens = list(islice(doc, seq_len))
+        tokens.extend(doc_tokens)
+        lengths.append(len(doc_tokens))
+    dtype = _id_dtype(mapping)
+    x = np.full((len(lengths), seq_len), mapping['__PAD__'], dtype=dtype)
+    if not tokens:
+        return x
+
+    codes, uniques = pd.factorize(np.array(tokens, dtype=object))
+    unk = mapping['__UNK__']
+    table = np.array([mapping.get(token, unk) for token in uniques], dtype=dtype)
+
+    doc_lengths = np.array(lengths, dtype=np.int64)
+    rows = np.repeat(np.arange(len(doc_lengths)), doc_lengths)
+    doc_starts = np.cumsum(doc_lengths) - doc_lengths
+    cols = np.arange(len(codes)) - np.repeat(doc_starts, doc_lengths)
+    x[rows, cols] = table[codes]
+    return x
 
 
 def _x_to_sequences(
@@ -144,13 +351,8 @@ def _x_to_sequences(
     for split in splits:
         split_len = get_split_len(split)
         print("Preprocessing split '%s' ..." % split)
-        x = np.zeros((split_len, seq_len), int)
-        for row, doc in tqdm.tqdm(enumerate(doc_iterator(split)), total=split_len):
-            for col, token in zip(range(seq_len), doc):
-                if token not in mapping:
-                    token = '__UNK__'
-                x[row, col] = mapping[token]
-        out.append(x)
+        docs = tqdm.tqdm(doc_iterator(split), total=split_len)
+        out.append(encode_sequences(docs, mapping, seq_len))
     return out
 
 
@@ -175,15 +377,7 @@ def mixed_pos_to_sequences(
 def file_to_sequence(
     seq_len: int, filepath: Path, w2i: Mapping[str, int]
 ) -> np.ndarray:
-    x = np.zeros(seq_len, int)
     with filepath.open() as f:
-        idx = 0
-        for line in f:
-            for token in line.strip().split():
-                if token not in w2i:
-                    token = '__UNK__'
-                x[idx] = w2i[token]
-                idx += 1
-                if idx >= seq_len:
-                    return x
+        tokens = (token for line in f for token in line.strip().split())
+        (x,) = encode_sequences([tokens], w2i, seq_len)
     return x
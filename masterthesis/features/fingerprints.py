@@ -0,0 +1,142 @@
+"""Document fingerprints: weighted averages of the word vectors of their tokens.
+
+The fingerprints of a split are computed at once, as the product of its
+sparse document x token weight matrix and the embedding matrix of its
+tokens. The weight of a token in a document is its count times
+
+    uniform  1, the continuous bag of words of gensim_utils.fingerprint
+    tfidf    The smoothed idf of the token in the training split, like
+             in sklearn's TfidfTransformer
+    sif      a / (a + p(w)), with p(w) the relative frequency of the
+             token in the training split (smooth inverse frequency).
+             The first principal component of the fingerprints of the
+             training split is removed from all fingerprints.
+
+Tokens without a vector are left out of the average. Fingerprints are
+kept in MODEL_DIR/fingerprints/<vectors digest>-<weighting>-<train split>,
+as <split>-<digest>-<train digest>.npy, where the digests are the
+corpus_digest of the splits.
+"""
+from pathlib import Path
+from typing import Dict, Optional, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+
+from masterthesis.features.build_features import corpus_digest, iterate_docs
+from masterthesis.features.ngrams import count_token_ngrams
+from masterthesis.models.utils import file_digest, load_embedding_matrix
+from masterthesis.utils import atomic_write, MODEL_DIR
+
+fingerprint_folder = MODEL_DIR / 'fingerprints'
+WEIGHTINGS = ('uniform', 'tfidf', 'sif')
+SIF_ALPHA = 1e-3
+
+
+def token_counts(split: str) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """Count the tokens of the documents in a split."""
+    return count_token_ngrams(list(doc) for doc in iterate_docs(split))
+
+
+def weighted_average(x: sp.csr_matrix, weights: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """Average the vectors of the columns of x, weighted by x times weights.
+
+    Columns with a zero vector are left out, and rows without any other
+    columns get zeros.
+    """
+    weights = np.where(vectors.any(axis=1), weights, 0).astype(np.float32)
+    weighted = sp.csr_matrix(x, dtype=np.float32).dot(sp.diags(weights)).tocsr()
+    totals = np.asarray(weighted.sum(axis=1))
+    sums = weighted.dot(vectors)
+    return np.divide(sums, totals, out=np.zeros_like(sums), where=totals > 0)
+
+
+def remove_component(fingerprints: np.ndarray, component: np.ndarray) -> np.ndarray:
+    return fingerprints - np.outer(fingerprints.dot(component), component)
+
+
+class Fingerprints:
+    """Fingerprints of the documents of any split with some vectors and weighting.
+
+    Args:
+        vector_path: The vectors, in any format that init_pretrained_embs loads
+        weighting: One of WEIGHTINGS
+        train_split: The split that token weights are estimated on
+        folder: Parent folder of all fingerprints, defaults to fingerprint_folder
+    """
+
+    def __init__(
+        self,
+        vector_path: Path,
+        weighting: str = 'uniform',
+        train_split: str = 'train',
+        folder: Optional[Path] = None,
+    ) -> None:
+        if weighting not in WEIGHTINGS:
+            raise ValueError('Weighting "%s" is not supported' % weighting)
+        self.vector_path = vector_path
+        self.weighting = weighting
+        self.train_split = train_split
+        if folder is None:
+            folder = fingerprint_folder
+        self.folder = folder / (
+            '%s-%s-%s' % (file_digest(vector_path)[:16], weighting, train_split)
+        )
+        self._train_counts = None  # type: Optional[Tuple[sp.csr_matrix, Dict[str, int]]]
+        self._digests = {}  # type: Dict[str, str]
+
+    def _digest(self, split: str) -> str:
+        if split not in self._digests:
+            self._digests[split] = corpus_digest(split)[:16]
+        return self._digests[split]
+
+    def _path(self, split: str) -> Path:
+        return self.folder / (
+            '%s-%s-%s.npy' % (split, self._digest(split), self._digest(self.train_split))
+        )
+
+    def _train_statistics(self) -> Tuple[sp.csr_matrix, Dict[str, int]]:
+        if self._train_counts is None:
+            x, names = token_counts(self.train_split)
+            self._train_counts = x, {name: idx for idx, name in enumerate(names.tolist())}
+        return self._train_counts
+
+    def token_weights(self, names: np.ndarray) -> np.ndarray:
+        """Weights of tokens, apart from their counts."""
+        if self.weighting == 'uniform':
+            return np.ones(len(names))
+        train_x, train_index = self._train_statistics()
+        columns = np.array([train_index.get(name, -1) for name in names.tolist()], dtype=np.int64)
+        seen = columns >= 0
+        if self.weighting == 'tfidf':
+            dfs = np.bincount(train_x.indices, minlength=train_x.shape[1])
+            df = np.where(seen, dfs[columns], 0)
+            return np.log((1 + train_x.shape[0]) / (1 + df)) + 1
+        tfs = np.asarray(train_x.sum(axis=0)).ravel()
+        p = np.where(seen, tfs[columns], 0) / tfs.sum()
+        return SIF_ALPHA / (SIF_ALPHA + p)
+
+    def _average(self, split: str) -> np.ndarray:
+        x, names = token_counts(split)
+        vectors = load_embedding_matrix(
+            self.vector_path, {name: idx for idx, name in enumerate(names.tolist())}
+        )
+        return weighted_average(x, self.token_weights(names), vectors)
+
+    def _compute(self, split: str) -> np.ndarray:
+        fingerprints = self._average(split)
+        if self.weighting == 'sif':
+            train = fingerprints if split == self.train_split else self._average(self.train_split)
+            component = np.linalg.svd(train, full_matrices=False)[2][0]
+            fingerprints = remove_component(fingerprints, component)
+        return fingerprints
+
+    def fingerprints(self, split: str) -> np.ndarray:
+        """Return the fingerprints of the documents in a split, computing them if needed."""
+        path = self._path(split)
+        if path.is_file():
+            return np.load(str(path))
+        fingerprints = self._compute(split)
+        with atomic_write(path) as f:
+            np.save(f, fingerprints)
+        return fingerprints
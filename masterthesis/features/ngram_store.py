@@ -0,0 +1,317 @@
+"""Persistent n-gram counts that can be sliced for any max_features.
+
+Fitting a CountVectorizer tokenizes every document, even when runs only
+differ in max_features. NgramStore fits once without any limit and
+saves the document x n-gram count matrix over the full vocabulary of the
+training split, together with the term and document frequencies of all
+n-grams. Other splits are saved as counts over the same vocabulary.
+A max_features, min_df or max_df setting is then applied by selecting
+columns, which gives exactly the features CountVectorizer would have
+kept with those settings.
+
+The store is kept in MODEL_DIR/ngrams/<kind>-<params hash>-<train split>:
+
+    vocab-<digest>.npz    Feature names, term and document frequencies
+    <split>-<digest>.npz  Counts of a split over the full vocabulary
+
+where the digest is the corpus_digest of the split, so that changed
+documents are counted again. POS, mixed POS and character n-grams are
+counted on integer-encoded tags and characters, see
+masterthesis.features.ngrams.
+"""
+import hashlib
+from itertools import islice
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from masterthesis.features.build_features import (
+    corpus_digest,
+    filename_iter,
+    iterate_mixed_pos_docs,
+    iterate_pos_docs,
+)
+from masterthesis.features.ngrams import (
+    count_char_ngrams,
+    count_token_ngrams,
+    PackingError,
+    transform_char_ngrams,
+    transform_token_ngrams,
+)
+from masterthesis.features.vectorize import (  # noqa: F401
+    fit_counts,
+    make_vocabulary,
+    select_features,
+    transform_counts,
+    Vocabulary,
+)
+from masterthesis.utils import atomic_write, load_split, MODEL_DIR
+
+store_folder = MODEL_DIR / 'ngrams'
+HASHING_CHUNK_SIZE = 256
+FEATURE_KINDS = ('bow', 'char', 'pos', 'mix')
+TOKEN_PATTERN = r"[^\s]+"
+
+
+def iterate_token_docs(kind: str, split: str) -> Iterable[List[str]]:
+    """Iterate over the tags of the POS or mixed POS documents in a split."""
+    if kind == 'pos':
+        docs = iterate_pos_docs(split)
+    elif kind == 'mix':
+        docs = iterate_mixed_pos_docs(split)
+    else:
+        raise ValueError('Feature type "%s" has no tags' % kind)
+    return (list(doc) for doc in docs)
+
+
+def iterate_texts(split: str) -> Iterable[str]:
+    """Iterate over the texts in a split, decoded like CountVectorizer decodes files."""
+    for filename in filename_iter(load_split(split)):
+        with open(filename, 'rb') as f:
+            yield f.read().decode('utf-8')
+
+
+def iterate_documents(kind: str, split: str) -> Iterable[str]:
+    """Iterate over the documents in a split as input to CountVectorizer.
+
+    POS and mixed POS documents are strings of space separated tags,
+    bag of words and character documents are file names.
+    """
+    if kind in ('pos', 'mix'):
+        return (' '.join(doc) for doc in iterate_token_docs(kind, split))
+    elif kind in ('bow', 'char'):
+        return filename_iter(load_split(split))
+    raise ValueError('Feature type "%s" is not supported' % kind)
+
+
+def vectorizer_params(kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the input type of the kind's documents to CountVectorizer params."""
+    params = dict(params)
+    if kind in ('bow', 'char'):
+        params['input'] = 'filename'
+    return params
+
+
+def params_digest(kind: str, params: Dict[str, Any]) -> str:
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps([kind, params], sort_keys=True).encode('utf-8'))
+    return sha1.hexdigest()[:12]
+
+
+class NgramStore:
+    """Full vocabulary n-gram counts of a feature kind, fitted on a split.
+
+    Args:
+        kind: One of FEATURE_KINDS
+        params: CountVectorizer parameters, apart from input and the
+            feature selection parameters
+        train_split: The split to take the vocabulary from
+        folder: Parent folder of all stores, defaults to store_folder
+        jobs: Number of processes to count documents in
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        params: Dict[str, Any],
+        train_split: str = 'train',
+        folder: Optional[Path] = None,
+        jobs: int = 1,
+    ) -> None:
+        if kind not in FEATURE_KINDS:
+            raise ValueError('Feature type "%s" is not supported' % kind)
+        self.kind = kind
+        self.params = params
+        self.train_split = train_split
+        self.jobs = jobs
+        if folder is None:
+            folder = store_folder
+        self.folder = folder / ('%s-%s-%s' % (kind, params_digest(kind, params), train_split))
+        self._vocab = None  # type: Optional[Vocabulary]
+        self._digests = {}  # type: Dict[str, str]
+
+    def _digest(self, split: str) -> str:
+        if split not in self._digests:
+            self._digests[split] = corpus_digest(split)[:16]
+        return self._digests[split]
+
+    def _split_path(self, split: str) -> Path:
+        return self.folder / ('%s-%s.npz' % (split, self._digest(split)))
+
+    def _vocab_path(self) -> Path:
+        return self.folder / ('vocab-%s.npz' % self._digest(self.train_split))
+
+    def _engine(self) -> Optional[str]:
+        """Which of 'tokens' or 'chars' the n-grams can be counted on, if any."""
+        params = dict(self.params)
+        params.pop('ngram_range', None)
+        if self.kind in ('pos', 'mix') and params == {
+            'lowercase': False,
+            'token_pattern': TOKEN_PATTERN,
+        }:
+            return 'tokens'
+        params.pop('lowercase', None)
+        if self.kind == 'char' and params == {'analyzer': 'char'}:
+            return 'chars'
+        return None
+
+    def _ngram_range(self) -> Tuple[int, int]:
+        min_n, max_n = self.params.get('ngram_range', (1, 1))
+        return min_n, max_n
+
+    def _fit(self) -> Tuple[Vocabulary, sp.csr_matrix]:
+        engine = self._engine()
+        try:
+            if engine == 'tokens':
+                x, names = count_token_ngrams(
+                    iterate_token_docs(self.kind, self.train_split), self._ngram_range()
+                )
+                return make_vocabulary(names, x), x
+            if engine == 'chars':
+                x, names = count_char_ngrams(
+                    iterate_texts(self.train_split),
+                    self._ngram_range(),
+                    self.params.get('lowercase', True),
+                )
+                return make_vocabulary(names, x), x
+        except PackingError:
+            pass
+        docs = iterate_documents(self.kind, self.train_split)
+        x, vocab = fit_counts(docs, self.jobs, **vectorizer_params(self.kind, self.params))
+        return vocab, x
+
+    def _transform(self, split: str) -> sp.csr_matrix:
+        engine = self._engine()
+        vocabulary = self.vocabulary().names
+        try:
+            if engine == 'tokens':
+                return transform_token_ngrams(
+                    iterate_token_docs(self.kind, split), vocabulary, self._ngram_range()
+                )
+            if engine == 'chars':
+                return transform_char_ngrams(
+                    iterate_texts(split),
+                    vocabulary,
+                    self._ngram_range(),
+                    self.params.get('lowercase', True),
+                )
+        except PackingError:
+            pass
+        return transform_counts(
+            iterate_documents(self.kind, split),
+            vocabulary.tolist(),
+            self.jobs,
+            **vectorizer_params(self.kind, self.params)
+        )
+
+    def vocabulary(self) -> Vocabulary:
+        """Load the full vocabulary, fitting and saving it if needed."""
+        if self._vocab is not None:
+            return self._vocab
+        path = self._vocab_path()
+        if path.is_file():
+            with np.load(str(path)) as f:
+                self._vocab = Vocabulary(f['names'], f['tfs'], f['dfs'], int(f['num_docs']))
+            return self._vocab
+        print('Counting %s n-grams in %s ...' % (self.kind, self.train_split))
+        vocab, x = self._fit()
+        with atomic_write(self._split_path(self.train_split)) as f:
+            sp.save_npz(f, x)
+        with atomic_write(path) as f:
+            np.savez(f, names=vocab.names, tfs=vocab.tfs, dfs=vocab.dfs, num_docs=vocab.num_docs)
+        self._vocab = vocab
+        return vocab
+
+    def counts(self, split: str) -> sp.csr_matrix:
+        """Return the counts of the full vocabulary in the documents of a split."""
+        vocab = self.vocabulary()
+        path = self._split_path(split)
+        if path.is_file():
+            x = sp.load_npz(str(path)).tocsr()
+            if x.shape[1] == len(vocab.names):
+                return x
+        x = self._transform(split)
+        with atomic_write(path) as f:
+            sp.save_npz(f, x)
+        return x
+
+    def features(
+        self,
+        splits: List[str],
+        max_features: Optional[int] = None,
+        min_df: Any = 1,
+        max_df: Any = 1.0,
+    ) -> Tuple[List[sp.csr_matrix], np.ndarray]:
+        """Return the selected features of some splits.
+
+        Returns:
+            The count matrix of each split and the names of the
+            selected features, like the transformed documents and
+            vocabulary of a CountVectorizer fitted on train_split with
+            these settings.
+        """
+        vocab = self.vocabulary()
+        columns = select_features(vocab, max_features, min_df, max_df)
+        return [self.counts(split)[:, columns] for split in splits], vocab.names[columns]
+
+
+def ngram_features(
+    kind: str,
+    params: Dict[str, Any],
+    max_features: Optional[int] = None,
+    train_split: str = 'train',
+    eval_split: str = 'dev',
+    hash_features: Optional[int] = None,
+    jobs: int = 1,
+) -> Tuple[sp.csr_matrix, sp.csr_matrix, int]:
+    """Return train and evaluation features and the number of features.
+
+    If hash_features is given, the n-grams are hashed into that many
+    features instead of counted over a vocabulary, see hashed_features.
+    """
+    if hash_features is not None:
+        train_x, eval_x = hashed_features(kind, params, hash_features, [train_split, eval_split])
+        return train_x, eval_x, hash_features
+    store = NgramStore(kind, params, train_split, jobs=jobs)
+    (train_x, eval_x), names = store.features([train_split, eval_split], max_features)
+    return train_x, eval_x, len(names)
+
+
+def hashed_features(
+    kind: str,
+    params: Dict[str, Any],
+    n_features: int,
+    splits: List[str],
+    chunk_size: int = HASHING_CHUNK_SIZE,
+) -> List[sp.csr_matrix]:
+    """Return signed hashed n-gram counts of some splits.
+
+    Each n-gram is hashed to one of n_features columns, with a sign
+    that makes collisions cancel out on average instead of adding up.
+    There is no vocabulary to fit, so every split is transformed on its
+    own, chunk_size documents at a time.
+    """
+    vectorizer = HashingVectorizer(
+        n_features=n_features,
+        alternate_sign=True,
+        norm=None,
+        dtype=np.float32,
+        **vectorizer_params(kind, params)
+    )
+    matrices = []
+    for split in splits:
+        docs = iter(iterate_documents(kind, split))
+        chunks = []
+        chunk = list(islice(docs, chunk_size))
+        while chunk:
+            chunks.append(vectorizer.transform(chunk))
+            chunk = list(islice(docs, chunk_size))
+        if chunks:
+            matrices.append(sp.vstack(chunks, format='csr'))
+        else:
+            matrices.append(sp.csr_matrix((0, n_features), dtype=np.float32))
+    return matrices
@@ -0,0 +1,290 @@
+"""Vectorized n-gram counting on integer-encoded sequences.
+
+CountVectorizer builds every n-gram as a Python string. Here, the tokens
+or characters of all documents are encoded as integer ids in a single
+flat array, and the n-grams of each length are read from a strided view
+of that array and packed into one 64 bit key per n-gram. The keys are
+counted with np.unique, and only the distinct n-grams are ever turned
+into strings.
+
+The results are the same matrix and vocabulary as CountVectorizer gives
+before feature selection, with the columns sorted by n-gram:
+
+- count_token_ngrams is CountVectorizer with lowercase=False and
+  token_pattern=r"[^\\s]+", for POS tags and mixed POS documents
+- count_char_ngrams is CountVectorizer with analyzer='char'
+"""
+import re
+from typing import Iterable, List, Sequence, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+
+MAX_KEY = 2 ** 63 - 1
+# The white space normalization of CountVectorizer's char analyzer
+WHITE_SPACES = re.compile(r"\s\s+")
+
+
+class PackingError(ValueError):
+    """There are too many distinct tokens to pack the n-grams in 64 bits."""
+
+
+def _encode_tokens(docs: Iterable[Sequence[str]]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Encode all tokens of all documents as ids, numbered from 1 in sorted order.
+
+    The documents are split on whitespace again, the same way as
+    CountVectorizer's token pattern would split the joined tokens.
+
+    Returns:
+        The sorted distinct tokens, the ids of all tokens and the
+        offsets of the documents in them.
+    """
+    tokens = []  # type: List[str]
+    lengths = []  # type: List[int]
+    for doc in docs:
+        doc_tokens = ' '.join(doc).split()
+        tokens.extend(doc_tokens)
+        lengths.append(len(doc_tokens))
+    vocab = sorted(set(tokens))
+    index = {token: i for i, token in enumerate(vocab, start=1)}
+    ids = np.array(list(map(index.__getitem__, tokens)), dtype=np.int64)
+    doc_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=doc_offsets[1:])
+    return vocab, ids, doc_offsets
+
+
+def _encode_chars(
+    texts: Iterable[str], lowercase: bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Encode all characters of all documents as ids, numbered from 1 in code point order.
+
+    The documents are normalized the same way as by CountVectorizer's
+    char analyzer.
+
+    Returns:
+        The sorted distinct code points, the ids of all characters and
+        the offsets of the documents in them.
+    """
+    normalized = []  # type: List[str]
+    for text in texts:
+        if lowercase:
+            text = text.lower()
+        normalized.append(WHITE_SPACES.sub(' ', text))
+    doc_offsets = np.zeros(len(normalized) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in normalized], out=doc_offsets[1:])
+    code_points = np.frombuffer(
+        ''.join(normalized).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32
+    )
+    alphabet, ids = np.unique(code_points, return_inverse=True)
+    return alphabet, ids.ravel().astype(np.int64) + 1, doc_offsets
+
+
+def pack_ngrams(
+    ids: np.ndarray, doc_offsets: np.ndarray, ngram_range: Tuple[int, int], base: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Pack the n-grams within each document into integer keys.
+
+    The ids of an n-gram are the leading digits of its key in the given
+    base, followed by zeros for n-grams shorter than the longest. As no
+    id is 0, the keys of n-grams of different length never collide, and
+    the keys sort like the sequences of ids, with shorter n-grams before
+    the longer ones they start.
+
+    Args:
+        ids: Token ids of all documents, all in the range [1, base)
+        doc_offsets: Start of each document in ids, and the end of the last
+        ngram_range: The smallest and largest n
+        base: The ids are the digits of the keys in this base
+
+    Returns:
+        The document of every n-gram and its key.
+    """
+    min_n, max_n = ngram_range
+    if base ** max_n > MAX_KEY:
+        raise PackingError('Cannot pack %d-grams of %d distinct tokens' % (max_n, base - 1))
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    lengths = np.diff(doc_offsets)
+    doc_of_token = np.repeat(np.arange(len(lengths)), lengths)
+    doc_end = np.repeat(doc_offsets[1:], lengths)
+    docs = []
+    keys = []
+    for n in range(min_n, max_n + 1):
+        num_windows = len(ids) - n + 1
+        if num_windows <= 0:
+            continue
+        windows = np.lib.stride_tricks.as_strided(
+            ids, shape=(num_windows, n), strides=(ids.strides[0], ids.strides[0]), writeable=False
+        )
+        powers = base ** np.arange(max_n - 1, max_n - 1 - n, -1, dtype=np.int64)
+        # Only windows that end within the document they start in
+        valid = np.arange(num_windows) + n <= doc_end[:num_windows]
+        keys.append(windows.dot(powers)[valid])
+        docs.append(doc_of_token[:num_windows][valid])
+    if not keys:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(docs), np.concatenate(keys)
+
+
+def unpack_ngrams(keys: np.ndarray, base: int, max_n: int) -> np.ndarray:
+    """Turn n-gram keys back into token ids.
+
+    Returns:
+        A row of max_n ids per key, with the ids of shorter n-grams
+        followed by zeros.
+    """
+    ngrams = np.empty((len(keys), max_n), dtype=np.int64)
+    remaining = keys.copy()
+    for position in range(max_n - 1, -1, -1):
+        ngrams[:, position] = remaining % base
+        remaining //= base
+    return ngrams
+
+
+def ngram_names(ngrams: np.ndarray, vocab: List[str]) -> np.ndarray:
+    """Join the tokens of n-grams, given as rows of ids, with spaces."""
+    lookup = np.array([''] + vocab, dtype=object)
+    names = lookup[ngrams[:, 0]]
+    for position in range(1, ngrams.shape[1]):
+        ids = ngrams[:, position]
+        rows = ids > 0
+        names[rows] = names[rows] + ' ' + lookup[ids[rows]]
+    return names.astype(str)
+
+
+def char_names(ngrams: np.ndarray, alphabet: np.ndarray) -> np.ndarray:
+    """Turn character n-grams, given as rows of ids, into strings.
+
+    The code points are viewed as a NumPy string array, in which the
+    zero padding of shorter n-grams ends the strings. As in any NumPy
+    string array, NUL characters at the end of an n-gram are lost.
+    """
+    code_points = np.concatenate([[0], alphabet]).astype(np.uint32)[ngrams]
+    width = ngrams.shape[1]
+    return np.ascontiguousarray(code_points).view('<U%d' % width).reshape(len(ngrams))
+
+
+def _count_ids(
+    ids: np.ndarray, doc_offsets: np.ndarray, ngram_range: Tuple[int, int], base: int
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """Count the n-grams of the documents.
+
+    Returns:
+        The document-term matrix and the n-grams of its columns as rows
+        of ids, see unpack_ngrams. The columns are in key order, which
+        is string order if the ids are.
+    """
+    num_docs = len(doc_offsets) - 1
+    doc_idx, keys = pack_ngrams(ids, doc_offsets, ngram_range, base)
+    key_space = base ** ngram_range[1]
+    if num_docs * key_space <= MAX_KEY:
+        # Counting (document, key) codes gives them in CSR order
+        codes, counts = np.unique(doc_idx * key_space + keys, return_counts=True)
+        rows, keys = np.divmod(codes, key_space)
+        unique_keys = np.unique(keys)
+        columns = np.searchsorted(unique_keys, keys)
+    else:
+        unique_keys, columns = np.unique(keys, return_inverse=True)
+        codes, counts = np.unique(
+            doc_idx * len(unique_keys) + columns.ravel(), return_counts=True
+        )
+        rows, columns = np.divmod(codes, max(len(unique_keys), 1))
+    indptr = np.searchsorted(rows, np.arange(num_docs + 1))
+    x = sp.csr_matrix(
+        (counts.astype(np.int64), columns, indptr), shape=(num_docs, len(unique_keys))
+    )
+    return x, unpack_ngrams(unique_keys, base, ngram_range[1])
+
+
+def _count_tokens(
+    docs: Iterable[Sequence[str]], ngram_range: Tuple[int, int]
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    vocab, ids, doc_offsets = _encode_tokens(docs)
+    x, ngrams = _count_ids(ids, doc_offsets, ngram_range, len(vocab) + 1)
+    names = ngram_names(ngrams, vocab)
+    if any(min(token) <= ' ' for token in vocab):
+        # The space that joins the tokens does not sort before all of
+        # their characters, so the names do not sort like the ids
+        order = np.argsort(names, kind='stable')
+        x = x[:, order]
+        x.sort_indices()
+        names = names[order]
+    return x, names
+
+
+def _count_chars(
+    texts: Iterable[str], ngram_range: Tuple[int, int], lowercase: bool
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    alphabet, ids, doc_offsets = _encode_chars(texts, lowercase)
+    x, ngrams = _count_ids(ids, doc_offsets, ngram_range, len(alphabet) + 1)
+    return x, char_names(ngrams, alphabet)
+
+
+def _check_vocabulary(names: np.ndarray) -> None:
+    if not len(names):
+        raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+
+
+def count_token_ngrams(
+    docs: Iterable[Sequence[str]], ngram_range: Tuple[int, int] = (1, 1)
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """Count the token n-grams in the documents.
+
+    Returns:
+        The document-term matrix and the n-grams of its columns, in
+        sorted order.
+    """
+    x, names = _count_tokens(docs, ngram_range)
+    _check_vocabulary(names)
+    return x, names
+
+
+def align_columns(x: sp.csr_matrix, names: np.ndarray, vocabulary: np.ndarray) -> sp.csr_matrix:
+    """Move the columns of x to those of the same names in a sorted vocabulary.
+
+    Columns that are not in the vocabulary are dropped.
+    """
+    positions = np.searchsorted(vocabulary, names)
+    in_range = positions < len(vocabulary)
+    known = np.zeros(len(names), dtype=bool)
+    known[in_range] = vocabulary[positions[in_range]] == names[in_range]
+    x = x.tocoo()
+    keep = known[x.col]
+    aligned = sp.csr_matrix(
+        (x.data[keep], (x.row[keep], positions[x.col[keep]])),
+        shape=(x.shape[0], len(vocabulary)),
+        dtype=x.dtype,
+    )
+    return aligned
+
+
+def transform_token_ngrams(
+    docs: Iterable[Sequence[str]], vocabulary: np.ndarray, ngram_range: Tuple[int, int] = (1, 1)
+) -> sp.csr_matrix:
+    """Count the n-grams of a sorted vocabulary in the documents."""
+    x, names = _count_tokens(docs, ngram_range)
+    return align_columns(x, names, vocabulary)
+
+
+def count_char_ngrams(
+    texts: Iterable[str], ngram_range: Tuple[int, int] = (1, 1), lowercase: bool = True
+) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """Count the character n-grams in the documents.
+
+    Returns:
+        The document-term matrix and the n-grams of its columns, in
+        sorted order.
+    """
+    x, names = _count_chars(texts, ngram_range, lowercase)
+    _check_vocabulary(names)
+    return x, names
+
+
+def transform_char_ngrams(
+    texts: Iterable[str],
+    vocabulary: np.ndarray,
+    ngram_range: Tuple[int, int] = (1, 1),
+    lowercase: bool = True,
+) -> sp.csr_matrix:
+    """Count the character n-grams of a sorted vocabulary in the documents."""
+    x, names = _count_chars(texts, ngram_range, lowercase)
+    return align_columns(x, names, vocabulary)
@@ -0,0 +1,172 @@
+"""Sharded CountVectorizer fitting and transforming.
+
+The documents are divided into contiguous shards that are counted in
+worker processes. The shard vocabularies are merged in sorted order and
+the shard matrices are stacked in document order, after which the
+feature selection of CountVectorizer is applied to the merged counts.
+The result is identical to fitting a single CountVectorizer.
+"""
+from functools import partial
+import multiprocessing
+from numbers import Integral
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+Vocabulary = NamedTuple(
+    'Vocabulary',
+    [('names', np.ndarray), ('tfs', np.ndarray), ('dfs', np.ndarray), ('num_docs', int)],
+)
+
+
+def document_frequencies(x: sp.csr_matrix) -> np.ndarray:
+    return np.bincount(x.indices, minlength=x.shape[1])
+
+
+def make_vocabulary(names: np.ndarray, x: sp.csr_matrix) -> Vocabulary:
+    """Collect the term and document frequencies of the columns of x."""
+    tfs = np.asarray(x.sum(axis=0)).ravel()
+    return Vocabulary(names, tfs, document_frequencies(x), x.shape[0])
+
+
+def select_features(
+    vocab: Vocabulary,
+    max_features: Optional[int] = None,
+    min_df: Any = 1,
+    max_df: Any = 1.0,
+) -> np.ndarray:
+    """Return the columns CountVectorizer keeps with these settings.
+
+    min_df and max_df are document counts if they are integers and
+    proportions of the documents if they are floats, like in
+    CountVectorizer. Of the features within those bounds, the
+    max_features with the highest term frequency are kept, breaking
+    ties the same way as CountVectorizer.
+    """
+    max_doc_count = max_df if isinstance(max_df, Integral) else max_df * vocab.num_docs
+    min_doc_count = min_df if isinstance(min_df, Integral) else min_df * vocab.num_docs
+    if max_doc_count < min_doc_count:
+        raise ValueError('max_df corresponds to < documents than min_df')
+    mask = (vocab.dfs <= max_doc_count) & (vocab.dfs >= min_doc_count)
+    if max_features is not None and mask.sum() > max_features:
+        mask_inds = (-vocab.tfs[mask]).argsort()[:max_features]
+        new_mask = np.zeros(len(vocab.dfs), dtype=bool)
+        new_mask[np.where(mask)[0][mask_inds]] = True
+        mask = new_mask
+    kept_indices = np.where(mask)[0]
+    if len(kept_indices) == 0:
+        raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+    return kept_indices
+
+
+def default_jobs() -> int:
+    """Number of usable cores, or 1 inside a pool worker, which can not start its own pool."""
+    if multiprocessing.current_process().daemon:
+        return 1
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _shards(docs: Sequence[Any], jobs: int) -> List[Sequence[Any]]:
+    bounds = np.linspace(0, len(docs), jobs + 1).astype(int)
+    return [docs[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _fit_shard(params: Dict[str, Any], docs: Sequence[Any]) -> Tuple[np.ndarray, sp.csr_matrix]:
+    vectorizer = CountVectorizer(**params)
+    try:
+        x = vectorizer.fit_transform(docs).tocsr()
+    except ValueError as e:
+        # A shard may well consist of documents without any terms
+        if 'empty vocabulary' not in str(e):
+            raise
+        return np.array([], dtype=str), sp.csr_matrix((len(docs), 0), dtype=np.int64)
+    vocabulary = vectorizer.vocabulary_
+    return np.array(sorted(vocabulary, key=vocabulary.__getitem__), dtype=str), x
+
+
+def _transform_shard(
+    params: Dict[str, Any], vocabulary: List[str], docs: Sequence[Any]
+) -> sp.csr_matrix:
+    return CountVectorizer(vocabulary=vocabulary, **params).transform(docs).tocsr()
+
+
+def fit_counts(
+    docs: Sequence[Any], jobs: int = 1, **params
+) -> Tuple[sp.csr_matrix, Vocabulary]:
+    """Count all terms in the documents, like CountVectorizer without feature selection.
+
+    Args:
+        docs: Documents in the form given by the input parameter
+        jobs: Number of worker processes
+        **params: CountVectorizer parameters, except the feature
+            selection parameters max_features, min_df and max_df
+
+    Returns:
+        The document-term matrix and the vocabulary, with the terms
+        sorted like CountVectorizer sorts them.
+    """
+    docs = list(docs)
+    jobs = max(1, min(jobs, len(docs)))
+    if jobs == 1:
+        names, x = _fit_shard(params, docs)
+        if not len(names):
+            raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+        return x, make_vocabulary(names, x)
+    with multiprocessing.Pool(jobs) as pool:
+        shards = pool.map(partial(_fit_shard, params), _shards(docs, jobs))
+    names = np.array(sorted(set().union(*(shard_names for shard_names, __ in shards))), dtype=str)
+    if not len(names):
+        raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+    matrices = []
+    for shard_names, shard_x in shards:
+        # Both vocabularies are sorted, so the column order within rows is kept
+        columns = np.searchsorted(names, shard_names)
+        matrices.append(
+            sp.csr_matrix(
+                (shard_x.data, columns[shard_x.indices], shard_x.indptr),
+                shape=(shard_x.shape[0], len(names)),
+            )
+        )
+    x = sp.vstack(matrices, format='csr')
+    return x, make_vocabulary(names, x)
+
+
+def transform_counts(
+    docs: Sequence[Any], vocabulary: Sequence[str], jobs: int = 1, **params
+) -> sp.csr_matrix:
+    """Count the terms of a fixed vocabulary in the documents."""
+    docs = list(docs)
+    vocabulary = list(vocabulary)
+    jobs = max(1, min(jobs, len(docs)))
+    if jobs == 1:
+        return _transform_shard(params, vocabulary, docs)
+    with multiprocessing.Pool(jobs) as pool:
+        matrices = pool.map(partial(_transform_shard, params, vocabulary), _shards(docs, jobs))
+    return sp.vstack(matrices, format='csr')
+
+
+def count_vectorize(
+    docs: Sequence[Any],
+    jobs: int = 1,
+    max_features: Optional[int] = None,
+    min_df: Any = 1,
+    max_df: Any = 1.0,
+    **params
+) -> Tuple[sp.csr_matrix, CountVectorizer]:
+    """Fit a CountVectorizer on the documents, counting them in parallel.
+
+    Returns:
+        The transformed documents and a CountVectorizer with the
+        resulting vocabulary, which can transform other documents.
+    """
+    x, vocab = fit_counts(docs, jobs, **params)
+    columns = select_features(vocab, max_features, min_df, max_df)
+    vectorizer = CountVectorizer(vocabulary=vocab.names[columns].tolist(), **params)
+    vectorizer.fit([])
+    return x[:, columns], vectorizer
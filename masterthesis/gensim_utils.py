@@ -1,29 +1,43 @@
 """Utils using Gensim.
 
 A separate module because it can take a long time to import gensim, and
-we want to avoid that when not necessary.
+we want to avoid that when not necessary. Gensim is imported by the
+functions that need it, so that vectors in the native format of
+masterthesis.vectors can be loaded without it.
 """
 
 import logging
 from pathlib import Path
-from typing import Iterable, Union
+from typing import Iterable, TYPE_CHECKING, Union
 import zipfile
 
-from gensim.models import FastText
-from gensim.models.keyedvectors import FastTextKeyedVectors, KeyedVectors
 import numpy as np
 
+from masterthesis.vectors import is_native, load_vectors
+
+if TYPE_CHECKING:
+    from gensim.models.keyedvectors import FastTextKeyedVectors, KeyedVectors  # noqa: F401
+
 logger = logging.getLogger(__name__)
 
 
-def load_embeddings(file: Union[Path, str], fasttext: bool = False) -> KeyedVectors:
-    """Load embeddings from file and unit normalize vectors."""
+def load_embeddings(file: Union[Path, str], fasttext: bool = False) -> 'KeyedVectors':
+    """Load embeddings from file and unit normalize vectors.
+
+    Vectors in the native format are memory mapped and already unit
+    normalized.
+    """
     if fasttext:
         return load_fasttext_embeddings(file)
 
     if isinstance(file, str):
         file = Path(file)
 
+    if is_native(file):
+        return load_vectors(file)
+
+    from gensim.models.keyedvectors import KeyedVectors
+
     # Native Gensim format?
     emb_model = KeyedVectors.load(str(file))
     # Unit-normalizing the vectors (if they aren't already)
@@ -31,8 +45,10 @@ def load_embeddings(file: Union[Path, str], fasttext: bool = False) -> KeyedVect
     return emb_model.wv
 
 
-def load_fasttext_embeddings(file: Union[Path, str]) -> FastTextKeyedVectors:
+def load_fasttext_embeddings(file: Union[Path, str]) -> 'FastTextKeyedVectors':
     """Load embeddings from file and unit normalize vectors."""
+    from gensim.models import FastText
+
     if isinstance(file, str):
         file = Path(file)
     # Detect the model format by its extension:
@@ -53,7 +69,7 @@ def load_fasttext_embeddings(file: Union[Path, str]) -> FastTextKeyedVectors:
     return emb_model.wv
 
 
-def fingerprint(wv: KeyedVectors, document: Iterable[str]) -> np.ndarray:
+def fingerprint(wv: 'KeyedVectors', document: Iterable[str]) -> np.ndarray:
     """Calculate the ``semantic fingerprint'' of a document.
 
     This algorithm is also known as ``continuous bag of words'' (CBOW).
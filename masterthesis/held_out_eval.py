@@ -2,11 +2,13 @@ import argparse
 import logging
 from pathlib import Path
 import pickle
+from typing import List, Tuple
 
 from keras.models import load_model, Model
 import numpy as np
 
 from masterthesis.features.build_features import words_to_sequences, pos_to_sequences
+from masterthesis.models.quantize import is_quantized, load_quantized, original_stem
 from masterthesis.models.report import report
 from masterthesis.results import save_results
 from masterthesis.utils import (
@@ -22,22 +24,24 @@ logging.basicConfig()
 
 pos2i_path = MODEL_DIR / "pos2i.pkl"
 
-pos2i = pickle.load(pos2i_path.open("rb"))
-(x_pos,) = pos_to_sequences(700, ["test"], pos2i)
-
 
 def get_input_reps(w2i, multi_input: bool, split="test"):
     (x,) = words_to_sequences(700, [split], w2i)
     if multi_input:
+        pos2i = pickle.load(pos2i_path.open("rb"))
         (x_pos,) = pos_to_sequences(700, [split], pos2i)
         x = [x, x_pos]
     return x
 
 
 def load_model_and_w2i(model_path: Path):
-    model = load_model(str(model_path))
+    """Load a saved model, or a quantized one, and its word mapping."""
+    if is_quantized(model_path):
+        model = load_quantized(model_path)
+    else:
+        model = load_model(str(model_path))
 
-    w2i_path = model_path.parent / (model_path.stem + "_w2i.pkl")
+    w2i_path = model_path.parent / (original_stem(model_path) + "_w2i.pkl")
     w2i = pickle.load(w2i_path.open("rb"))
     return model, w2i
 
@@ -50,6 +54,27 @@ def get_predictions(model: Model, x, multi_output: bool) -> np.ndarray:
     return predictions
 
 
+def predict_levels(model: Model, w2i, split: str, highest_class: int) -> np.ndarray:
+    """Predict the levels of the documents of a split, rounded and clipped to the score range."""
+    multi_input = isinstance(model.input, list) and len(model.input) == 2
+    multi_output = isinstance(model.outputs, list) and len(model.outputs) > 1
+
+    x = get_input_reps(w2i, multi_input, split)
+    predictions = get_predictions(model, x, multi_output)
+    return rescale_regression_results(predictions, highest_class).ravel()
+
+
+def load_targets(split: str, collapsed: bool) -> Tuple[np.ndarray, int, List[str]]:
+    """Return the level indices of a split, the highest level and the level names."""
+    if collapsed:
+        labels = ROUND_CEFR_LABELS
+    else:
+        labels = CEFR_LABELS
+    meta = load_split(split, round_cefr=collapsed)
+    targets = np.array([labels.index(c) for c in meta["cefr"]], dtype=int)
+    return targets, len(labels) - 1, labels
+
+
 def find_model_paths(job_ids):
     model_globs = ["*%s*model.h5" % i for i in job_ids]
     return [f for g in model_globs for f in MODEL_DIR.glob(g)]
@@ -72,46 +97,18 @@ def parse_args() -> argparse.Namespace:
     return args
 
 
-["26805083", "26805084"]
-
-
 def main():
     args = parse_args()
     model_paths = find_model_paths(args.job_ids)
 
     print(model_paths)
 
-    if args.collapsed:
-        test_meta = load_split("test", round_cefr=True)
-        round_target_scores = np.array(
-            [ROUND_CEFR_LABELS.index(c) for c in test_meta["cefr"]], dtype=int
-        )
-        targets = round_target_scores
-        highest_class = 3
-        labels = ROUND_CEFR_LABELS
-    else:
-        test_meta = load_split("test", round_cefr=False)
-        target_scores = np.array(
-            [CEFR_LABELS.index(c) for c in test_meta["cefr"]], dtype=int
-        )
-        targets = target_scores
-        highest_class = 6
-        labels = CEFR_LABELS
+    targets, highest_class, labels = load_targets("test", args.collapsed)
 
     for model_path in model_paths:
         model, w2i = load_model_and_w2i(model_path)
-
-        multi_input = isinstance(model.input, list) and len(model.input) == 2
-        multi_output = isinstance(model.outputs, list) and len(model.outputs) > 1
-
-        x = get_input_reps(w2i, multi_input)
-        del w2i
-        predictions = get_predictions(model, x, multi_output)
-        del x
+        pred = predict_levels(model, w2i, "test", highest_class)
         del model
-
-        # Round to integers and clip to score range
-        pred = rescale_regression_results(predictions, highest_class).ravel()
         report(targets, pred, labels)
 
         name = model_path.stem + "_test_eval"
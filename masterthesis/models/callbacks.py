@@ -5,6 +5,7 @@ from keras.callbacks import Callback
 import numpy as np
 from sklearn.metrics import f1_score
 
+from masterthesis.models.generators import predict
 from masterthesis.models.utils import ranked_prediction
 from masterthesis.utils import rescale_regression_results
 
@@ -37,7 +38,7 @@ class F1Metrics(Callback):
             logs = {}
 
         self.multi = self.multi or len(self.model.outputs) > 1
-        val_predict = self.model.predict(self.dev_x)
+        val_predict = predict(self.model, self.dev_x)
         if self.multi:
             val_predict = val_predict[0]
         if val_predict.shape[1] == 1:
@@ -22,11 +22,14 @@ from keras.utils import to_categorical
 import numpy as np
 
 from masterthesis.models.callbacks import F1Metrics
+from masterthesis.models.cross_validation import cross_validate, fold_result, FoldResult
+from masterthesis.models.generators import fit, predict
 from masterthesis.models.layers import build_inputs_and_embeddings, InputLayerArgs
 from masterthesis.models.report import multi_task_report, report
 from masterthesis.models.utils import (
     add_common_args,
     add_seq_common_args,
+    bucket_sequences,
     get_sequence_input_reps,
     get_targets_and_output_units,
     init_pretrained_embs,
@@ -73,7 +76,7 @@ def positive_float(s: str) -> Optional[float]:
     raise ValueError("Invalid constraint value (must be positive, finite float)")
 
 
-def parse_args():
+def parse_args(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
     add_common_args(parser)
     add_seq_common_args(parser)
@@ -82,7 +85,7 @@ def parse_args():
     parser.set_defaults(
         batch_size=32, embed_dim=100, epochs=50, vocab_size=None, windows=[3, 4, 5]
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.verbose:
         logging.getLogger(None).setLevel(logging.DEBUG)
     return args
@@ -90,7 +93,7 @@ def parse_args():
 
 def build_model(
     vocab_size: int,
-    sequence_length: int,
+    sequence_length: Optional[int],
     output_units: Sequence[int],
     embed_dim: int,
     windows: Iterable[int],
@@ -99,7 +102,10 @@ def build_model(
     static_embs: bool = False,
     classification: bool = False,
 ) -> Model:
-    """Build CNN model."""
+    """Build CNN model.
+
+    The sequence length is None for batches of varying length.
+    """
     input_layer_args = InputLayerArgs(
         num_pos=num_pos,
         mask_zero=False,
@@ -174,13 +180,18 @@ def get_compile_args(method: str, lr: float):
     return optimizer, losses, metrics
 
 
-def main():
-    args = parse_args()
+def train(args: argparse.Namespace):
+    """Train on args.train_split and predict args.dev_split.
 
+    Returns:
+        The model with the weights of the best epoch, the training
+        history, the true and predicted label indices of the dev
+        documents, the labels and the vocabulary.
+    """
     set_reproducible(args.seed_delta)
 
-    train_meta = load_split("train", round_cefr=args.round_cefr)
-    dev_meta = load_split("dev", round_cefr=args.round_cefr)
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
 
     target_col = "lang" if args.nli else "cefr"
     labels = sorted(train_meta[target_col].unique())
@@ -221,7 +232,7 @@ def main():
 
     model = build_model(
         args.vocab_size,
-        args.doc_length,
+        None if args.bucket else args.doc_length,
         output_units,
         args.embed_dim,
         windows=args.windows,
@@ -242,16 +253,24 @@ def main():
     logger.debug("Train y\n%r", train_y[0][:5])
     logger.debug("Model config\n%r", model.get_config())
 
+    if args.bucket:
+        # Every batch must be at least as long as the widest window
+        train_x, dev_x = bucket_sequences(
+            args, train_x, train_y, dev_x, dev_y, min_length=max(args.windows)
+        )
+
     temp_handle, weights_path = tempfile.mkstemp(suffix=".h5")
     val_y = dev_target_scores
     callbacks = [F1Metrics(dev_x, val_y, weights_path, ranked=args.method == "ranked")]
-    history = model.fit(
+    history = fit(
+        model,
         train_x,
         train_y,
+        dev_x,
+        dev_y,
         epochs=args.epochs,
         batch_size=args.batch_size,
         callbacks=callbacks,
-        validation_data=(dev_x, dev_y),
         verbose=2,
     )
     model.load_weights(weights_path)
@@ -260,9 +279,9 @@ def main():
 
     true = dev_target_scores
     if multi_task:
-        predictions = model.predict(dev_x)[0]
+        predictions = predict(model, dev_x)[0]
     else:
-        predictions = model.predict(dev_x)
+        predictions = predict(model, dev_x)
     if args.method == "classification":
         pred = np.argmax(predictions, axis=1)
     elif args.method == "regression":
@@ -271,6 +290,26 @@ def main():
         pred = rescale_regression_results(predictions, highest_class).ravel()
     elif args.method == "ranked":
         pred = K.eval(ranked_prediction(predictions))
+    return model, history, true, pred, labels, w2i
+
+
+def run_fold(args: argparse.Namespace) -> FoldResult:
+    __, history, true, pred, labels, __ = train(args)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    return fold_result(dev_meta.filename, labels, true, pred, history.history)
+
+
+def run(args: argparse.Namespace, name_suffix: str = "") -> None:
+    """Train a configuration, report on it and save its results."""
+    multi_task = args.aux_loss_weight > 0
+    name = get_name(args.nli, multi_task)
+
+    if args.cv_folds:
+        target_col = "lang" if args.nli else "cefr"
+        cross_validate(run_fold, args, get_file_name(name + "-cv") + name_suffix, target_col)
+        return
+
+    model, history, true, pred, labels, w2i = train(args)
     try:
         if multi_task:
             multi_task_report(history.history, true, pred, labels)
@@ -279,14 +318,16 @@ def main():
     except Exception:
         pass
 
-    name = get_name(args.nli, multi_task)
-    name = get_file_name(name)
+    name = get_file_name(name) + name_suffix
 
     if args.save_model:
         save_model(name, model, w2i)
 
     save_results(name, args.__dict__, history.history, true, pred)
 
+
+def main():
+    run(parse_args())
     plt.show()
 
 
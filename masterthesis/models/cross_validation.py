@@ -0,0 +1,130 @@
+"""Cross-validation over the train and dev splits.
+
+The documents in train,dev are divided into folds, either stratified by
+CEFR score or grouped by topic, so that no topic is in both the train
+and dev part of a fold. Every fold is trained in a fresh worker process,
+as set_reproducible fixes the seeds and limits TensorFlow to a single
+thread for the whole process. The out-of-fold predictions for all
+documents are saved as a single Results object.
+"""
+import argparse
+from copy import copy
+from functools import partial
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence  # noqa: F401
+
+import numpy as np
+from sklearn.metrics import f1_score
+
+from masterthesis.models.report import report
+from masterthesis.results import save_results
+from masterthesis.utils import CV_STRATEGIES, fold_split_name, load_split
+
+FoldResult = NamedTuple(
+    'FoldResult',
+    [
+        ('filenames', List[str]),
+        ('true', List[str]),
+        ('pred', List[str]),
+        ('history', Optional[Dict[str, Any]]),
+    ],
+)
+
+# Keep the numerical libraries in the workers from using every core
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def add_cv_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--cv-folds', type=int, help='Cross-validate over train,dev with this many folds'
+    )
+    parser.add_argument('--cv-strategy', choices=CV_STRATEGIES, default='stratified')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1, help='Number of folds to train concurrently'
+    )
+    parser.set_defaults(train_split='train', dev_split='dev')
+
+
+def fold_result(
+    filenames: Sequence[str],
+    labels: Sequence[str],
+    true: Sequence[int],
+    pred: Sequence[int],
+    history: Optional[Dict[str, Any]] = None,
+) -> FoldResult:
+    """Collect the predictions for the dev part of a fold.
+
+    The labels are stored as strings, as the label indices of a fold
+    depend on which labels are in its train part.
+    """
+    return FoldResult(
+        list(filenames),
+        [labels[int(t)] for t in true],
+        [labels[int(p)] for p in pred],
+        history,
+    )
+
+
+def _run_fold(
+    run_fold: Callable[[argparse.Namespace], FoldResult], args: argparse.Namespace, fold: int
+) -> FoldResult:
+    fold_args = copy(args)
+    fold_args.train_split = fold_split_name(args.cv_strategy, args.cv_folds, fold, 'train')
+    fold_args.dev_split = fold_split_name(args.cv_strategy, args.cv_folds, fold, 'dev')
+    fold_args.cv_folds = None
+    # Pool workers can not start pools of their own
+    fold_args.jobs = 1
+    fold_args.feature_jobs = 1
+    print('Training fold %d of %d' % (fold + 1, args.cv_folds))
+    return run_fold(fold_args)
+
+
+def cross_validate(
+    run_fold: Callable[[argparse.Namespace], FoldResult],
+    args: argparse.Namespace,
+    name: str,
+    target_col: str = 'cefr',
+):
+    """Train and evaluate every fold and save the out-of-fold predictions.
+
+    Args:
+        run_fold: Module level function that trains on args.train_split
+            and returns the predictions for args.dev_split
+        args: Parsed command line arguments, including the cv args
+        name: Name of the results file
+        target_col: The metadata column to predict
+
+    Returns:
+        The true and predicted label indices of every document in
+        train,dev, in metadata order.
+    """
+    num_workers = max(1, min(args.jobs, args.cv_folds))
+    for var in THREAD_ENV_VARS:
+        os.environ.setdefault(var, '1')
+    # Spawned workers do not share TensorFlow state with this process
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(num_workers, maxtasksperchild=1) as pool:
+        fold_results = pool.map(
+            partial(_run_fold, run_fold, args), range(args.cv_folds), chunksize=1
+        )
+
+    meta = load_split('train,dev', round_cefr=args.round_cefr)
+    labels = sorted(meta[target_col].unique())
+    predicted = {}
+    for result in fold_results:
+        predicted.update(zip(result.filenames, zip(result.true, result.pred)))
+    true = np.array([labels.index(predicted[fn][0]) for fn in meta.filename], dtype=int)
+    pred = np.array([labels.index(predicted[fn][1]) for fn in meta.filename], dtype=int)
+
+    fold_f1 = [f1_score(r.true, r.pred, average='macro') for r in fold_results]
+    print('Macro F1 per fold: ' + ', '.join('%.3f' % f1 for f1 in fold_f1))
+    print('Mean macro F1: %.3f (std %.3f)' % (np.mean(fold_f1), np.std(fold_f1)))
+    report(true, pred, labels)
+
+    history = {
+        'folds': [r.history for r in fold_results],
+        'fold_macro_f1': fold_f1,
+    }
+    save_results(name, args.__dict__, history, true, pred)
+    return true, pred
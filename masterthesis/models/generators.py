@@ -0,0 +1,203 @@
+"""Batch generators for training and prediction.
+
+The sequence models get documents padded to --doc-length, so short
+documents pay for the full length in every recurrent step and
+convolution. BucketedSequence sorts the documents by length into
+batches of similar length and pads each batch only to its longest
+document. Models that mask the padding id 0 give the same predictions
+either way; the others see less padding.
+
+The MLP gets sparse n-gram counts, which SparseBatchSequence densifies
+one batch at a time, so that the dense inputs never take more memory
+than a batch.
+"""
+import abc
+from typing import Any, List, Optional, Union  # noqa: F401
+
+from keras.utils import Sequence
+import numpy as np
+import scipy.sparse as sp
+
+Inputs = Union[np.ndarray, List[np.ndarray]]
+
+
+def _as_list(arrays: Optional[Inputs]) -> List[np.ndarray]:
+    if arrays is None:
+        return []
+    if isinstance(arrays, list):
+        return arrays
+    return [arrays]
+
+
+def _unwrap(arrays: List[np.ndarray], was_list: bool) -> Inputs:
+    return arrays if was_list else arrays[0]
+
+
+class BatchSequence(Sequence, abc.ABC):
+    """Batches of documents, given as arrays of their indices.
+
+    Args:
+        x: Inputs, or a list of inputs for models with several
+        y: Targets, or a list of targets for multi-task models, or None
+            to only generate inputs
+        batch_size: Number of documents per batch
+        seed: Seed for the assignment of documents to batches
+    """
+
+    def __init__(
+        self,
+        x: Inputs,
+        y: Optional[Inputs] = None,
+        batch_size: int = 32,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.x = _as_list(x)
+        self.y = _as_list(y)
+        self._x_is_list = isinstance(x, list)
+        self._y_is_list = isinstance(y, list)
+        self.num_docs = self.x[0].shape[0]
+        self.batch_size = batch_size
+        self.rng = np.random.RandomState(seed)
+        self.batches = []  # type: List[np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def _split_batches(self, order: np.ndarray) -> None:
+        self.batches = [
+            order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)
+        ]
+
+    @abc.abstractmethod
+    def inputs(self, indices: np.ndarray) -> Inputs:
+        """Return the inputs of some documents."""
+
+    def __getitem__(self, idx: int) -> Any:
+        indices = self.batches[idx]
+        if not self.y:
+            return self.inputs(indices)
+        return self.inputs(indices), _unwrap([a[indices] for a in self.y], self._y_is_list)
+
+
+class BucketedSequence(BatchSequence):
+    """Batches of documents of similar length, padded to the longest in the batch.
+
+    Args:
+        x: Documents padded at the end with 0, or a list of such arrays
+            for models with several inputs, like words and POS tags
+        y: Targets, or a list of targets for multi-task models, or None
+            to only generate inputs
+        batch_size: Number of documents per batch
+        min_length: Pad all batches to at least this length, for
+            instance to the largest convolution window
+        seed: Seed for the order of documents of the same length
+
+    The documents of the same length are assigned to batches in a new
+    random order every epoch. The order of the batches is shuffled by
+    fit_generator.
+    """
+
+    def __init__(
+        self,
+        x: Inputs,
+        y: Optional[Inputs] = None,
+        batch_size: int = 32,
+        min_length: int = 1,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__(x, y, batch_size, seed)
+        self.min_length = max(min_length, 1)
+        self.lengths = np.max([np.count_nonzero(a, axis=1) for a in self.x], axis=0)
+        self.on_epoch_end()
+
+    def on_epoch_end(self) -> None:
+        self._split_batches(np.lexsort((self.rng.permutation(self.num_docs), self.lengths)))
+
+    def inputs(self, indices: np.ndarray) -> Inputs:
+        """Return the inputs of some documents, padded to the longest of them."""
+        length = max(int(self.lengths[indices].max()), self.min_length)
+        return _unwrap([a[indices, :length] for a in self.x], self._x_is_list)
+
+
+class SparseBatchSequence(BatchSequence):
+    """Batches of rows of sparse matrices, densified one batch at a time.
+
+    Args:
+        x: CSR matrix, or a list of them
+        y: Targets, or a list of targets for multi-task models, or None
+            to only generate inputs
+        batch_size: Number of documents per batch
+        seed: Seed for the assignment of documents to batches
+        dtype: Type of the dense batches
+
+    The documents are assigned to batches in a new random order every
+    epoch.
+    """
+
+    def __init__(
+        self,
+        x: Inputs,
+        y: Optional[Inputs] = None,
+        batch_size: int = 32,
+        seed: Optional[int] = None,
+        dtype: Any = np.float32,
+    ) -> None:
+        super().__init__([sp.csr_matrix(a) for a in _as_list(x)], y, batch_size, seed)
+        self._x_is_list = isinstance(x, list)
+        self.dtype = dtype
+        self.on_epoch_end()
+
+    def on_epoch_end(self) -> None:
+        self._split_batches(self.rng.permutation(self.num_docs))
+
+    def inputs(self, indices: np.ndarray) -> Inputs:
+        """Return the dense rows of some documents."""
+        return _unwrap(
+            [a[indices].toarray().astype(self.dtype, copy=False) for a in self.x], self._x_is_list
+        )
+
+
+def predict_in_order(model, sequence: BatchSequence) -> Inputs:
+    """Predict all documents of a sequence, in the order of its inputs."""
+    outputs = []  # type: List[np.ndarray]
+    is_list = False
+    for indices in sequence.batches:
+        batch_outputs = model.predict_on_batch(sequence.inputs(indices))
+        is_list = isinstance(batch_outputs, list)
+        batch_outputs = _as_list(batch_outputs)
+        if not outputs:
+            outputs = [
+                np.empty((sequence.num_docs,) + out.shape[1:], dtype=out.dtype)
+                for out in batch_outputs
+            ]
+        for output, batch_output in zip(outputs, batch_outputs):
+            output[indices] = batch_output
+    return _unwrap(outputs, is_list)
+
+
+def predict(model, x: Union[Inputs, BatchSequence]) -> Inputs:
+    """Predict plain inputs or all documents of a sequence, in input order."""
+    if isinstance(x, BatchSequence):
+        return predict_in_order(model, x)
+    return model.predict(x)
+
+
+def fit(
+    model,
+    train_x: Union[Inputs, BatchSequence],
+    train_y: Inputs,
+    dev_x: Union[Inputs, BatchSequence],
+    dev_y: Inputs,
+    **kwargs
+):
+    """Fit a model on plain inputs, or on sequences with their own targets.
+
+    Args:
+        **kwargs: Other arguments to fit, or to fit_generator, where
+            batch_size is left out as the sequences have their own
+    """
+    if isinstance(train_x, BatchSequence):
+        kwargs.pop('batch_size', None)
+        return model.fit_generator(train_x, validation_data=dev_x, **kwargs)
+    return model.fit(train_x, train_y, validation_data=(dev_x, dev_y), **kwargs)
@@ -0,0 +1,363 @@
+"""Nearest neighbour search over essay representations, and a kNN CEFR scorer.
+
+Essays are represented by document fingerprints (masterthesis.features.fingerprints)
+or by the representation layer outputs of a trained model. IVFIndex is
+an inverted file index for cosine similarity: the vectors are clustered
+with spherical k-means, and a query is only compared to the vectors of
+the num_probes clusters with the nearest centroids. The index of a
+model is saved next to it as <model stem>_knn.npz, and fingerprint
+indexes in MODEL_DIR/knn. Saved indexes are reused until --rebuild is
+given or the training split changes.
+
+Score the dev split, or find the nearest training essays of some essays
+or of a whole split:
+
+    python -m masterthesis.models.knn --model models/rnn-123_model.h5
+    python -m masterthesis.models.knn --model models/rnn-123_model.h5 --query s0001_a1
+    python -m masterthesis.models.knn --embeddings models/vectors/120.npy --query-split test
+"""
+import argparse
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple  # noqa: F401
+
+import numpy as np
+import scipy.sparse as sp
+
+from masterthesis.models.report import report
+from masterthesis.results import save_results
+from masterthesis.utils import (
+    atomic_write,
+    get_file_name,
+    load_split,
+    MODEL_DIR,
+    safe_plt as plt,
+)
+from masterthesis.vectors import unit_normalize
+
+knn_folder = MODEL_DIR / 'knn'
+KMEANS_ITERATIONS = 10
+# Queries are compared to vectors in chunks of this many rows
+CHUNK_SIZE = 4096
+
+KnnPrediction = NamedTuple(
+    'KnnPrediction',
+    [('labels', np.ndarray), ('neighbours', np.ndarray), ('distances', np.ndarray)],
+)
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid of each unit vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK_SIZE):
+        chunk = vectors[start:start + CHUNK_SIZE]
+        assignments[start:start + CHUNK_SIZE] = np.argmax(chunk.dot(centroids.T), axis=1)
+    return assignments
+
+
+def spherical_kmeans(
+    vectors: np.ndarray,
+    num_clusters: int,
+    iterations: int = KMEANS_ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """Cluster unit vectors by cosine similarity, returning unit length centroids.
+
+    A cluster that loses all its vectors keeps its previous centroid.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)]
+    for __ in range(iterations):
+        assignments = assign_clusters(vectors, centroids)
+        members = sp.csr_matrix(
+            (np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))),
+            shape=(num_clusters, len(vectors)),
+        )
+        sums = unit_normalize(members.dot(vectors))
+        nonempty = sums.any(axis=1)
+        centroids[nonempty] = sums[nonempty]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index of unit vectors for top-k cosine similarity search.
+
+    The vectors are stored ordered by cluster, so the vectors of a
+    cluster are a contiguous block, and ids map them back to the order
+    they were added in.
+
+    Args:
+        centroids: Unit length centroids of the clusters
+        vectors: Unit length vectors, ordered by cluster
+        ids: Original index of each vector
+        offsets: Start of the block of each cluster, and the end of the last
+        num_probes: Number of clusters to search for each query
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        num_probes: int = 8,
+    ) -> None:
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.num_probes = num_probes
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        num_lists: Optional[int] = None,
+        num_probes: int = 8,
+        seed: int = 0,
+    ) -> 'IVFIndex':
+        """Cluster vectors into num_lists clusters, by default about sqrt(len(vectors))."""
+        vectors = unit_normalize(vectors)
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(vectors)))
+        num_lists = max(1, min(num_lists, len(vectors)))
+        centroids = spherical_kmeans(vectors, num_lists, seed=seed)
+        assignments = assign_clusters(vectors, centroids)
+        ids = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[ids], np.arange(num_lists + 1))
+        return cls(centroids, vectors[ids], ids, offsets, num_probes)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _probes(self, queries: np.ndarray) -> np.ndarray:
+        """The clusters to search for each query."""
+        num_lists = len(self.centroids)
+        if self.num_probes >= num_lists:
+            return np.broadcast_to(np.arange(num_lists), (len(queries), num_lists))
+        sims = queries.dot(self.centroids.T)
+        return np.argpartition(-sims, self.num_probes - 1, axis=1)[:, :self.num_probes]
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k most similar vectors of a batch of queries.
+
+        Every probed cluster is compared to all the queries that probe
+        it at once, and merged into the running top k of the queries.
+
+        Returns:
+            The cosine distances and ids of the neighbours of each
+            query, nearest first. If fewer than k vectors are in the
+            probed clusters, the remaining ids are -1 with distance inf.
+        """
+        queries = unit_normalize(np.atleast_2d(queries))
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        probes = self._probes(queries)
+        for cluster in np.unique(probes):
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if start == end:
+                continue
+            rows = np.flatnonzero((probes == cluster).any(axis=1))
+            sims = np.hstack([best_sims[rows], queries[rows].dot(self.vectors[start:end].T)])
+            ids = np.hstack([best_ids[rows], np.tile(self.ids[start:end], (len(rows), 1))])
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            row_idx = np.arange(len(rows))[:, None]
+            best_sims[rows] = sims[row_idx, top]
+            best_ids[rows] = ids[row_idx, top]
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        row_idx = np.arange(len(queries))[:, None]
+        best_sims = best_sims[row_idx, order]
+        best_ids = best_ids[row_idx, order]
+        distances = np.where(best_ids >= 0, 1 - best_sims, np.inf)
+        return distances, best_ids
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {
+            'centroids': self.centroids,
+            'vectors': self.vectors,
+            'ids': self.ids,
+            'offsets': self.offsets,
+            'num_probes': np.array(self.num_probes),
+        }
+
+    @classmethod
+    def from_state(cls, state) -> 'IVFIndex':
+        return cls(
+            state['centroids'],
+            state['vectors'],
+            state['ids'],
+            state['offsets'],
+            int(state['num_probes']),
+        )
+
+
+class KnnScorer:
+    """Predict the CEFR level of essays by a vote of their nearest neighbours.
+
+    Each neighbour votes for its label, weighted by its cosine similarity.
+
+    Args:
+        index: Index of the representations of the training essays
+        labels: Label index of each training essay
+        names: File name of each training essay
+        k: Number of neighbours to vote
+        label_names: The label of each label index, if known
+    """
+
+    def __init__(
+        self,
+        index: IVFIndex,
+        labels: np.ndarray,
+        names: np.ndarray,
+        k: int = 10,
+        label_names: Optional[Sequence[str]] = None,
+    ) -> None:
+        self.index = index
+        self.labels = np.asarray(labels)
+        self.names = np.asarray(names, dtype=str)
+        self.k = k
+        self.label_names = list(label_names) if label_names is not None else None
+
+    def predict(self, queries: np.ndarray) -> KnnPrediction:
+        """Returns the predicted labels, and the names and distances of the neighbours."""
+        distances, ids = self.index.search(queries, self.k)
+        found = ids >= 0
+        votes = np.zeros((len(ids), self.labels.max() + 1))
+        rows = np.broadcast_to(np.arange(len(ids))[:, None], ids.shape)
+        # Similarity plus one, which is 2 - distance, so that no vote is negative
+        np.add.at(votes, (rows[found], self.labels[ids[found]]), 2 - distances[found])
+        neighbours = np.where(found, self.names[ids], '')
+        return KnnPrediction(np.argmax(votes, axis=1), neighbours, distances)
+
+    def save(self, path: Path) -> None:
+        arrays = dict(self.index.state(), labels=self.labels, names=self.names, k=self.k)
+        if self.label_names is not None:
+            arrays['label_names'] = np.array(self.label_names, dtype=str)
+        with atomic_write(path) as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> 'KnnScorer':
+        with np.load(str(path)) as f:
+            label_names = f['label_names'].tolist() if 'label_names' in f.files else None
+            return cls(
+                IVFIndex.from_state(f), f['labels'], f['names'], int(f['k']), label_names
+            )
+
+    def is_index_of(self, labels: np.ndarray, names: Sequence[str], label_names) -> bool:
+        """Whether this scorer indexes these training essays with these labels."""
+        return (
+            self.label_names == list(label_names)
+            and self.names.tolist() == list(names)
+            and np.array_equal(self.labels, labels)
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='kNN CEFR scorer over essay representations')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--embeddings', type=Path, help='Fingerprint essays with these vectors')
+    source.add_argument('--model', type=Path, help='Representations of a trained model')
+    parser.add_argument('--weighting', choices={'uniform', 'tfidf', 'sif'}, default='uniform')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--num-lists', type=int)
+    parser.add_argument('--num-probes', type=int, default=8)
+    parser.add_argument('--round-cefr', action='store_true')
+    parser.add_argument('--train-split', default='train')
+    parser.add_argument('--dev-split', default='dev')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild a saved index')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('--query', nargs='+', metavar='ESSAY', help='Find the neighbours of essays')
+    query.add_argument('--query-split', help='Find the neighbours of the essays in a split')
+    return parser.parse_args()
+
+
+def representations(args: argparse.Namespace, split: str) -> np.ndarray:
+    if args.embeddings:
+        from masterthesis.features.fingerprints import Fingerprints
+
+        return Fingerprints(args.embeddings, args.weighting, args.train_split).fingerprints(split)
+    from masterthesis.models.utils import get_model_representations
+
+    return get_model_representations(args.model, split)
+
+
+def index_path(args: argparse.Namespace) -> Path:
+    if args.model:
+        return args.model.parent / (args.model.stem + '_knn.npz')
+    return knn_folder / (
+        '%s-%s-%s.npz' % (args.embeddings.stem, args.weighting, args.train_split)
+    )
+
+
+def essay_representations(args: argparse.Namespace, names: Sequence[str]) -> np.ndarray:
+    """Representations of essays by name, from the splits they are in."""
+    wanted = set(names)
+    found = {}  # type: Dict[str, np.ndarray]
+    for split in ('train', 'dev', 'test'):
+        rows = [
+            (row, name)
+            for row, name in enumerate(load_split(split).filename)
+            if name in wanted and name not in found
+        ]
+        if rows:
+            split_representations = representations(args, split)
+            found.update((name, split_representations[row]) for row, name in rows)
+    missing = [name for name in names if name not in found]
+    if missing:
+        raise ValueError('Essays not found in any split: %s' % ', '.join(missing))
+    return np.array([found[name] for name in names])
+
+
+def load_or_build(args: argparse.Namespace, train_meta, labels: List[str]) -> KnnScorer:
+    """Load the saved scorer of the training split, or build and save it."""
+    train_y = np.array([labels.index(c) for c in train_meta.cefr])
+    path = index_path(args)
+    if path.is_file() and not args.rebuild:
+        scorer = KnnScorer.load(path)
+        if scorer.is_index_of(train_y, train_meta.filename, labels):
+            scorer.k = args.k
+            scorer.index.num_probes = args.num_probes
+            return scorer
+        print('%s is not an index of %s, rebuilding it' % (path, args.train_split))
+    index = IVFIndex.build(
+        representations(args, args.train_split), args.num_lists, args.num_probes
+    )
+    scorer = KnnScorer(index, train_y, train_meta.filename, args.k, labels)
+    scorer.save(path)
+    return scorer
+
+
+def print_neighbours(scorer: KnnScorer, names: Sequence[str], queries: np.ndarray) -> None:
+    prediction = scorer.predict(queries)
+    for name, label, neighbours, distances in zip(names, *prediction):
+        print('%s (%s):' % (name, scorer.label_names[label] if scorer.label_names else label))
+        for neighbour, distance in zip(neighbours, distances):
+            if neighbour:
+                print('    %s %.3f' % (neighbour, distance))
+
+
+def main():
+    args = parse_args()
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    labels = sorted(train_meta.cefr.unique())
+    scorer = load_or_build(args, train_meta, labels)
+    if args.query:
+        print_neighbours(scorer, args.query, essay_representations(args, args.query))
+        return
+    if args.query_split:
+        names = load_split(args.query_split).filename.tolist()
+        print_neighbours(scorer, names, representations(args, args.query_split))
+        return
+
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    dev_y = [labels.index(c) for c in dev_meta.cefr]
+    prediction = scorer.predict(representations(args, args.dev_split))
+    for name, neighbours in zip(dev_meta.filename[:5], prediction.neighbours):
+        print('%s: %s' % (name, ', '.join(neighbours[:3])))
+    report(dev_y, prediction.labels, labels)
+    save_results(get_file_name('knn'), args.__dict__, None, dev_y, prediction.labels)
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
 from keras import backend as K
 from keras.layers import Concatenate, Embedding, Input
@@ -71,9 +71,8 @@ class GlobalAveragePooling1D(_GlobalPooling1D):
     def call(self, inputs, mask=None):
         if mask is not None:
             mask = K.cast(mask, K.floatx())
-            input_shape = K.int_shape(inputs)
-            broadcast_shape = [-1, input_shape[1], 1]
-            mask = K.reshape(mask, broadcast_shape)
+            # The number of steps is unknown with bucketed batches
+            mask = K.expand_dims(mask, axis=-1)
             inputs *= mask
             return K.sum(inputs, axis=1) / K.sum(mask, axis=1)
         else:
@@ -87,7 +86,7 @@ InputLayerArgs = NamedTuple(
     "InputLayerArgs",
     [
         ("vocab_size", int),
-        ("sequence_len", int),
+        ("sequence_len", Optional[int]),
         ("embed_dim", int),
         ("pos_embed_dim", int),
         ("mask_zero", bool),
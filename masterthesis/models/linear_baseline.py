@@ -1,32 +1,28 @@
 import argparse
-from typing import Iterable, Optional
+from typing import Optional
 
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.linear_model import LogisticRegression
 from sklearn.svm import LinearSVC, LinearSVR
 
-from masterthesis.features.build_features import (
-    bag_of_words,
-    filename_iter,
-    iterate_mixed_pos_docs,
-    iterate_pos_docs,
+from masterthesis.features.ngram_store import ngram_features
+from masterthesis.models.cross_validation import (
+    add_cv_args,
+    cross_validate,
+    fold_result,
+    FoldResult,
 )
 from masterthesis.models.report import report
 from masterthesis.results import save_results
-from masterthesis.utils import DATA_DIR, get_file_name, load_split
+from masterthesis.utils import get_file_name, load_split
 
-conll_folder = DATA_DIR / "conll"
-
-
-def pos_line_iter(split) -> Iterable[str]:
-    for doc in iterate_pos_docs(split):
-        yield " ".join(doc)
-
-
-def mixed_pos_line_iter(split) -> Iterable[str]:
-    for doc in iterate_mixed_pos_docs(split):
-        yield " ".join(doc)
+# CountVectorizer parameters of each feature type
+FEATURE_PARAMS = {
+    "pos": dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(2, 4)),
+    "mix": dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(1, 3)),
+    "char": dict(analyzer="char", ngram_range=(1, 3)),
+    "bow": dict(token_pattern=r"[^\s]+", lowercase=False),
+}
 
 
 def parse_args():
@@ -38,7 +34,21 @@ def parse_args():
     parser.add_argument("--round-cefr", action="store_true")
     parser.add_argument("--nli", action="store_true")
     parser.add_argument("--eval-on-test", action="store_true")
-    return parser.parse_args()
+    parser.add_argument(
+        "--hashing", action="store_true", help="Hash n-grams instead of counting them"
+    )
+    parser.add_argument("--hash-features", type=int, default=2 ** 20)
+    parser.add_argument(
+        "--feature-jobs", type=int, default=1, help="Number of processes to count n-grams in"
+    )
+    add_cv_args(parser)
+    args = parser.parse_args()
+    if args.eval_on_test and args.cv_folds:
+        parser.error("--eval-on-test can not be combined with cross-validation")
+    if args.eval_on_test:
+        args.train_split = "train,dev"
+        args.dev_split = "test"
+    return args
 
 
 def preprocess(
@@ -46,66 +56,45 @@ def preprocess(
     max_features: Optional[int],
     train_meta,
     test_meta,
-    eval_on_test: bool = False,
+    train_split: str = "train",
+    test_split: str = "dev",
+    hash_features: Optional[int] = None,
+    jobs: int = 1,
 ):
-    if eval_on_test:
-        train_split = "train,dev"
-        test_split = "test"
-    else:
-        train_split = "train"
-        test_split = "dev"
-    if kind == "pos":
-        vectorizer = CountVectorizer(
-            lowercase=False,
-            token_pattern=r"[^\s]+",
-            ngram_range=(2, 4),
-            max_features=max_features,
-        )
-        train_x = vectorizer.fit_transform(pos_line_iter(train_split))
-        test_x = vectorizer.transform(pos_line_iter(test_split))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == "mix":
-        vectorizer = CountVectorizer(
-            lowercase=False,
-            token_pattern=r"[^\s]+",
-            ngram_range=(1, 3),
-            max_features=max_features,
-        )
-        train_x = vectorizer.fit_transform(mixed_pos_line_iter(train_split))
-        test_x = vectorizer.transform(mixed_pos_line_iter(test_split))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == "char":
-        train_x, vectorizer = bag_of_words(
-            train_split, analyzer="char", ngram_range=(1, 3), max_features=max_features
-        )
-        test_x = vectorizer.transform(filename_iter(test_meta))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == "bow":
-        train_x, vectorizer = bag_of_words(
-            train_split,
-            max_features=max_features,
-            token_pattern=r"[^\s]+",
-            lowercase=False,
-        )
-        test_x = vectorizer.transform(filename_iter(test_meta))
-        num_features = len(vectorizer.vocabulary_)
-    else:
+    if kind not in FEATURE_PARAMS:
         raise ValueError('Feature type "%s" is not supported' % kind)
-    print("Number of features is %d" % len(vectorizer.vocabulary_))
+    train_x, test_x, num_features = ngram_features(
+        kind,
+        FEATURE_PARAMS[kind],
+        max_features,
+        train_split=train_split,
+        eval_split=test_split,
+        hash_features=hash_features,
+        jobs=jobs,
+    )
+    print("Number of features is %d" % num_features)
     return train_x, test_x, num_features
 
 
-def main():
-    args = parse_args()
-    if args.eval_on_test:
-        train_meta = load_split("train,dev", round_cefr=args.round_cefr)
-        test_meta = load_split("test", round_cefr=args.round_cefr)
-    else:
-        train_meta = load_split("train", round_cefr=args.round_cefr)
-        test_meta = load_split("dev", round_cefr=args.round_cefr)
+def train(args: argparse.Namespace):
+    """Fit a classifier on args.train_split and predict args.dev_split.
+
+    Returns:
+        The fitted classifier, the true and predicted label indices of
+        the evaluation documents and the labels.
+    """
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    test_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
 
     train_x, test_x, num_features = preprocess(
-        args.kind, None, train_meta, test_meta, eval_on_test=args.eval_on_test
+        args.kind,
+        None,
+        train_meta,
+        test_meta,
+        train_split=args.train_split,
+        test_split=args.dev_split,
+        hash_features=args.hash_features if args.hashing else None,
+        jobs=args.feature_jobs,
     )
     print(train_x.shape)
     print(test_x.shape)
@@ -130,13 +119,29 @@ def main():
     predictions = clf.predict(test_x)
     if args.algorithm == "svr":
         predictions = np.clip(np.floor(predictions + 0.5), 0, max(train_y))
+    return clf, test_y, predictions, labels
+
+
+def run_fold(args: argparse.Namespace) -> FoldResult:
+    __, test_y, predictions, labels = train(args)
+    test_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    return fold_result(test_meta.filename, labels, test_y, predictions)
 
-    report(test_y, predictions, labels)
 
+def main():
+    args = parse_args()
     if args.nli:
         name = "linear_%s_nli" % args.algorithm
     else:
         name = "linear_" + args.algorithm
+
+    if args.cv_folds:
+        cross_validate(run_fold, args, get_file_name(name + "-cv"))
+        return
+
+    __, test_y, predictions, labels = train(args)
+    report(test_y, predictions, labels)
+
     name = get_file_name(name)
     save_results(name, args.__dict__, None, test_y, predictions)
 
@@ -1,7 +1,7 @@
 import argparse
 import os
 import tempfile
-from typing import Callable, Iterable, List, Sequence, Union  # noqa: F401
+from typing import Callable, List, Sequence, Union  # noqa: F401
 
 import keras.backend as K
 from keras.layers import Dense, Dropout, Input
@@ -9,15 +9,11 @@ from keras.models import Model
 from keras.optimizers import Adam
 from keras.utils import to_categorical
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
 
-from masterthesis.features.build_features import (
-    bag_of_words,
-    filename_iter,
-    iterate_mixed_pos_docs,
-    iterate_pos_docs,
-)
+from masterthesis.features.ngram_store import ngram_features
 from masterthesis.models.callbacks import F1Metrics
+from masterthesis.models.cross_validation import cross_validate, fold_result, FoldResult
+from masterthesis.models.generators import fit, predict, SparseBatchSequence
 from masterthesis.models.report import multi_task_report, report
 from masterthesis.models.utils import (
     add_common_args,
@@ -28,7 +24,6 @@ from masterthesis.models.utils import (
 from masterthesis.results import save_results
 from masterthesis.utils import (
     AUX_OUTPUT_NAME,
-    DATA_DIR,
     get_file_name,
     load_split,
     OUTPUT_NAME,
@@ -39,7 +34,13 @@ from masterthesis.utils import (
     set_reproducible,
 )
 
-conll_folder = DATA_DIR / 'conll'
+# CountVectorizer parameters of each feature type
+FEATURE_PARAMS = {
+    'pos': dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(2, 4)),
+    'mix': dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(1, 3)),
+    'char': dict(analyzer='char', ngram_range=(2, 4), lowercase=False),
+    'bow': dict(token_pattern=r"[^\s]+", lowercase=False),
+}
 
 
 def parse_args():
@@ -47,6 +48,14 @@ def parse_args():
     add_common_args(parser)
     parser.add_argument('featuretype', choices={'pos', 'bow', 'char', 'mix'})
     parser.add_argument('--max-features', type=int, default=20000)
+    parser.add_argument(
+        '--hashing', action='store_true', help='Hash n-grams into --max-features features'
+    )
+    parser.add_argument(
+        '--feature-jobs', type=int, default=1, help='Number of processes to count n-grams in'
+    )
+    # The batch size Keras used to default to
+    parser.set_defaults(batch_size=32)
     return parser.parse_args()
 
 
@@ -71,56 +80,27 @@ def build_model(vocab_size: int, output_units: Sequence[int], classification: bo
     return Model(inputs=[input_], outputs=outputs)
 
 
-def pos_line_iter(split) -> Iterable[str]:
-    for doc in iterate_pos_docs(split):
-        yield ' '.join(doc)
-
-
-def mixed_pos_line_iter(split) -> Iterable[str]:
-    for doc in iterate_mixed_pos_docs(split):
-        yield ' '.join(doc)
-
-
-def preprocess(kind: str, max_features: int, train_meta, dev_meta):
-    if kind == 'pos':
-        vectorizer = CountVectorizer(
-            lowercase=False,
-            token_pattern=r"[^\s]+",
-            ngram_range=(2, 4),
-            max_features=max_features,
-        )
-        train_x = vectorizer.fit_transform(pos_line_iter('train'))
-        dev_x = vectorizer.transform(pos_line_iter('dev'))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == 'mix':
-        vectorizer = CountVectorizer(
-            lowercase=False,
-            token_pattern=r"[^\s]+",
-            ngram_range=(1, 3),
-            max_features=max_features,
-        )
-        train_x = vectorizer.fit_transform(mixed_pos_line_iter('train'))
-        dev_x = vectorizer.transform(mixed_pos_line_iter('dev'))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == 'char':
-        train_x, vectorizer = bag_of_words(
-            'train',
-            analyzer='char',
-            ngram_range=(2, 4),
-            max_features=max_features,
-            lowercase=False,
-        )
-        dev_x = vectorizer.transform(filename_iter(dev_meta))
-        num_features = len(vectorizer.vocabulary_)
-    elif kind == 'bow':
-        train_x, vectorizer = bag_of_words(
-            'train', token_pattern=r"[^\s]+", max_features=max_features, lowercase=False
-        )
-        dev_x = vectorizer.transform(filename_iter(dev_meta))
-        num_features = len(vectorizer.vocabulary_)
-    else:
+def preprocess(
+    kind: str,
+    max_features: int,
+    train_meta,
+    dev_meta,
+    train_split: str = 'train',
+    dev_split: str = 'dev',
+    hashing: bool = False,
+    jobs: int = 1,
+):
+    if kind not in FEATURE_PARAMS:
         raise ValueError('Feature type "%s" is not supported' % kind)
-    return train_x, dev_x, num_features
+    return ngram_features(
+        kind,
+        FEATURE_PARAMS[kind],
+        max_features,
+        train_split=train_split,
+        eval_split=dev_split,
+        hash_features=max_features if hashing else None,
+        jobs=jobs,
+    )
 
 
 def get_compile_args(method: str, lr: float):
@@ -141,18 +121,30 @@ def get_compile_args(method: str, lr: float):
     return optimizer, loss, metrics
 
 
-def main():
-    args = parse_args()
+def train(args: argparse.Namespace):
+    """Train on args.train_split and predict args.dev_split.
 
+    Returns:
+        The model with the weights of the best epoch, the training
+        history, the true and predicted label indices of the dev
+        documents and the labels.
+    """
     set_reproducible(args.seed_delta)
     do_classification = args.method == 'classification'
 
-    train_meta = load_split('train', round_cefr=args.round_cefr)
-    dev_meta = load_split('dev', round_cefr=args.round_cefr)
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
 
     kind = args.featuretype
     train_x, dev_x, num_features = preprocess(
-        kind, args.max_features, train_meta, dev_meta
+        kind,
+        args.max_features,
+        train_meta,
+        dev_meta,
+        train_split=args.train_split,
+        dev_split=args.dev_split,
+        hashing=args.hashing,
+        jobs=args.feature_jobs,
     )
 
     target_col = 'lang' if args.nli else 'cefr'
@@ -192,17 +184,22 @@ def main():
         optimizer=optimizer, loss=loss, loss_weights=loss_weights, metrics=metrics
     )
 
+    # Only densify the counts of a batch at a time
+    train_x = SparseBatchSequence(train_x, train_y, args.batch_size, seed=args.seed_delta)
+    dev_x = SparseBatchSequence(dev_x, dev_y, args.batch_size)
+
     # Context manager fails on Windows (can't open an open file again)
     temp_handle, weights_path = tempfile.mkstemp(suffix='.h5')
     val_y = dev_target_scores
     callbacks = [F1Metrics(dev_x, val_y, weights_path, ranked=args.method == 'ranked')]
-    history = model.fit(
+    history = fit(
+        model,
         train_x,
         train_y,
+        dev_x,
+        dev_y,
         epochs=args.epochs,
-        batch_size=args.batch_size,
         callbacks=callbacks,
-        validation_data=(dev_x, dev_y),
         verbose=2,
     )
     model.load_weights(weights_path)
@@ -211,9 +208,9 @@ def main():
 
     true = dev_target_scores
     if multi_task:
-        predictions = model.predict(dev_x)[0]
+        predictions = predict(model, dev_x)[0]
     else:
-        predictions = model.predict(dev_x)
+        predictions = predict(model, dev_x)
     if args.method == 'classification':
         pred = np.argmax(predictions, axis=1)
     elif args.method == 'regression':
@@ -222,6 +219,26 @@ def main():
         pred = rescale_regression_results(predictions, highest_class).ravel()
     elif args.method == 'ranked':
         pred = K.eval(ranked_prediction(predictions))
+    return model, history, true, pred, labels
+
+
+def run_fold(args: argparse.Namespace) -> FoldResult:
+    __, history, true, pred, labels = train(args)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    return fold_result(dev_meta.filename, labels, true, pred, history.history)
+
+
+def main():
+    args = parse_args()
+    multi_task = args.aux_loss_weight > 0
+    prefix = 'mlp_%s' % args.featuretype
+
+    if args.cv_folds:
+        target_col = 'lang' if args.nli else 'cefr'
+        cross_validate(run_fold, args, get_file_name(prefix + '-cv'), target_col)
+        return
+
+    model, history, true, pred, labels = train(args)
     if multi_task:
         multi_task_report(history.history, true, pred, labels)
     else:
@@ -229,7 +246,6 @@ def main():
 
     plt.show()
 
-    prefix = 'mlp_%s' % args.featuretype
     fname = get_file_name(prefix)
     save_results(fname, args.__dict__, history.history, true, pred)
 
@@ -0,0 +1,167 @@
+"""Post-training quantization of saved models.
+
+The embeddings and the kernels of Dense, Conv1D and recurrent layers
+are stored as float16, or as int8 with a float32 scale per channel:
+per word for embeddings, and per output unit for kernels. Other weights,
+like biases, are kept as float32. A quantized model is an npz file next
+to the original,
+
+    <model stem>-float16.npz or <model stem>-int8.npz
+
+holding the model config and the weights. held_out_eval loads both
+formats. The weights are dequantized to float32 layer by layer when the
+model is loaded, so quantization reduces the size on disk and the time
+to read it, but a loaded model takes as much memory as the original.
+
+Quantize the models of some jobs and compare them on the dev split:
+
+    python -m masterthesis.models.quantize --dtype int8 --report 26805083
+"""
+import argparse
+from pathlib import Path
+from typing import Any, Dict, List, Optional  # noqa: F401
+
+from keras.models import load_model, model_from_json
+import numpy as np
+from sklearn.metrics import accuracy_score, f1_score
+
+from masterthesis.utils import atomic_write
+
+# Weights that are quantized, by their name in the layer
+QUANTIZED_WEIGHTS = ('embeddings', 'kernel', 'recurrent_kernel')
+DTYPES = ('float16', 'int8')
+INT8_MAX = 127
+
+
+def weight_name(weight) -> str:
+    """The name of a weight in its layer, like 'kernel' for 'dense_1/kernel:0'."""
+    return weight.name.split('/')[-1].split(':')[0]
+
+
+def quantize_int8(weights: np.ndarray, axis: int) -> Dict[str, np.ndarray]:
+    """Symmetric int8 quantization with one scale per index of an axis."""
+    other_axes = tuple(i for i in range(weights.ndim) if i != axis % weights.ndim)
+    scale = np.abs(weights).max(axis=other_axes, keepdims=True) / INT8_MAX
+    scale[scale == 0] = 1
+    values = np.clip(np.round(weights / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return {'values': values, 'scale': scale.astype(np.float32)}
+
+
+def quantize_weight(name: str, weights: np.ndarray, dtype: str) -> Dict[str, np.ndarray]:
+    if name not in QUANTIZED_WEIGHTS:
+        return {'values': weights}
+    if dtype == 'float16':
+        return {'values': weights.astype(np.float16)}
+    # A scale per word for embeddings, and per output unit for kernels
+    return quantize_int8(weights, axis=0 if name == 'embeddings' else -1)
+
+
+def dequantize_weight(values: np.ndarray, scale: Optional[np.ndarray] = None) -> np.ndarray:
+    weights = values.astype(np.float32)
+    if scale is not None:
+        weights *= scale
+    return weights
+
+
+def quantized_path(model_path: Path, dtype: str) -> Path:
+    return model_path.with_name('%s-%s.npz' % (model_path.stem, dtype))
+
+
+def is_quantized(model_path: Path) -> bool:
+    return model_path.suffix == '.npz' and any(
+        model_path.stem.endswith('-' + dtype) for dtype in DTYPES
+    )
+
+
+def original_stem(model_path: Path) -> str:
+    """The stem of the saved model a model path was quantized from, or its own stem."""
+    if is_quantized(model_path):
+        return model_path.stem.rsplit('-', 1)[0]
+    return model_path.stem
+
+
+def save_quantized(model, path: Path, dtype: str) -> None:
+    if dtype not in DTYPES:
+        raise ValueError('Quantization to %s is not supported' % dtype)
+    arrays = {'config': np.array(model.to_json())}
+    for idx, (weight, values) in enumerate(zip(model.weights, model.get_weights())):
+        for key, array in quantize_weight(weight_name(weight), values, dtype).items():
+            arrays['%d_%s' % (idx, key)] = array
+    with atomic_write(path) as f:
+        np.savez(f, **arrays)
+
+
+def load_quantized(path: Path, custom_objects: Optional[Dict[str, Any]] = None):
+    """Load a quantized model, with its weights dequantized to float32.
+
+    The weights are dequantized and set one layer at a time, so only the
+    float32 copies of a single layer exist besides the model.
+    """
+    with np.load(str(path)) as f:
+        model = model_from_json(str(f['config']), custom_objects=custom_objects)
+        # The npz keys follow the order of model.weights
+        weight_idx = {id(weight): idx for idx, weight in enumerate(model.weights)}
+        for layer in model.layers:
+            weights = []
+            for weight in layer.weights:
+                idx = weight_idx[id(weight)]
+                scale_key = '%d_scale' % idx
+                scale = f[scale_key] if scale_key in f.files else None
+                weights.append(dequantize_weight(f['%d_values' % idx], scale))
+            if weights:
+                layer.set_weights(weights)
+    return model
+
+
+def quantize(model_path: Path, dtype: str) -> Path:
+    path = quantized_path(model_path, dtype)
+    save_quantized(load_model(str(model_path)), path, dtype)
+    return path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Quantize saved models')
+    parser.add_argument('job_ids', type=str, nargs='+')
+    parser.add_argument('--dtype', choices=set(DTYPES), default='int8')
+    parser.add_argument('--report', action='store_true', help='Compare the models on --split')
+    parser.add_argument('--split', default='dev')
+    parser.add_argument('--collapsed', action='store_true')
+    return parser.parse_args()
+
+
+def accuracy_delta_report(model_path: Path, path: Path, split: str, collapsed: bool) -> None:
+    """Print the accuracy and macro F1 of a model and its quantized version on a split."""
+    # held_out_eval loads quantized models with this module
+    from masterthesis.held_out_eval import load_model_and_w2i, load_targets, predict_levels
+
+    targets, highest_class, __ = load_targets(split, collapsed)
+    predictions = []
+    for p in (model_path, path):
+        model, w2i = load_model_and_w2i(p)
+        predictions.append(predict_levels(model, w2i, split, highest_class))
+        del model
+    metrics = [
+        ('Accuracy', accuracy_score),
+        ('Macro F1', lambda true, pred: f1_score(true, pred, average='macro')),
+    ]
+    for name, metric in metrics:
+        before, after = (metric(targets, pred) for pred in predictions)
+        print('%s: %.4f -> %.4f (%+.4f)' % (name, before, after, after - before))
+    print('Same prediction: %.4f' % np.mean(predictions[0] == predictions[1]))
+
+
+def main():
+    from masterthesis.held_out_eval import find_model_paths
+
+    args = parse_args()
+    for model_path in find_model_paths(args.job_ids):
+        path = quantize(model_path, args.dtype)
+        print('%s: %.1f MB -> %.1f MB' % (
+            path.name, model_path.stat().st_size / 2 ** 20, path.stat().st_size / 2 ** 20
+        ))
+        if args.report:
+            accuracy_delta_report(model_path, path, args.split, args.collapsed)
+
+
+if __name__ == '__main__':
+    main()
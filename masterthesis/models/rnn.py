@@ -1,7 +1,7 @@
 import argparse
 import os
 import tempfile
-from typing import Callable, Dict, Iterable, List, Sequence, Union  # noqa: F401
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Union  # noqa: F401
 
 from keras import backend as K
 from keras.layers import (
@@ -26,6 +26,8 @@ from keras.utils import to_categorical
 import numpy as np
 
 from masterthesis.models.callbacks import F1Metrics
+from masterthesis.models.cross_validation import cross_validate, fold_result, FoldResult
+from masterthesis.models.generators import fit, predict
 from masterthesis.models.layers import (
     build_inputs_and_embeddings,
     GlobalAveragePooling1D,
@@ -35,6 +37,7 @@ from masterthesis.models.report import multi_task_report, report
 from masterthesis.models.utils import (
     add_common_args,
     add_seq_common_args,
+    bucket_sequences,
     get_sequence_input_reps,
     get_targets_and_output_units,
     init_pretrained_embs,
@@ -60,7 +63,7 @@ RECURRENT_DROPOUT = 0.1
 POS_EMB_DIM = 10
 
 
-def parse_args():
+def parse_args(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser()
     add_common_args(parser)
     add_seq_common_args(parser)
@@ -83,7 +86,11 @@ def parse_args():
         vocab_size=None,
         pool_method='mean',
     )
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.bucket and args.pool_method == 'attention':
+        # The attention weights are computed over a fixed number of steps
+        parser.error('--bucket is not supported with attention pooling')
+    return args
 
 
 def _build_rnn(rnn_cell: str, rnn_dim: int, bidirectional: bool) -> Layer:
@@ -114,7 +121,7 @@ def build_model(
         embed_dim=args.embed_dim,
         pos_embed_dim=POS_EMB_DIM,
         vocab_size=args.vocab_size,
-        sequence_len=args.doc_length,
+        sequence_len=None if args.bucket else args.doc_length,
         static_embeddings=args.static_embs,
     )
     inputs, embedding_layer = build_inputs_and_embeddings(input_layer_args)
@@ -179,19 +186,24 @@ def get_compile_args(args: argparse.Namespace):
 
 def get_predictions(model: Model, x, multi_task: bool) -> np.ndarray:
     """Return only the first set of predictions if multi-task setup."""
-    predictions = model.predict(x)
+    predictions = predict(model, x)
     if multi_task:
         return predictions[0]
     return predictions
 
 
-def main():
-    args = parse_args()
+def train(args: argparse.Namespace):
+    """Train on args.train_split and predict args.dev_split.
 
+    Returns:
+        The model with the weights of the best epoch, the training
+        history, the true and predicted label indices of the dev
+        documents, the labels and the vocabulary.
+    """
     set_reproducible(args.seed_delta)
 
-    train_meta = load_split('train', round_cefr=args.round_cefr)
-    dev_meta = load_split('dev', round_cefr=args.round_cefr)
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
 
     target_col = 'lang' if args.nli else 'cefr'
     labels = sorted(train_meta[target_col].unique())
@@ -239,17 +251,22 @@ def main():
         optimizer=optimizer, loss=loss, loss_weights=loss_weights, metrics=metrics
     )
 
+    if args.bucket:
+        train_x, dev_x = bucket_sequences(args, train_x, train_y, dev_x, dev_y)
+
     # Context manager fails on Windows (can't open an open file again)
     temp_handle, weights_path = tempfile.mkstemp(suffix='.h5')
     val_y = dev_target_scores
     callbacks = [F1Metrics(dev_x, val_y, weights_path, ranked=args.method == 'ranked')]
-    history = model.fit(
+    history = fit(
+        model,
         train_x,
         train_y,
+        dev_x,
+        dev_y,
         epochs=args.epochs,
         batch_size=args.batch_size,
         callbacks=callbacks,
-        validation_data=(dev_x, dev_y),
         verbose=2,
     )
     model.load_weights(weights_path)
@@ -266,6 +283,31 @@ def main():
         pred = rescale_regression_results(predictions, highest_class).ravel()
     elif args.method == 'ranked':
         pred = K.eval(ranked_prediction(predictions))
+    return model, history, true, pred, labels, w2i
+
+
+def run_fold(args: argparse.Namespace) -> FoldResult:
+    __, history, true, pred, labels, __ = train(args)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    return fold_result(dev_meta.filename, labels, true, pred, history.history)
+
+
+def run(args: argparse.Namespace, name_suffix: str = '') -> None:
+    """Train a configuration, report on it and save its results."""
+    multi_task = args.aux_loss_weight > 0
+    if args.nli:
+        name = 'rnn-nli'
+    elif multi_task:
+        name = 'rnn-multi'
+    else:
+        name = 'rnn'
+
+    if args.cv_folds:
+        target_col = 'lang' if args.nli else 'cefr'
+        cross_validate(run_fold, args, get_file_name(name + '-cv') + name_suffix, target_col)
+        return
+
+    model, history, true, pred, labels, w2i = train(args)
     try:
         if multi_task:
             multi_task_report(history.history, true, pred, labels)
@@ -274,19 +316,16 @@ def main():
     except Exception:
         pass
 
-    if args.nli:
-        name = 'rnn-nli'
-    elif multi_task:
-        name = 'rnn-multi'
-    else:
-        name = 'rnn'
-    name = get_file_name(name)
+    name = get_file_name(name) + name_suffix
 
     if args.save_model:
         save_model(name, model, w2i)
 
     save_results(name, args.__dict__, history.history, true, pred)
 
+
+def main():
+    run(parse_args())
     plt.show()
 
 
@@ -0,0 +1,86 @@
+"""Train several configurations of a model in one process.
+
+Every configuration is a line of arguments to the model script, as in
+the case statements of batch_jobs/*.slurm. The configurations are
+trained one after the other with the usual results, and models if
+--save-model is given, named like those of the script with the suffix
+_<line number>. TensorFlow is only imported once, and configurations
+with the same inputs share them, see models.utils.shared_inputs.
+
+    # configs.txt
+    --method classification
+    --method classification --include-pos
+    --method regression --vectors models/vectors/120-small.pkl
+
+    python -m masterthesis.models.runner cnn configs.txt --common "--constraint 3"
+
+With --grid, every line is instead a list of alternatives separated by
+|, and a configuration is made for every combination of alternatives:
+
+    --method classification | --method regression | --method ranked
+    | --include-pos | --mixed-pos
+"""
+import argparse
+from importlib import import_module
+from itertools import product
+import logging
+from pathlib import Path
+import shlex
+from typing import List  # noqa: F401
+
+import keras.backend as K
+
+from masterthesis.models.utils import shared_inputs
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+MODELS = ('cnn', 'rnn')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Train several configurations of a model')
+    parser.add_argument('model', choices=set(MODELS))
+    parser.add_argument('configs', type=Path, help='File with a configuration on every line')
+    parser.add_argument('--grid', action='store_true', help='Lines are alternatives to combine')
+    parser.add_argument(
+        '--common', type=shlex.split, default=[], help='Arguments of every configuration'
+    )
+    return parser.parse_args()
+
+
+def read_lines(path: Path) -> List[str]:
+    """Non-empty lines of a file, without comments."""
+    with path.open(encoding='utf-8') as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
+def configurations(lines: List[str], grid: bool = False) -> List[List[str]]:
+    """Argument lists of the configurations described by some lines."""
+    if not grid:
+        return [shlex.split(line) for line in lines]
+    axes = [[shlex.split(alternative) for alternative in line.split('|')] for line in lines]
+    return [sum(combination, []) for combination in product(*axes)]
+
+
+def run_all(model: str, configs: List[List[str]]) -> None:
+    module = import_module('masterthesis.models.' + model)
+    # Parse all configurations first, so that errors show before any training
+    all_args = [module.parse_args(argv) for argv in configs]
+    with shared_inputs():
+        for idx, (argv, args) in enumerate(zip(configs, all_args), start=1):
+            print('Configuration %d of %d: %s' % (idx, len(configs), ' '.join(argv)))
+            # Free the graph of the previous model, set_reproducible makes a new session
+            K.clear_session()
+            module.run(args, name_suffix='_%d' % idx)
+
+
+def main():
+    args = parse_args()
+    configs = configurations(read_lines(args.configs), args.grid)
+    run_all(args.model, [args.common + argv for argv in configs])
+
+
+if __name__ == '__main__':
+    main()
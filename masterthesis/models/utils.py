@@ -1,13 +1,20 @@
 import argparse
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+from operator import itemgetter
 import os
 from pathlib import Path
+import pickle
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple  # noqa: F401
 
 import keras.backend as K
-from keras.models import Model
+from keras.models import load_model, Model
 from keras.utils import to_categorical
 import numpy as np
-from tqdm import tqdm
 
+from masterthesis.fasttext import is_fasttext_binary, vector_matrix
 from masterthesis.features.build_features import (
     make_mixed_pos2i,
     make_pos2i,
@@ -16,8 +23,113 @@ from masterthesis.features.build_features import (
     pos_to_sequences,
     words_to_sequences,
 )
-from masterthesis.gensim_utils import load_embeddings
-from masterthesis.utils import EMB_LAYER_NAME
+from masterthesis.models.cross_validation import add_cv_args
+from masterthesis.models.generators import BucketedSequence
+from masterthesis.utils import atomic_write, EMB_LAYER_NAME, MODEL_DIR, REPRESENTATION_LAYER
+from masterthesis.vectors import unit_normalize
+
+embeddings_folder = MODEL_DIR / 'embeddings'
+logger = logging.getLogger(__name__)
+_shared_inputs = None  # type: Optional[Dict[Tuple, Any]]
+
+
+def digest_path(path: Path) -> Path:
+    return path.with_name(path.name + '.sha1')
+
+
+def file_digest(path: Path) -> str:
+    """SHA-1 of the contents of a file, memoized next to it.
+
+    Hashing a vectors file reads all of it, so the digest is saved in
+    <path>.sha1 with the size and modification time of the file, and
+    only computed again when they change. If the folder is read-only,
+    the digest is computed every time.
+    """
+    stat = path.stat()
+    stamp = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    memo_path = digest_path(path)
+    try:
+        with memo_path.open() as f:
+            memo = json.load(f)
+        if memo.get('stamp') == stamp:
+            return memo['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1 = hashlib.sha1()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    try:
+        with atomic_write(memo_path) as f:
+            f.write(json.dumps({'stamp': stamp, 'sha1': sha1.hexdigest()}).encode('utf-8'))
+    except OSError:
+        logger.debug('Can not save the digest of %s', path)
+    return sha1.hexdigest()
+
+
+def mapping_digest(w2i: Mapping[str, int]) -> str:
+    """SHA-1 of the words of a vocabulary and their indices."""
+    sha1 = hashlib.sha1()
+    for word, idx in sorted(w2i.items(), key=itemgetter(1)):
+        sha1.update(('%d\t%s\n' % (idx, word)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def _vector_index(kv) -> Mapping[str, int]:
+    """Map words to rows of the vectors of both Gensim 3 and 4 keyed vectors."""
+    if hasattr(kv, 'key_to_index'):
+        return kv.key_to_index
+    return {word: vocab.index for word, vocab in kv.vocab.items()}
+
+
+def _index_words(w2i: Mapping[str, int]) -> List[str]:
+    words = [''] * len(w2i)
+    for word, idx in w2i.items():
+        words[idx] = word
+    return words
+
+
+def embedding_matrix(kv, w2i: Mapping[str, int]) -> np.ndarray:
+    """Gather the vectors of a vocabulary into a float32 matrix.
+
+    The rows of words in the keyed vectors are gathered at once. Other
+    words get the vector kv.get_vector makes for them, like the subword
+    vectors of fastText, or zeros if it can not make one.
+    """
+    words = _index_words(w2i)
+    index = _vector_index(kv)
+    rows = np.array([index.get(word, -1) for word in words], dtype=np.int64)
+    known = rows >= 0
+    matrix = np.zeros((len(words), kv.vector_size), dtype=np.float32)
+    matrix[known] = kv.vectors[rows[known]]
+    for idx in np.flatnonzero(~known):
+        try:
+            matrix[idx] = kv.get_vector(words[idx])
+        except KeyError:
+            logger.debug('No vector for %s', words[idx])
+    return matrix
+
+
+def load_embedding_matrix(vector_path: Path, w2i: Mapping[str, int]) -> np.ndarray:
+    """Return the embedding matrix of a vocabulary, cached by vectors file and vocabulary."""
+    cache_path = embeddings_folder / (
+        '%s-%s.npy' % (file_digest(vector_path)[:16], mapping_digest(w2i)[:16])
+    )
+    if cache_path.is_file():
+        return np.load(str(cache_path))
+    if is_fasttext_binary(vector_path):
+        # Subword vectors for the whole vocabulary, without loading the model
+        with vector_path.open('rb') as f:
+            __, matrix = vector_matrix(f, _index_words(w2i))
+        matrix = unit_normalize(matrix)
+    else:
+        # Importing Gensim is slow, so only do it when the matrix is not cached
+        from masterthesis.gensim_utils import load_embeddings
+
+        matrix = embedding_matrix(load_embeddings(vector_path), w2i)
+    with atomic_write(cache_path) as f:
+        np.save(f, matrix)
+    return matrix
 
 
 def init_pretrained_embs(model: Model, vector_path: Path, w2i) -> None:
@@ -28,20 +140,36 @@ def init_pretrained_embs(model: Model, vector_path: Path, w2i) -> None:
     if not vector_path.is_file():
         print('Embeddings path not available, searching for submitdir')
     else:
-        kv = load_embeddings(vector_path)
-        embed_dim = kv.vector_size
         emb_layer = model.get_layer(EMB_LAYER_NAME)
         vocab_size = emb_layer.input_dim
-        assert embed_dim == emb_layer.output_dim
         assert len(w2i) == vocab_size
-        embeddings_matrix = np.zeros((vocab_size, embed_dim))
-        print('Making embeddings:')
-        for word, idx in tqdm(w2i.items(), total=vocab_size):
-            vec = kv.word_vec(word)
-            embeddings_matrix[idx, :] = vec
+        print('Making embeddings ...')
+        embeddings_matrix = _shared(
+            ('vectors', str(vector_path), mapping_digest(w2i)),
+            lambda: load_embedding_matrix(vector_path, w2i),
+        )
+        assert embeddings_matrix.shape[1] == emb_layer.output_dim
         emb_layer.set_weights([embeddings_matrix])
 
 
+def get_model_representations(model_path: Path, split: str) -> np.ndarray:
+    """Outputs of the representation layer of a saved model for the documents of a split."""
+    model = load_model(str(model_path))
+    representation_model = Model(
+        inputs=model.input, outputs=model.get_layer(REPRESENTATION_LAYER).output
+    )
+    logger.debug(model.input)
+    w2i_path = model_path.parent / (model_path.stem + '_w2i.pkl')
+    w2i = pickle.load(w2i_path.open('rb'))
+    (x,) = words_to_sequences(700, [split], w2i)
+    if isinstance(model.input, list) and len(model.input) == 2:
+        pos2i_path = model_path.parent / ('pos2i.pkl')
+        pos2i = pickle.load(pos2i_path.open('rb'))
+        (x_pos,) = pos_to_sequences(700, [split], pos2i)
+        x = [x, x_pos]
+    return representation_model.predict(x)
+
+
 def add_common_args(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--aux-loss-weight', type=float, default=0)
     parser.add_argument('--batch-size', '-b', type=int)
@@ -57,9 +185,15 @@ def add_common_args(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--save-model', action='store_true')
     parser.add_argument('--seed-delta', type=int, default=0)
     parser.add_argument('--verbose', action='store_true')
+    add_cv_args(parser)
 
 
 def add_seq_common_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--bucket',
+        action='store_true',
+        help='Batch documents of similar length and pad batches to their longest document',
+    )
     parser.add_argument('--doc-length', '-l', type=int, default=700)
     parser.add_argument('--embed-dim', type=int)
     parser.add_argument('--include-pos', action='store_true')
@@ -112,23 +246,68 @@ def to_ranked_rep(targets):
     return rep
 
 
+@contextmanager
+def shared_inputs() -> Iterator[None]:
+    """Share input representations between the models trained within the block.
+
+    The results of get_sequence_input_reps and the embedding matrices of
+    init_pretrained_embs are kept by the arguments they depend on, so
+    that configurations with the same inputs only prepare them once.
+    """
+    global _shared_inputs
+    _shared_inputs = {}
+    try:
+        yield
+    finally:
+        _shared_inputs = None
+
+
+def _shared(key: Tuple, make: Callable[[], Any]) -> Any:
+    if _shared_inputs is None:
+        return make()
+    if key not in _shared_inputs:
+        _shared_inputs[key] = make()
+    return _shared_inputs[key]
+
+
+def representation_key(args) -> Tuple:
+    """The arguments that get_sequence_input_reps depends on."""
+    if args.mixed_pos:
+        return (args.train_split, args.dev_split, args.doc_length, 'mixed_pos')
+    return (
+        args.train_split, args.dev_split, args.doc_length, args.vocab_size, args.include_pos
+    )
+
+
 def get_sequence_input_reps(args):
+    return _shared(representation_key(args), lambda: _make_sequence_input_reps(args))
+
+
+def _make_sequence_input_reps(args):
+    splits = [args.train_split, args.dev_split]
     if args.mixed_pos:
-        w2i = make_mixed_pos2i()
-        train_x, dev_x = mixed_pos_to_sequences(args.doc_length, ['train', 'dev'], w2i)
+        w2i = make_mixed_pos2i(args.train_split)
+        train_x, dev_x = mixed_pos_to_sequences(args.doc_length, splits, w2i)
         args.vocab_size = len(w2i)
         num_pos = 0
     else:
-        w2i = make_w2i(args.vocab_size)
-        train_x, dev_x = words_to_sequences(args.doc_length, ['train', 'dev'], w2i)
+        w2i = make_w2i(args.vocab_size, args.train_split)
+        train_x, dev_x = words_to_sequences(args.doc_length, splits, w2i)
         if args.include_pos:
-            pos2i = make_pos2i()
+            pos2i = make_pos2i(args.train_split)
             num_pos = len(pos2i)
-            train_pos, dev_pos = pos_to_sequences(
-                args.doc_length, ['train', 'dev'], pos2i
-            )
+            train_pos, dev_pos = pos_to_sequences(args.doc_length, splits, pos2i)
             train_x = [train_x, train_pos]
             dev_x = [dev_x, dev_pos]
         else:
             num_pos = 0
     return train_x, dev_x, num_pos, w2i
+
+
+def bucket_sequences(args, train_x, train_y, dev_x, dev_y, min_length: int = 1):
+    """Wrap the inputs and targets of both splits in BucketedSequences."""
+    train_seq = BucketedSequence(
+        train_x, train_y, args.batch_size, min_length=min_length, seed=args.seed_delta
+    )
+    dev_seq = BucketedSequence(dev_x, dev_y, args.batch_size, min_length=min_length)
+    return train_seq, dev_seq
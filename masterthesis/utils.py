@@ -4,14 +4,29 @@ safe_plt: A Pyplot that won't attempt to open a display if not available
 iso639_3: A mapping of Norwegian language names (as used in the data) to
     ISO639_3 codes.
 """
+from contextlib import contextmanager
 import datetime as dt
 import itertools
 import os
 from pathlib import Path
 import pickle
 import random
+import re
 import sys
-from typing import Iterable, List, Optional, Sequence, Set, TextIO, Tuple, Union
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import keras.backend as K
 import matplotlib
@@ -22,6 +37,7 @@ if 'SLURM_JOB_NODELIST' in os.environ or (
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from sklearn.model_selection import GroupKFold, StratifiedKFold
 import tensorflow as tf
 
 try:
@@ -194,28 +210,159 @@ def round_cefr_score(cefr: str) -> str:
     return cefr[-2:] if '/' in cefr else cefr
 
 
+SPLITS = ("train", "dev", "test", "train,dev", "norsk")
+CATEGORICAL_COLUMNS = ("cefr", "lang", "split", "topic")
+CV_STRATEGIES = ("stratified", "topic")
+
+_fold_split_re = re.compile(r"^cv-(%s)-(\d+)-(\d+)-(train|dev)$" % "|".join(CV_STRATEGIES))
+
+
+def fold_split_name(strategy: str, num_folds: int, fold: int, part: str) -> str:
+    """Name of the train or dev part of a cross-validation fold.
+
+    The folds divide the documents in train,dev, and the names can be
+    used wherever a split name is expected.
+
+    >>> fold_split_name('topic', 5, 0, 'dev')
+    'cv-topic-5-0-dev'
+    """
+    if strategy not in CV_STRATEGIES:
+        raise ValueError("Unknown cross-validation strategy %r" % strategy)
+    if part not in ("train", "dev") or not 0 <= fold < num_folds:
+        raise ValueError("Invalid fold %d %s of %d" % (fold, part, num_folds))
+    return "cv-%s-%d-%d-%s" % (strategy, num_folds, fold, part)
+
+
+def parse_fold_split(split: str) -> Optional[Tuple[str, int, int, str]]:
+    """Return the strategy, number of folds, fold and part of a fold split.
+
+    Returns None if split is not the name of a fold.
+    """
+    match = _fold_split_re.match(split)
+    if match is None:
+        return None
+    strategy, num_folds, fold, part = match.groups()
+    if int(fold) >= int(num_folds):
+        return None
+    return strategy, int(num_folds), int(fold), part
+
+
+def is_valid_split(split: str) -> bool:
+    return split in SPLITS or parse_fold_split(split) is not None
+
+
+def _uncategorize(frame: pd.DataFrame) -> pd.DataFrame:
+    for col in CATEGORICAL_COLUMNS:
+        frame[col] = frame[col].astype(object)
+    return frame
+
+
+class MetadataIndex:
+    """The corpus metadata, parsed once and indexed by split.
+
+    Attributes:
+        path: The metadata file
+        mtime: Modification time of the file when it was read
+        frame: All metadata, with categorical lang, cefr, split and
+            topic columns. The frames of the splits have plain object
+            columns, like the metadata file read without dtypes.
+        rows: Positions in frame of the documents in every split.
+            Cross-validation folds are added the first time they are
+            requested.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.mtime = path.stat().st_mtime
+        df = pd.read_csv(path, dtype={col: "category" for col in CATEGORICAL_COLUMNS})
+        self.frame = df
+        rated = df.cefr.notna()
+        self.rows = {
+            "train": np.flatnonzero(rated & (df.split == "train")),
+            "dev": np.flatnonzero(rated & (df.split == "dev")),
+            "test": np.flatnonzero(rated & (df.split == "test")),
+            "train,dev": np.flatnonzero(rated & (df.split != "test")),
+            "norsk": np.flatnonzero(df.lang.isin({"bokmål", "nynorsk"})),
+        }
+        round_cefr = df.cefr.astype(object).map(round_cefr_score, na_action="ignore")
+        self._round_cefr = round_cefr.astype("category")
+        self._frames = {}  # type: Dict[Tuple[str, bool], pd.DataFrame]
+        for split in SPLITS:
+            self._add_frames(split)
+
+    def _add_frames(self, split: str) -> None:
+        rows = self.rows[split]
+        frame = self.frame.iloc[rows].copy()
+        if split != "norsk":
+            rounded = frame.copy()
+            rounded["cefr"] = self._round_cefr.iloc[rows]
+            self._frames[split, True] = _uncategorize(rounded)
+        self._frames[split, False] = _uncategorize(frame)
+
+    def _add_folds(self, strategy: str, num_folds: int) -> None:
+        """Divide train,dev into folds and index the train and dev part of each."""
+        rows = self.rows["train,dev"]
+        docs = self.frame.iloc[rows]
+        if strategy == "stratified":
+            kfold = StratifiedKFold(num_folds, shuffle=True, random_state=RANDOM_SEED)
+            folds = kfold.split(rows, docs.cefr.astype(str))
+        else:
+            # No topic is in both the train and dev part of a fold
+            folds = GroupKFold(num_folds).split(rows, groups=docs.topic.astype(str))
+        for fold, (train_idx, dev_idx) in enumerate(folds):
+            for part, idx in (("train", train_idx), ("dev", dev_idx)):
+                split = fold_split_name(strategy, num_folds, fold, part)
+                self.rows[split] = rows[np.sort(idx)]
+                self._add_frames(split)
+
+    def _ensure_split(self, split: str) -> None:
+        if split not in self.rows:
+            fold_split = parse_fold_split(split)
+            if fold_split is None:
+                raise ValueError("Unrecognized split %r" % split)
+            self._add_folds(*fold_split[:2])
+
+    def select(self, split: str, round_cefr: bool = False) -> pd.DataFrame:
+        """Return a copy of the metadata for the documents in a split."""
+        self._ensure_split(split)
+        if split == "norsk":
+            round_cefr = False
+        return self._frames[split, round_cefr].copy()
+
+    def split_len(self, split: str) -> int:
+        self._ensure_split(split)
+        return len(self.rows[split])
+
+
+_metadata_index = None  # type: Optional[MetadataIndex]
+
+
+def get_metadata_index() -> MetadataIndex:
+    """Return the metadata index, reading the metadata file if it has changed."""
+    global _metadata_index
+    filepath = DATA_DIR / "metadata.csv"
+    if (
+        _metadata_index is None
+        or _metadata_index.path != filepath
+        or _metadata_index.mtime != filepath.stat().st_mtime
+    ):
+        _metadata_index = MetadataIndex(filepath)
+    return _metadata_index
+
+
 def load_split(split: str, round_cefr: bool = False) -> pd.DataFrame:
     """Load the test split as a dataframe.
 
     Args:
-        split: {train, dev, test}
+        split: {train, dev, test} or the name of a cross-validation
+            fold, see fold_split_name
 
     Returns:
         A frame with the metadata for documents in the requested split.
     """
-    if split not in ["train", "dev", "test", "train,dev", "norsk"]:
-        raise ValueError('Split must be train, dev or test')
-    filepath = DATA_DIR / "metadata.csv"
-    df = pd.read_csv(filepath)
-    if split == "norsk":
-        return df[df.lang.isin({"bokmål", "nynorsk"})]
-    df = df.dropna(subset=['cefr'])
-    if round_cefr:
-        df.loc[:, 'cefr'] = df.cefr.apply(round_cefr_score)
-    if split == "train,dev":
-        return df[df.split != "test"]
-    else:
-        return df[df.split == split]
+    if not is_valid_split(split):
+        raise ValueError('Split must be train, dev, test or a cross-validation fold')
+    return get_metadata_index().select(split, round_cefr)
 
 
 def load_test() -> pd.DataFrame:
@@ -255,7 +402,8 @@ def conll_reader(
         file: The CoNLL file to read from
         cols: The columns to read
         tags: Whether to include start and end tags around sentences.
-            The tags are '<s>' and '</s>' regardless of column.
+            The tags are '<s>' and '</s>' regardless of column, also
+            around a last sentence without an empty line after it.
 
     Yields:
         Each sentence in file as a list of tuples corresponding to the
@@ -268,8 +416,10 @@ def conll_reader(
     except ValueError:
         raise ValueError('All column names must be one of %s' % set(conll_cols))
     if tags:
-        start_tags = tuple('<s>' for __ in cols)
-        end_tags = tuple('</s>' for __ in cols)
+        start_tags = [tuple('<s>' for __ in cols)]
+        end_tags = [tuple('</s>' for __ in cols)]
+    else:
+        start_tags = end_tags = []
     with file.open(encoding='utf8') as stream:
         tuple_sequence = []  # type: List[Tuple[str, ...]]
         for line in stream:
@@ -277,30 +427,137 @@ def conll_reader(
             if line.startswith('#'):
                 continue
             if not line:  # Empty line = end of sentence
-                if tags:
-                    yield [start_tags] + tuple_sequence + [end_tags]
-                else:
-                    yield tuple_sequence
+                yield start_tags + tuple_sequence + end_tags
                 tuple_sequence = []
             else:
                 fields = line.split('\t')
                 tup = tuple(fields[i] for i in col_idx)
                 tuple_sequence.append(tup)
     if tuple_sequence:  # Flush if there is no empty line at end of file
-        yield tuple_sequence
+        yield start_tags + tuple_sequence + end_tags
+
+
+ConllColumns = NamedTuple(
+    'ConllColumns',
+    [
+        ('columns', Dict[str, np.ndarray]),
+        ('sent_offsets', np.ndarray),
+        ('doc_offsets', np.ndarray),
+    ],
+)
+
+
+def _split_conll_fields(token_lines: List[str]) -> np.ndarray:
+    """Split token lines into a (num_tokens, num_fields) array of strings."""
+    if not token_lines:
+        return np.empty((0, len(conll_cols)), dtype=object)
+    # One split call for the whole file instead of one per line
+    fields = '\t'.join(token_lines).split('\t')
+    if len(fields) == len(conll_cols) * len(token_lines):
+        return np.array(fields, dtype=object).reshape(-1, len(conll_cols))
+    # Some lines have extra or missing fields
+    rows = [line.split('\t') for line in token_lines]
+    width = max(len(conll_cols), max(len(row) for row in rows))
+    table = np.full((len(rows), width), '', dtype=object)
+    for i, row in enumerate(rows):
+        table[i, :len(row)] = row
+    return table
+
+
+def _read_conll_file(file: Path) -> Tuple[np.ndarray, List[int]]:
+    """Return the fields of all tokens in a file and the sentence lengths."""
+    with file.open(encoding='utf8') as stream:
+        lines = stream.read().split('\n')
+    if lines and not lines[-1]:
+        lines.pop()  # The file ends with a newline
+    token_lines = []  # type: List[str]
+    sent_lengths = []  # type: List[int]
+    sent_start = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if not line:  # Empty line = end of sentence
+            sent_lengths.append(len(token_lines) - sent_start)
+            sent_start = len(token_lines)
+        else:
+            token_lines.append(line)
+    if len(token_lines) > sent_start:  # No empty line at end of file
+        sent_lengths.append(len(token_lines) - sent_start)
+    return _split_conll_fields(token_lines), sent_lengths
+
+
+def _add_sentence_tags(column: np.ndarray, sent_lengths: np.ndarray) -> np.ndarray:
+    num_sents = len(sent_lengths)
+    tagged = np.empty(len(column) + 2 * num_sents, dtype=object)
+    new_starts = np.cumsum(sent_lengths + 2) - (sent_lengths + 2)
+    token_sents = np.repeat(np.arange(num_sents), sent_lengths)
+    tagged[np.arange(len(column)) + 2 * token_sents + 1] = column
+    tagged[new_starts] = '<s>'
+    tagged[new_starts + sent_lengths + 1] = '</s>'
+    return tagged
+
+
+def read_conll_columns(
+    files: Union[str, Path, Iterable[Union[str, Path]]],
+    cols: Sequence[str],
+    tags: bool = False,
+) -> ConllColumns:
+    """Read columns from one or more CoNLL files into flat arrays.
+
+    This is a faster alternative to conll_reader when the tokens are
+    needed as flat sequences rather than one tuple per token.
+
+    Args:
+        files: The CoNLL file or files to read from
+        cols: The columns to read
+        tags: Whether to include start and end tags around sentences.
+            The tags are '<s>' and '</s>' regardless of column.
+
+    Returns:
+        A ConllColumns tuple where columns maps each column name to an
+        object array of all tokens in all files, sent_offsets holds the
+        start of each sentence and the end of the last, and doc_offsets
+        the start of each file and the end of the last.
+    """
+    if isinstance(files, (str, Path)):
+        files = [files]
+    try:
+        col_idx = [conll_cols.index(c) for c in cols]
+    except ValueError:
+        raise ValueError('All column names must be one of %s' % set(conll_cols))
+
+    tables = []
+    all_sent_lengths = []
+    doc_lengths = []
+    for file in files:
+        table, sent_lengths = _read_conll_file(Path(file))
+        tables.append(table[:, col_idx])
+        all_sent_lengths.extend(sent_lengths)
+        doc_lengths.append(len(table) + (2 * len(sent_lengths) if tags else 0))
+    if tables:
+        table = np.concatenate(tables)
+    else:
+        table = np.empty((0, len(col_idx)), dtype=object)
+
+    sent_lengths = np.array(all_sent_lengths, dtype=np.int64)
+    if tags:
+        columns = {c: _add_sentence_tags(table[:, i], sent_lengths) for i, c in enumerate(cols)}
+        sent_lengths = sent_lengths + 2
+    else:
+        columns = {c: table[:, i] for i, c in enumerate(cols)}
+    sent_offsets = np.concatenate([[0], np.cumsum(sent_lengths)]).astype(np.int64)
+    doc_offsets = np.concatenate([[0], np.cumsum(doc_lengths)]).astype(np.int64)
+    return ConllColumns(columns, sent_offsets, doc_offsets)
 
 
 def get_split_len(split: str) -> int:
     """Return the number of documents in the split."""
-    if split == 'train':
-        return 966
-    elif split in ('dev', 'test'):
-        return 123
-    elif split == "norsk":
-        return 200
-    raise ValueError(
-        "Unrecognized split '%s', should be 'train', 'dev' or 'test'" % split
-    )
+    if not is_valid_split(split):
+        raise ValueError(
+            "Unrecognized split '%s', should be 'train', 'dev', 'test' or a fold" % split
+        )
+    return get_metadata_index().split_len(split)
 
 
 def get_file_name(name: str) -> str:
@@ -320,6 +577,26 @@ def get_file_name(name: str) -> str:
     return name + '-' + timestamp
 
 
+@contextmanager
+def atomic_write(path: Path) -> Iterator[BinaryIO]:
+    """Write a file through a temporary file that replaces path when done.
+
+    Readers never see a partially written file, and path is left as it
+    was if writing fails. Missing parent folders are created.
+    """
+    if not path.parent.is_dir():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('%s.%d.tmp' % (path.name, os.getpid()))
+    try:
+        with tmp_path.open('wb') as f:
+            yield f
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    os.replace(str(tmp_path), str(path))
+
+
 def save_model(name: str, model, w2i, pos2i=None):
     if not MODEL_DIR.is_dir():
         MODEL_DIR.mkdir()
@@ -0,0 +1,136 @@
+"""Word vectors in a native format that is memory mapped instead of unpickled.
+
+Loading Gensim keyed vectors imports Gensim, which is slow, and gives
+every process its own normalized copy of the vectors. The native format
+is two NumPy files:
+
+    <name>.npy        Unit-normalized float32 vectors, one row per word
+    <name>.vocab.npy  The words of the rows
+
+Both are loaded with np.load(mmap_mode='r'), so processes on the same
+node share the pages of the vectors through the OS cache.
+
+Convert Gensim vectors with:
+
+    python -m masterthesis.vectors models/vectors/120-small.pkl
+"""
+import argparse
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union  # noqa: F401
+
+import numpy as np
+
+from masterthesis.utils import atomic_write
+
+VOCAB_SUFFIX = '.vocab.npy'
+
+
+class Vectors:
+    """Word vectors with the lookup methods of Gensim keyed vectors that we use.
+
+    Args:
+        words: The word of each row
+        vectors: Unit-normalized vectors, one row per word
+    """
+
+    def __init__(self, words: np.ndarray, vectors: np.ndarray) -> None:
+        if len(words) != len(vectors):
+            raise ValueError('%d words for %d vectors' % (len(words), len(vectors)))
+        self.words = words
+        self.vectors = vectors
+        self._key_to_index = None  # type: Optional[Dict[str, int]]
+
+    @property
+    def vector_size(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def key_to_index(self) -> Dict[str, int]:
+        if self._key_to_index is None:
+            self._key_to_index = {word: idx for idx, word in enumerate(self.words.tolist())}
+        return self._key_to_index
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.key_to_index
+
+    def get_vector(self, word: str) -> np.ndarray:
+        return self.vectors[self.key_to_index[word]]
+
+    __getitem__ = get_vector
+    word_vec = get_vector
+
+
+def vocab_path(path: Path) -> Path:
+    return path.with_name(path.stem + VOCAB_SUFFIX)
+
+
+def is_native(path: Union[Path, str]) -> bool:
+    """Whether the path is of vectors in the native format."""
+    path = Path(path)
+    return path.suffix == '.npy' and not path.name.endswith(VOCAB_SUFFIX)
+
+
+def unit_normalize(vectors: np.ndarray) -> np.ndarray:
+    """Return float32 copies of the vectors with length 1, keeping zero vectors."""
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def save_vectors(path: Path, words: Iterable[str], vectors: np.ndarray) -> None:
+    """Save vectors in the native format, normalizing them to unit length."""
+    words = np.array(list(words), dtype=str)
+    vectors = unit_normalize(vectors)
+    if len(words) != len(vectors):
+        raise ValueError('%d words for %d vectors' % (len(words), len(vectors)))
+    if not path.parent.is_dir():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    # Write the vocabulary first, as the vectors file marks a complete save
+    with atomic_write(vocab_path(path)) as f:
+        np.save(f, words, allow_pickle=False)
+    with atomic_write(path) as f:
+        np.save(f, vectors, allow_pickle=False)
+
+
+def load_vectors(path: Union[Path, str]) -> Vectors:
+    """Memory map vectors in the native format."""
+    path = Path(path)
+    words = np.load(str(vocab_path(path)), mmap_mode='r', allow_pickle=False)
+    vectors = np.load(str(path), mmap_mode='r', allow_pickle=False)
+    return Vectors(words, vectors)
+
+
+def convert(input_path: Path, output_path: Optional[Path] = None) -> Path:
+    """Convert Gensim keyed vectors to the native format.
+
+    Returns:
+        The path of the native vectors, by default the input path with
+        the suffix .npy.
+    """
+    from gensim.models.keyedvectors import KeyedVectors
+
+    if output_path is None:
+        output_path = input_path.with_suffix('.npy')
+    kv = KeyedVectors.load(str(input_path))
+    kv = getattr(kv, 'wv', kv)
+    # Gensim 4 and Gensim 3 names of the word of each row
+    words = kv.index_to_key if hasattr(kv, 'index_to_key') else kv.index2word
+    save_vectors(output_path, words, kv.vectors)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert Gensim vectors to the native format')
+    parser.add_argument('input', type=Path)
+    parser.add_argument('output', type=Path, nargs='?')
+    args = parser.parse_args()
+    output_path = convert(args.input, args.output)
+    print('Saved %s and %s' % (output_path, vocab_path(output_path)))
+
+
+if __name__ == '__main__':
+    main()
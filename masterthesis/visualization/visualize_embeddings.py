@@ -1,25 +1,18 @@
 import argparse
 import logging
 from pathlib import Path
-import pickle
-from typing import Iterable
 
-from keras.models import load_model, Model
 import numpy as np
 import seaborn as sns
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
-import tqdm
 
-from masterthesis.features.build_features import pos_to_sequences, words_to_sequences
-from masterthesis.gensim_utils import fingerprint, load_embeddings
+from masterthesis.features.fingerprints import Fingerprints, WEIGHTINGS
+from masterthesis.models.utils import get_model_representations
 from masterthesis.utils import (
     CEFR_LABELS,
-    DATA_DIR,
-    document_iterator,
     iso639_3,
     load_split,
-    REPRESENTATION_LAYER,
     safe_plt as plt,
 )
 
@@ -52,48 +45,25 @@ def parse_args() -> argparse.Namespace:
         '--quiet', dest='loglevel', action='store_const', const=logging.WARN
     )
     parser.add_argument('--split', choices={'train', 'dev', 'test'}, default='dev')
+    parser.add_argument('--weighting', choices=set(WEIGHTINGS), default='uniform')
     parser.set_defaults(loglevel=logging.INFO)
     args = parser.parse_args()
     logging.getLogger(None).setLevel(args.loglevel)
     return args
 
 
-def get_fingerprints(embeddings: Path, filenames: Iterable[str]) -> np.ndarray:
-    wv = load_embeddings(embeddings)
-    txt_folder = DATA_DIR / 'txt'
-    fingerprints = []
+def get_fingerprints(embeddings: Path, split: str, weighting: str = 'uniform') -> np.ndarray:
     logger.info("Computing fingerprints of all documents ...")
-    for filename in tqdm.tqdm(filenames):
-        infile = txt_folder / Path(filename).with_suffix('.txt')
-        with open(str(infile), encoding='utf-8') as f:
-            fingerprints.append(fingerprint(wv, document_iterator(f)))
-    return np.stack(fingerprints)
-
-
-def get_model_representations(model_path: Path, split: str) -> np.ndarray:
-    model = load_model(str(model_path))
-    representation_model = Model(
-        inputs=model.input, outputs=model.get_layer(REPRESENTATION_LAYER).output
-    )
-    logger.debug(model.input)
-    w2i_path = model_path.parent / (model_path.stem + '_w2i.pkl')
-    w2i = pickle.load(w2i_path.open('rb'))
-    (x,) = words_to_sequences(700, [split], w2i)
-    if isinstance(model.input, list) and len(model.input) == 2:
-        pos2i_path = model_path.parent / ('pos2i.pkl')
-        pos2i = pickle.load(pos2i_path.open('rb'))
-        (x_pos,) = pos_to_sequences(700, [split], pos2i)
-        x = [x, x_pos]
-    return representation_model.predict(x)
+    return Fingerprints(embeddings, weighting).fingerprints(split)
 
 
 def main():
     args = parse_args()
     meta = load_split(args.split)
-    meta["lang"].replace(iso639_3, inplace=True)
+    meta["lang"] = meta["lang"].replace(iso639_3)
 
     if args.embeddings:
-        representations = get_fingerprints(args.embeddings, meta.filename)
+        representations = get_fingerprints(args.embeddings, args.split, args.weighting)
     elif args.model:
         representations = get_model_representations(args.model, args.split)
 
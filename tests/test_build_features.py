@@ -1,9 +1,23 @@
+from collections import Counter
 from pathlib import Path
 from unittest.mock import patch
 
+import numpy as np
 from numpy.testing import assert_equal
 
-from masterthesis.features.build_features import iterate_docs, iterate_tokens, words_to_sequences
+from masterthesis.data.corpus_store import compile_corpus_store
+from masterthesis.features.build_features import (
+    corpus_digest,
+    count_vocabularies,
+    encode_sequences,
+    file_to_sequence,
+    get_frequency_tables,
+    iterate_docs,
+    iterate_mixed_pos_tags,
+    iterate_tokens,
+    make_w2i,
+    words_to_sequences,
+)
 
 test_data_dir = Path(__file__).parent / 'test_data'
 test_doc_len = 21
@@ -48,3 +62,94 @@ def test_words_to_sequences(mock_load_split):
     assert_equal(t[0, :4], [2, 3, 4, 5])  # Dette er første linje
     assert_equal(t[0, 4:7], [1, 1, 1])  # i dokumentet .
     assert t[0, -1] == 0  # __PAD__
+
+
+def test_encode_sequences():
+    w2i = {"__PAD__": 0, "__UNK__": 1, "a": 2, "b": 3}
+    docs = [iter("a b c a".split()), iter([]), iter("b b".split())]
+    x = encode_sequences(docs, w2i, 3)
+    assert x.dtype == np.int16
+    assert_equal(x, [[2, 3, 1], [0, 0, 0], [3, 3, 0]])
+
+    big_w2i = {str(i): i for i in range(2, 40000)}
+    big_w2i.update(__PAD__=0, __UNK__=1)
+    x = encode_sequences([["39999", "x"]], big_w2i, 3)
+    assert x.dtype == np.int32
+    assert_equal(x, [[39999, 1, 0]])
+
+
+def test_file_to_sequence():
+    w2i = {"__PAD__": 0, "__UNK__": 1, "Dette": 2, "er": 3}
+    x = file_to_sequence(5, test_data_dir / 'txt' / 'sample_doc.txt', w2i)
+    assert_equal(x, [2, 3, 1, 1, 1])
+
+
+class ManyDocsMeta:
+    filename = ['sample_doc'] * 120
+
+
+@patch('masterthesis.features.build_features.get_stopwords', new=lambda: {'er', 'i'})
+@patch('masterthesis.features.build_features.load_split')
+@patch('masterthesis.features.build_features.data_folder', new=test_data_dir)
+def test_frequency_tables(mock_load_split, tmpdir):
+    mock_load_split.return_value = ManyDocsMeta()
+    sharded = count_vocabularies(jobs=2)
+    serial = count_vocabularies(jobs=1)
+    for kind in ('words', 'pos', 'mixed_pos'):
+        assert sharded[kind].most_common() == serial[kind].most_common()
+    assert sharded['mixed_pos'] == Counter(iterate_mixed_pos_tags())
+
+    with patch('masterthesis.features.build_features.vocab_folder', new=Path(str(tmpdir))):
+        tables = get_frequency_tables()
+        assert tables['words'] == Counter(iterate_tokens()).most_common()
+        with patch('masterthesis.features.build_features.count_vocabularies') as mock_count:
+            assert get_frequency_tables() == tables
+            w2i = make_w2i(4)
+        mock_count.assert_not_called()
+    assert w2i == {'__PAD__': 0, '__UNK__': 1, tables['words'][0][0]: 2, tables['words'][1][0]: 3}
+
+
+@patch('masterthesis.features.build_features.load_split')
+@patch('masterthesis.features.build_features.data_folder', new=test_data_dir)
+def test_count_vocabularies_in_pool_worker(mock_load_split):
+    mock_load_split.return_value = ManyDocsMeta()
+    with patch('multiprocessing.current_process') as mock_process, \
+            patch('multiprocessing.Pool') as mock_pool:
+        mock_process.return_value.daemon = True
+        counts = count_vocabularies()
+    mock_pool.assert_not_called()
+    assert counts['words'] == Counter(iterate_tokens())
+
+
+@patch('masterthesis.features.build_features.get_stopwords', new=lambda: {'er', 'i'})
+@patch('masterthesis.features.build_features.load_split')
+def test_corpus_digest(mock_load_split, tmpdir):
+    folder = Path(str(tmpdir))
+    (folder / 'txt').mkdir()
+    (folder / 'txt' / 'sample_doc.txt').write_text('Dette er en test .')
+    mock_load_split.return_value = MockMeta()
+    with patch('masterthesis.features.build_features.data_folder', new=folder), \
+            patch('masterthesis.features.build_features._corpus_digests', new={}) as digests:
+        digest = corpus_digest('train')
+        assert corpus_digest('train') == digest
+        assert mock_load_split.call_count == 1
+
+        # The same contents with a new modification time
+        (folder / 'txt' / 'sample_doc.txt').write_text('Dette er en test .')
+        digests.clear()
+        assert corpus_digest('train') == digest
+
+        (folder / 'txt' / 'sample_doc.txt').write_text('Dette er en lengre test .')
+        digests.clear()
+        changed = corpus_digest('train')
+        assert changed != digest
+
+        # Documents in the store are identified by its digest, not read
+        compile_corpus_store(folder)
+        digests.clear()
+        with patch.object(Path, 'read_bytes', side_effect=AssertionError):
+            stored = corpus_digest('train')
+        (folder / 'txt' / 'sample_doc.txt').write_text('Dette er en test .')
+        compile_corpus_store(folder)
+        digests.clear()
+        assert corpus_digest('train') not in {stored, digest, changed}
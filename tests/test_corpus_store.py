@@ -0,0 +1,53 @@
+from pathlib import Path
+from unittest.mock import patch
+
+from masterthesis.data.corpus_store import compile_corpus_store, open_corpus_store
+from masterthesis.features.build_features import (
+    iterate_docs,
+    iterate_mixed_pos_docs,
+    iterate_pos_docs,
+)
+
+test_data_dir = Path(__file__).parent / 'test_data'
+
+
+class MockMeta:
+    filename = ['sample_doc']
+
+
+def test_compile_corpus_store(tmpdir):
+    store_dir = compile_corpus_store(test_data_dir, Path(str(tmpdir)))
+    store = open_corpus_store(store_dir)
+    tokens = store.tokens('sample_doc', 'txt')
+    assert tokens[:4] == 'Dette er første linje'.split()
+    assert tokens[-4:] == 'har to setninger .'.split()
+    assert store.tokens('sample_doc', 'form') == tokens
+    assert store.tokens('sample_doc', 'upos')[:3] == ['PRON', 'AUX', 'ADJ']
+    assert not store.has('missing_doc', 'txt')
+
+
+def test_open_missing_store(tmpdir):
+    assert open_corpus_store(Path(str(tmpdir)) / 'store') is None
+
+
+@patch('masterthesis.features.build_features.get_stopwords', new=lambda: {'er', 'i'})
+@patch('masterthesis.features.build_features.load_split')
+def test_iterate_from_store(mock_load_split, tmpdir):
+    """Documents are read from the store when the files are not available."""
+    data_dir = Path(str(tmpdir))
+    compile_corpus_store(test_data_dir, data_dir / 'store')
+    mock_load_split.return_value = MockMeta()
+    with patch('masterthesis.features.build_features.data_folder', new=test_data_dir):
+        from_files = [
+            [list(d) for d in iterate_docs()],
+            [list(d) for d in iterate_pos_docs()],
+            [list(d) for d in iterate_mixed_pos_docs()],
+        ]
+    with patch('masterthesis.features.build_features.data_folder', new=data_dir):
+        from_store = [
+            [list(d) for d in iterate_docs()],
+            [list(d) for d in iterate_pos_docs()],
+            [list(d) for d in iterate_mixed_pos_docs()],
+        ]
+    assert from_store == from_files
+    assert from_store[2][0][:3] == ['PRON', 'er', 'ADJ']
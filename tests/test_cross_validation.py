@@ -0,0 +1,53 @@
+import argparse
+from unittest.mock import patch
+
+from masterthesis.models.cross_validation import (
+    _run_fold,
+    add_cv_args,
+    cross_validate,
+    fold_result,
+)
+from masterthesis.utils import load_split
+
+
+def _predict_majority(args):
+    """Predict the most common label in the train part for every dev document."""
+    train_meta = load_split(args.train_split, round_cefr=args.round_cefr)
+    dev_meta = load_split(args.dev_split, round_cefr=args.round_cefr)
+    labels = sorted(train_meta.cefr.unique())
+    majority = labels.index(train_meta.cefr.value_counts().idxmax())
+    true = [labels.index(c) for c in dev_meta.cefr]
+    return fold_result(dev_meta.filename, labels, true, [majority] * len(true))
+
+
+@patch('masterthesis.models.cross_validation.report')
+@patch('masterthesis.models.cross_validation.save_results')
+def test_cross_validate(mock_save_results, mock_report):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--round-cefr', action='store_true')
+    add_cv_args(parser)
+    args = parser.parse_args(['--cv-folds', '3', '--jobs', '2', '--round-cefr'])
+    true, pred = cross_validate(_predict_majority, args, 'test-cv')
+
+    meta = load_split('train,dev', round_cefr=True)
+    labels = sorted(meta.cefr.unique())
+    assert [labels[t] for t in true] == list(meta.cefr)
+    assert len(pred) == len(meta)
+    name, config, history, saved_true, saved_pred = mock_save_results.call_args[0]
+    assert name == 'test-cv'
+    assert len(history['fold_macro_f1']) == 3
+    assert (saved_pred == pred).all()
+
+
+def test_fold_args():
+    parser = argparse.ArgumentParser()
+    add_cv_args(parser)
+    parser.add_argument('--feature-jobs', type=int, default=1)
+    args = parser.parse_args(['--cv-folds', '5', '--jobs', '4', '--feature-jobs', '8'])
+    fold_args = _run_fold(lambda fold_args: fold_args, args, 2)
+    assert fold_args.train_split == 'cv-stratified-5-2-train'
+    assert fold_args.cv_folds is None
+    # Only the parent process starts pools
+    assert fold_args.jobs == 1
+    assert fold_args.feature_jobs == 1
+    assert args.feature_jobs == 8
@@ -0,0 +1,82 @@
+import hashlib
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+from gensim.models import KeyedVectors
+import numpy as np
+
+from masterthesis.models.utils import (
+    digest_path,
+    embedding_matrix,
+    file_digest,
+    load_embedding_matrix,
+)
+
+WORDS = ['__PAD__', '__UNK__', 'og', 'jeg', 'huset']
+
+
+def make_kv():
+    kv = KeyedVectors(4)
+    kv.add_vectors(WORDS[::-1], np.arange(20, dtype=np.float32).reshape(5, 4))
+    return kv
+
+
+class Vocab:
+    def __init__(self, index):
+        self.index = index
+
+
+class OldKeyedVectors:
+    """The parts of Gensim 3 keyed vectors that are used."""
+
+    def __init__(self, kv):
+        self.vocab = {word: Vocab(idx) for word, idx in kv.key_to_index.items()}
+        self.vectors = kv.vectors
+        self.vector_size = kv.vector_size
+
+    def get_vector(self, word):
+        raise KeyError(word)
+
+
+def test_embedding_matrix():
+    kv = make_kv()
+    w2i = {'__PAD__': 0, '__UNK__': 1, 'jeg': 2, 'ukjent': 3, 'huset': 4}
+    for vectors in (kv, OldKeyedVectors(kv)):
+        matrix = embedding_matrix(vectors, w2i)
+        assert matrix.dtype == np.float32
+        for word, idx in w2i.items():
+            if word == 'ukjent':
+                assert not matrix[idx].any()
+            else:
+                assert np.array_equal(matrix[idx], kv.get_vector(word))
+
+
+def test_embedding_matrix_is_cached(tmpdir):
+    folder = Path(str(tmpdir))
+    vector_path = folder / 'vectors.pkl'
+    vector_path.write_bytes(b'vectors')
+    w2i = {word: idx for idx, word in enumerate(WORDS)}
+    with patch('masterthesis.models.utils.embeddings_folder', new=folder / 'embeddings'):
+        with patch('masterthesis.gensim_utils.load_embeddings', return_value=make_kv()) as load:
+            first = load_embedding_matrix(vector_path, w2i)
+            second = load_embedding_matrix(vector_path, w2i)
+            assert load.call_count == 1
+            assert np.array_equal(first, second)
+
+            load_embedding_matrix(vector_path, dict(w2i, og=4, huset=2))
+            vector_path.write_bytes(b'other vectors')
+            load_embedding_matrix(vector_path, w2i)
+            assert load.call_count == 3
+
+
+def test_file_digest_is_memoized(tmpdir):
+    path = Path(str(tmpdir)) / 'vectors.bin'
+    path.write_bytes(b'vectors')
+    assert file_digest(path) == hashlib.sha1(b'vectors').hexdigest()
+    memo = json.loads(digest_path(path).read_text())
+    digest_path(path).write_text(json.dumps(dict(memo, sha1='memoized')))
+    assert file_digest(path) == 'memoized'
+
+    path.write_bytes(b'other vectors')
+    assert file_digest(path) == hashlib.sha1(b'other vectors').hexdigest()
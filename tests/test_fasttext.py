@@ -0,0 +1,99 @@
+from pathlib import Path
+from unittest.mock import patch
+import zipfile
+
+from gensim.models import FastText, KeyedVectors
+from gensim.models.fasttext import save_facebook_model
+from gensim.models.fasttext_inner import compute_ngrams_bytes, ft_hash_bytes
+import numpy as np
+
+from masterthesis.data.prepare_vectors import read_vectors
+from masterthesis.fasttext import EOS, FastTextDictionary, ngram_hashes, word_vectors
+from masterthesis.models.utils import load_embedding_matrix
+
+SENTENCES = [
+    ['jeg', 'bor', 'i', 'et', 'stort', 'hus'],
+    ['huset', 'er', 'fint', 'og', 'blåbær', 'er', 'søte'],
+] * 10
+WORDS = ['jeg', 'blåbær', 'ukjent', 'blåbærsyltetøy', 'x', '__PAD__']
+
+
+def train_fasttext(path):
+    model = FastText(vector_size=6, min_count=1, bucket=500, min_n=2, max_n=4, seed=0, workers=1)
+    model.build_vocab(SENTENCES)
+    model.train(SENTENCES, total_examples=len(SENTENCES), epochs=2)
+    save_facebook_model(model, str(path))
+    return model.wv
+
+
+def test_word_vectors(tmpdir):
+    path = Path(str(tmpdir)) / 'model.bin'
+    wv = train_fasttext(path)
+    with path.open('rb') as f:
+        words, vectors = word_vectors(f, WORDS)
+    assert words == WORDS
+    for word, vector in zip(words, vectors):
+        assert np.allclose(vector, wv[word], atol=1e-6)
+
+
+def test_ngram_hashes():
+    words = ['blåbær', 'a', '', 'ɛ̃', '日本語', EOS, 'huset']
+    word_idx, hashes = ngram_hashes(words, 1, 5)
+    for idx, word in enumerate(words):
+        expected = [] if word == EOS else [
+            ft_hash_bytes(ngram) for ngram in compute_ngrams_bytes(word, 1, 5)
+        ]
+        assert sorted(hashes[word_idx == idx].tolist()) == sorted(expected)
+
+
+def test_no_ngrams():
+    for minn, maxn in ((0, 0), (3, 0)):
+        word_idx, hashes = ngram_hashes(['ab', 'og'], minn, maxn)
+        assert not len(word_idx) and not len(hashes)
+    word_idx, rows = FastTextDictionary(['og'], 0, 0, 0).rows(['og', 'ukjent'])
+    assert word_idx.tolist() == [0]
+    assert rows.tolist() == [0]
+    word_idx, hashes = ngram_hashes(['ab'], 0, 2)
+    assert sorted(hashes.tolist()) == sorted(ngram_hashes(['ab'], 1, 2)[1].tolist())
+
+
+def test_pruned_rows():
+    hashes = [ft_hash_bytes(b'<h') % 100, ft_hash_bytes(b'us') % 100]
+    dictionary = FastTextDictionary(['og', 'huset'], 2, 2, 100, {hashes[0]: 0, hashes[1]: 1})
+    word_idx, rows = dictionary.rows(['hus', 'og'])
+    assert sorted(zip(word_idx.tolist(), rows.tolist())) == [(0, 2), (0, 3), (1, 0)]
+
+
+def test_embedding_matrix_from_fasttext(tmpdir):
+    folder = Path(str(tmpdir))
+    wv = train_fasttext(folder / 'model.bin')
+    w2i = {word: idx for idx, word in enumerate(WORDS)}
+    with patch('masterthesis.models.utils.embeddings_folder', new=folder / 'embeddings'):
+        matrix = load_embedding_matrix(folder / 'model.bin', w2i)
+    for word, idx in w2i.items():
+        expected = wv[word] / np.linalg.norm(wv[word])
+        assert np.allclose(matrix[idx], expected, atol=1e-6)
+
+
+def test_read_vectors(tmpdir):
+    folder = Path(str(tmpdir))
+    wv = train_fasttext(folder / 'parameters.bin')
+    kv = KeyedVectors(6)
+    kv.add_vectors(wv.index_to_key, wv.vectors)
+    kv.save_word2vec_format(str(folder / 'model.bin'), binary=True)
+    kv.save_word2vec_format(str(folder / 'model.txt'))
+    for name in ['parameters.bin', 'model.bin', 'model.txt']:
+        with zipfile.ZipFile(str(folder / (name + '.zip')), 'w') as archive:
+            archive.write(str(folder / name), name)
+
+    vocab = set(WORDS)
+    for path in [folder / 'model.bin', folder / 'model.txt',
+                 folder / 'model.bin.zip', folder / 'model.txt.zip']:
+        words, vectors = read_vectors(path, vocab)
+        assert sorted(words) == ['blåbær', 'jeg']
+        for word, vector in zip(words, vectors):
+            assert np.allclose(vector, wv[word], atol=1e-6)
+
+    words, vectors = read_vectors(folder / 'parameters.bin.zip', vocab)
+    assert words == sorted(vocab)
+    assert np.allclose(vectors, [wv[word] for word in words], atol=1e-6)
@@ -0,0 +1,82 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from masterthesis.features.fingerprints import Fingerprints, SIF_ALPHA
+from masterthesis.gensim_utils import fingerprint
+from masterthesis.vectors import load_vectors, save_vectors
+
+WORDS = ['jeg', 'bor', 'i', 'Oslo', 'huset', 'er', 'stort', 'og', 'fint', '.']
+DOCS = {
+    'train': [
+        ['jeg', 'bor', 'i', 'Oslo', '.'],
+        ['huset', 'er', 'stort', 'og', 'fint', '.', 'huset', 'er', 'mitt'],
+        ['jeg', 'er', 'i', 'huset', '.'],
+        ['og', 'og', 'og'],
+    ],
+    'dev': [['Oslo', 'er', 'fint', 'ukjent'], ['ukjent'], []],
+}
+
+
+def iterate_docs(split):
+    return (iter(doc) for doc in DOCS[split])
+
+
+@pytest.fixture
+def fingerprints(tmpdir):
+    folder = Path(str(tmpdir))
+    rng = np.random.RandomState(0)
+    # 'mitt' and 'ukjent' have no vector
+    save_vectors(folder / 'vectors.npy', WORDS, rng.normal(size=(len(WORDS), 5)))
+    with patch('masterthesis.features.fingerprints.iterate_docs', new=iterate_docs), \
+            patch('masterthesis.features.fingerprints.corpus_digest', new=lambda split: split), \
+            patch('masterthesis.models.utils.embeddings_folder', new=folder / 'embeddings'):
+        yield lambda weighting: Fingerprints(
+            folder / 'vectors.npy', weighting, folder=folder / 'fingerprints'
+        )
+
+
+def test_uniform(fingerprints):
+    wv = load_vectors(fingerprints('uniform').vector_path)
+    for split in ('train', 'dev'):
+        result = fingerprints('uniform').fingerprints(split)
+        assert result.shape == (len(DOCS[split]), 5)
+        for doc, row in zip(DOCS[split], result):
+            if any(token in wv for token in doc):
+                assert np.allclose(row, fingerprint(wv, doc), atol=1e-6)
+            else:
+                assert not row.any()
+
+
+def test_weightings(fingerprints):
+    wv = load_vectors(fingerprints('uniform').vector_path)
+    counts = {}
+    for doc in DOCS['train']:
+        for token in doc:
+            counts[token] = counts.get(token, 0) + 1
+    total = sum(counts.values())
+    doc = DOCS['dev'][0]
+    known = [token for token in doc if token in wv]
+
+    idf = [np.log(5 / (1 + sum(token in d for d in DOCS['train']))) + 1 for token in known]
+    expected = np.average([wv[token] for token in known], axis=0, weights=idf)
+    assert np.allclose(fingerprints('tfidf').fingerprints('dev')[0], expected, atol=1e-6)
+
+    sif = fingerprints('sif')
+    train = sif.fingerprints('train')
+    weights = [SIF_ALPHA / (SIF_ALPHA + counts[token] / total) for token in known]
+    average = np.average([wv[token] for token in known], axis=0, weights=weights)
+    component = np.linalg.svd(sif._average('train'), full_matrices=False)[2][0]
+    expected = average - average.dot(component) * component
+    assert np.allclose(sif.fingerprints('dev')[0], expected, atol=1e-6)
+    assert np.allclose(train.dot(component), 0, atol=1e-6)
+
+
+def test_fingerprints_are_cached(fingerprints):
+    first = fingerprints('tfidf').fingerprints('dev')
+    with patch('masterthesis.features.fingerprints.load_embedding_matrix') as load:
+        second = fingerprints('tfidf').fingerprints('dev')
+        assert not load.called
+    assert np.array_equal(first, second)
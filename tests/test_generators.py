@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from masterthesis.models.generators import (
+    BatchSequence,
+    BucketedSequence,
+    predict,
+    SparseBatchSequence,
+)
+
+
+def padded_docs(lengths, seq_len=12, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.zeros((len(lengths), seq_len), dtype=np.int32)
+    for row, length in enumerate(lengths):
+        x[row, :length] = rng.randint(1, 50, length)
+    return x
+
+
+class SumModel:
+    """Predicts the sum of the ids of each document, and their number."""
+
+    def predict_on_batch(self, x):
+        words, pos = x
+        return [words.sum(axis=1, keepdims=True), (pos > 0).sum(axis=1, keepdims=True)]
+
+    def predict(self, x):
+        return self.predict_on_batch(x)
+
+
+def test_bucketed_sequence():
+    lengths = [3, 12, 0, 5, 7, 3, 1, 12, 6, 2]
+    words = padded_docs(lengths)
+    pos = padded_docs(lengths, seed=1)
+    y = np.arange(len(lengths))
+    seq = BucketedSequence([words, pos], [y, 2 * y], batch_size=3, min_length=2, seed=0)
+    assert len(seq) == 4
+    seen = []
+    for idx in range(len(seq)):
+        (batch_words, batch_pos), (batch_y, batch_y2) = seq[idx]
+        assert batch_words.shape == batch_pos.shape
+        width = max(max(lengths[i] for i in batch_y), 2)
+        assert batch_words.shape[1] == width
+        assert np.array_equal(batch_words, words[batch_y, :width])
+        assert np.array_equal(batch_y2, 2 * batch_y)
+        seen.extend(batch_y)
+    assert sorted(seen) == list(range(len(lengths)))
+    assert [lengths[i] for i in seen] == sorted(lengths)
+
+    seq.on_epoch_end()
+    assert sorted(np.concatenate(seq.batches)) == list(range(len(lengths)))
+
+    single = BucketedSequence(words, batch_size=4)
+    assert single[0].shape == (4, 3)
+
+
+def test_predict_in_order():
+    lengths = [4, 1, 9, 0, 12, 3, 3]
+    words = padded_docs(lengths)
+    pos = padded_docs(lengths, seed=2)
+    sums, counts = predict(SumModel(), BucketedSequence([words, pos], batch_size=2))
+    assert sums.ravel().tolist() == words.sum(axis=1).tolist()
+    assert counts.ravel().tolist() == lengths
+
+
+class DenseCheckModel:
+    def predict_on_batch(self, x):
+        assert isinstance(x, np.ndarray)
+        assert x.dtype == np.float32
+        return x.sum(axis=1, keepdims=True)
+
+
+def test_sparse_batch_sequence():
+    x = sp.random(11, 40, density=0.2, format='csr', random_state=3, dtype=np.float64) * 10
+    y = np.arange(11)
+    seq = SparseBatchSequence(x, y, batch_size=4, seed=1)
+    assert len(seq) == 3
+    seen = []
+    for idx in range(len(seq)):
+        batch_x, batch_y = seq[idx]
+        assert batch_x.dtype == np.float32
+        assert np.allclose(batch_x, x[batch_y].toarray())
+        seen.extend(batch_y)
+    assert sorted(seen) == list(range(11))
+
+    sums = predict(DenseCheckModel(), SparseBatchSequence(x, batch_size=3))
+    assert np.allclose(sums.ravel(), np.asarray(x.sum(axis=1)).ravel())
+
+
+def test_batch_sequence_is_abstract():
+    class NoInputs(BatchSequence):
+        pass
+
+    with pytest.raises(TypeError):
+        NoInputs(np.zeros((4, 3)))
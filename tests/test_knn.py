@@ -0,0 +1,97 @@
+from argparse import Namespace
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from masterthesis.models.knn import index_path, IVFIndex, KnnScorer, load_or_build
+
+
+def clustered(num_clusters=6, size=40, dim=16, seed=0):
+    """Points around the same centers for every seed."""
+    centers = np.random.RandomState(num_clusters).normal(size=(num_clusters, dim)) * 3
+    labels = np.repeat(np.arange(num_clusters), size)
+    noise = np.random.RandomState(seed).normal(size=(len(labels), dim))
+    return centers[labels] + noise, labels
+
+
+def brute_force(vectors, queries, k):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    sims = queries.dot(vectors.T)
+    ids = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+    return 1 - np.take_along_axis(sims, ids, axis=1), ids
+
+
+def test_exhaustive_search_is_exact():
+    vectors, __ = clustered()
+    queries, __ = clustered(seed=1)
+    index = IVFIndex.build(vectors, num_lists=5, num_probes=5)
+    distances, ids = index.search(queries, 7)
+    expected_distances, expected_ids = brute_force(vectors, queries, 7)
+    assert np.allclose(distances, expected_distances, atol=1e-5)
+    assert np.array_equal(ids, expected_ids)
+    assert sorted(index.ids.tolist()) == list(range(len(vectors)))
+
+
+def test_probed_search():
+    vectors, __ = clustered(num_clusters=12)
+    queries, __ = clustered(num_clusters=12, seed=1)
+    index = IVFIndex.build(vectors, num_lists=12, num_probes=3)
+    __, ids = index.search(queries, 5)
+    __, expected_ids = brute_force(vectors, queries, 5)
+    recall = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(ids, expected_ids)])
+    assert recall > 0.95
+
+    __, ids = IVFIndex.build(vectors[:3], num_lists=1).search(queries[:2], 5)
+    assert (ids[:, 3:] == -1).all()
+
+
+def test_knn_scorer(tmpdir):
+    vectors, labels = clustered()
+    names = np.array(['doc%d' % i for i in range(len(vectors))])
+    scorer = KnnScorer(IVFIndex.build(vectors, num_probes=2), labels, names, k=5)
+    queries, query_labels = clustered(seed=1)
+    prediction = scorer.predict(queries)
+    assert np.mean(prediction.labels == query_labels) > 0.95
+    assert prediction.neighbours.shape == (len(queries), 5)
+    assert (np.diff(prediction.distances, axis=1) >= 0).all()
+
+    path = Path(str(tmpdir)) / 'model_knn.npz'
+    scorer.save(path)
+    loaded = KnnScorer.load(path)
+    assert loaded.k == 5
+    reloaded = loaded.predict(queries)
+    assert np.array_equal(reloaded.labels, prediction.labels)
+    assert np.array_equal(reloaded.neighbours, prediction.neighbours)
+
+
+def test_load_or_build(tmpdir):
+    vectors, labels = clustered()
+    names = ['doc%d' % i for i in range(len(vectors))]
+    train_meta = pd.DataFrame({'filename': names, 'cefr': np.array(['A2', 'B1', 'B2'])[labels % 3]})
+    args = Namespace(
+        model=Path(str(tmpdir)) / 'rnn-1_model.h5',
+        k=5,
+        num_lists=None,
+        num_probes=2,
+        rebuild=False,
+        train_split='train',
+    )
+    with patch('masterthesis.models.knn.representations', return_value=vectors) as reps:
+        scorer = load_or_build(args, train_meta, ['A2', 'B1', 'B2'])
+        assert index_path(args).is_file()
+        args.k = 3
+        loaded = load_or_build(args, train_meta, ['A2', 'B1', 'B2'])
+        assert reps.call_count == 1
+        assert loaded.k == 3
+        assert loaded.label_names == ['A2', 'B1', 'B2']
+        assert np.array_equal(loaded.index.ids, scorer.index.ids)
+
+        # A different training split or labelling, or --rebuild
+        load_or_build(args, train_meta[:-1], ['A2', 'B1', 'B2'])
+        load_or_build(args, train_meta, ['B2', 'B1', 'A2'])
+        args.rebuild = True
+        load_or_build(args, train_meta, ['A2', 'B1', 'B2'])
+        assert reps.call_count == 4
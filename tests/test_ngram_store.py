@@ -0,0 +1,150 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+
+from masterthesis.features.build_features import bag_of_words
+from masterthesis.features.ngram_store import (
+    hashed_features,
+    iterate_documents,
+    NgramStore,
+    vectorizer_params,
+)
+from masterthesis.features.vectorize import count_vectorize, transform_counts
+
+WORDS = {
+    'jeg': 'PRON',
+    'er': 'AUX',
+    'Glad': 'ADJ',
+    'bor': 'VERB',
+    'i': 'ADP',
+    'Oslo': 'PROPN',
+    'huset': 'NOUN',
+    'og': 'CCONJ',
+    'på': 'ADP',
+    'skolen': 'NOUN',
+    '.': 'PUNCT',
+}
+SPLITS = {'train': ['doc%d' % i for i in range(8)], 'dev': ['doc8', 'doc9']}
+PARAMS = {
+    'pos': dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(2, 4)),
+    'mix': dict(lowercase=False, token_pattern=r"[^\s]+", ngram_range=(1, 3)),
+    'char': dict(analyzer='char', ngram_range=(1, 3)),
+    'bow': dict(token_pattern=r"[^\s]+", lowercase=False),
+}
+
+
+class Meta:
+    def __init__(self, split, round_cefr=False):
+        self.filename = SPLITS[split]
+
+
+def write_corpus(folder: Path) -> None:
+    """Write random txt and CoNLL documents for the documents in SPLITS."""
+    rng = np.random.RandomState(4)
+    words = sorted(WORDS)
+    (folder / 'txt').mkdir()
+    (folder / 'conll').mkdir()
+    for doc in SPLITS['train'] + SPLITS['dev']:
+        sents = [list(rng.choice(words, rng.randint(1, 12))) for __ in range(rng.randint(1, 5))]
+        txt = '\n\n'.join(' '.join(sent) + '  ' * rng.randint(2) for sent in sents) + '\n'
+        (folder / 'txt' / (doc + '.txt')).write_text(txt, encoding='utf-8')
+        conll = ''.join(
+            ''.join(
+                '\t'.join([str(i), w, w, WORDS[w], '_', '_', '0', 'dep', '_', '_']) + '\n'
+                for i, w in enumerate(sent, start=1)
+            )
+            + '\n'
+            for sent in sents
+        )
+        (folder / 'conll' / (doc + '.conll')).write_text(conll, encoding='utf-8')
+
+
+@pytest.fixture
+def corpus(tmpdir):
+    folder = Path(str(tmpdir))
+    write_corpus(folder)
+    with patch('masterthesis.features.build_features.data_folder', new=folder), patch(
+        'masterthesis.features.build_features.load_split', new=Meta
+    ), patch('masterthesis.features.ngram_store.load_split', new=Meta), patch(
+        'masterthesis.features.build_features.get_stopwords', new=lambda: {'i', 'og', 'er'}
+    ):
+        yield folder
+
+
+@pytest.mark.parametrize('kind', sorted(PARAMS))
+def test_store_matches_count_vectorizer(corpus, kind):
+    for max_features in (None, 20, 3):
+        store = NgramStore(kind, PARAMS[kind], folder=corpus / 'ngrams')
+        (train_x, dev_x), names = store.features(['train', 'dev'], max_features)
+        vectorizer = CountVectorizer(
+            max_features=max_features, **vectorizer_params(kind, PARAMS[kind])
+        )
+        expected_train = vectorizer.fit_transform(iterate_documents(kind, 'train'))
+        expected_dev = vectorizer.transform(iterate_documents(kind, 'dev'))
+        vocabulary = vectorizer.vocabulary_
+        assert names.tolist() == sorted(vocabulary, key=vocabulary.__getitem__)
+        assert (train_x != expected_train).nnz == 0
+        assert (dev_x != expected_dev).nnz == 0
+
+    (train_x,), __ = store.features(['train'], min_df=2, max_df=0.9)
+    vectorizer = CountVectorizer(min_df=2, max_df=0.9, **vectorizer_params(kind, PARAMS[kind]))
+    assert (train_x != vectorizer.fit_transform(iterate_documents(kind, 'train'))).nnz == 0
+
+
+@pytest.mark.parametrize('kind', ['char', 'mix', 'pos'])
+def test_store_counts_without_count_vectorizer(corpus, kind):
+    store = NgramStore(kind, PARAMS[kind], folder=corpus / 'ngrams')
+    with patch('masterthesis.features.ngram_store.fit_counts') as mock_fit:
+        with patch('masterthesis.features.ngram_store.transform_counts') as mock_transform:
+            store.features(['train', 'dev'])
+    mock_fit.assert_not_called()
+    mock_transform.assert_not_called()
+
+
+def test_store_is_reused(corpus):
+    NgramStore('bow', PARAMS['bow'], folder=corpus / 'ngrams').features(['train', 'dev'])
+    store = NgramStore('bow', PARAMS['bow'], folder=corpus / 'ngrams')
+    with patch.object(store, '_fit') as mock_fit:
+        with patch.object(store, '_transform') as mock_transform:
+            (train_x, dev_x), names = store.features(['train', 'dev'], 5)
+    mock_fit.assert_not_called()
+    mock_transform.assert_not_called()
+    assert train_x.shape == (8, 5)
+    assert dev_x.shape == (2, 5)
+
+
+@pytest.mark.parametrize('kind', sorted(PARAMS))
+def test_hashed_features(corpus, kind):
+    train_x, dev_x = hashed_features(kind, PARAMS[kind], 64, ['train', 'dev'], chunk_size=3)
+    params = vectorizer_params(kind, PARAMS[kind])
+    vectorizer = HashingVectorizer(n_features=64, norm=None, **params)
+    assert train_x.shape == (8, 64)
+    for x, split in ((train_x, 'train'), (dev_x, 'dev')):
+        expected = vectorizer.transform(iterate_documents(kind, split))
+        assert np.allclose(x.toarray(), expected.toarray())
+
+
+@pytest.mark.parametrize('kind', sorted(PARAMS))
+def test_sharded_count_vectorize(corpus, kind):
+    params = vectorizer_params(kind, PARAMS[kind])
+    docs = list(iterate_documents(kind, 'train'))
+    for max_features in (None, 10):
+        x, vectorizer = count_vectorize(docs, jobs=3, max_features=max_features, **params)
+        expected = CountVectorizer(max_features=max_features, **params)
+        expected_x = expected.fit_transform(docs)
+        assert vectorizer.vocabulary_ == expected.vocabulary_
+        assert (x != expected_x).nnz == 0
+
+    dev_docs = list(iterate_documents(kind, 'dev'))
+    dev_x = transform_counts(dev_docs, sorted(expected.vocabulary_), jobs=2, **params)
+    assert (dev_x != expected.transform(dev_docs)).nnz == 0
+
+
+def test_sharded_bag_of_words(corpus):
+    x, vectorizer = bag_of_words('train', jobs=4, analyzer='char', ngram_range=(2, 4))
+    expected_x, expected = bag_of_words('train', analyzer='char', ngram_range=(2, 4))
+    assert vectorizer.vocabulary_ == expected.vocabulary_
+    assert (x != expected_x).nnz == 0
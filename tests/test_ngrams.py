@@ -0,0 +1,89 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer
+
+from masterthesis.features.ngrams import (
+    count_char_ngrams,
+    count_token_ngrams,
+    pack_ngrams,
+    PackingError,
+    transform_char_ngrams,
+    transform_token_ngrams,
+)
+
+TAGS = ['AD', 'ADJ', 'ADP', 'NOUN', 'PRON', 'PUNCT', 'VERB', 'å', 'Ø', 'ø']
+
+
+def random_docs(seed, num_docs, tags=TAGS):
+    rng = np.random.RandomState(seed)
+    # Include empty documents and documents shorter than the n-grams
+    return [list(rng.choice(tags, rng.randint(0, 15))) for __ in range(num_docs)]
+
+
+@pytest.mark.parametrize('ngram_range', [(1, 1), (2, 4), (1, 3), (3, 3)])
+@pytest.mark.parametrize('tags', [TAGS, TAGS + ['A\x01']])
+def test_count_token_ngrams(ngram_range, tags):
+    docs = random_docs(0, 30, tags)
+    x, names = count_token_ngrams(docs, ngram_range)
+    vectorizer = CountVectorizer(lowercase=False, token_pattern=r"[^\s]+", ngram_range=ngram_range)
+    expected_x = vectorizer.fit_transform(' '.join(doc) for doc in docs)
+    vocabulary = vectorizer.vocabulary_
+    assert names.tolist() == sorted(vocabulary, key=vocabulary.__getitem__)
+    assert x.dtype == expected_x.dtype
+    assert (x != expected_x).nnz == 0
+
+    dev_docs = random_docs(1, 10) + [['NUM', 'NOUN', 'NUM'], ['X Y', 'ADJ']]
+    dev_x = transform_token_ngrams(dev_docs, names, ngram_range)
+    assert (dev_x != vectorizer.transform(' '.join(doc) for doc in dev_docs)).nnz == 0
+
+
+def test_count_token_ngrams_with_large_keys():
+    docs = random_docs(2, 30)
+    expected_x, expected_names = count_token_ngrams(docs, (1, 3))
+    # Too small to add the document to the keys
+    with patch('masterthesis.features.ngrams.MAX_KEY', new=len(TAGS) ** 4):
+        x, names = count_token_ngrams(docs, (1, 3))
+    assert names.tolist() == expected_names.tolist()
+    assert (x != expected_x).nnz == 0
+
+
+TEXTS = [
+    'Jeg bor i Oslo.\n\nDet er  fint her!\r\n',
+    'ÆØÅ æøå\tog\t\tnoe 🙂 mer',
+    '',
+    'a',
+]
+
+
+@pytest.mark.parametrize('ngram_range', [(1, 1), (2, 4), (1, 3)])
+@pytest.mark.parametrize('lowercase', [True, False])
+def test_count_char_ngrams(ngram_range, lowercase):
+    x, names = count_char_ngrams(TEXTS, ngram_range, lowercase)
+    vectorizer = CountVectorizer(analyzer='char', ngram_range=ngram_range, lowercase=lowercase)
+    expected_x = vectorizer.fit_transform(TEXTS)
+    vocabulary = vectorizer.vocabulary_
+    assert names.tolist() == sorted(vocabulary, key=vocabulary.__getitem__)
+    assert (x != expected_x).nnz == 0
+
+    dev_texts = TEXTS[:2] + ['Helt  nye tegn: ß§', '\n']
+    dev_x = transform_char_ngrams(dev_texts, names, ngram_range, lowercase)
+    assert (dev_x != vectorizer.transform(dev_texts)).nnz == 0
+
+
+def test_empty_documents():
+    with pytest.raises(ValueError):
+        count_token_ngrams([[], ['NOUN']], (2, 2))
+    dev_x = transform_token_ngrams([[], ['VERB']], np.array(['NOUN'], dtype=str))
+    assert dev_x.shape == (2, 1)
+    assert dev_x.nnz == 0
+
+
+def test_pack_ngrams():
+    ids = np.array([1, 2, 3, 4, 5])
+    docs, keys = pack_ngrams(ids, np.array([0, 3, 5]), (2, 3), 6)
+    assert docs.tolist() == [0, 0, 1, 0]
+    assert keys.tolist() == [1 * 36 + 2 * 6, 2 * 36 + 3 * 6, 4 * 36 + 5 * 6, 1 * 36 + 2 * 6 + 3]
+    with pytest.raises(PackingError):
+        pack_ngrams(ids, np.array([0, 5]), (1, 4), 2 ** 16)
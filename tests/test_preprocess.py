@@ -0,0 +1,64 @@
+import json
+from pathlib import Path
+import shutil
+from unittest.mock import patch
+
+from masterthesis.data.preprocess import (
+    extract_document,
+    file_digest,
+    is_fresh,
+    load_cache,
+    save_cache,
+)
+
+test_xml = Path(__file__).parent / 'test_data' / 'xml' / 'sample_doc.xml'
+
+
+def test_extract_document(tmpdir):
+    output_dir = Path(str(tmpdir))
+    row = extract_document(test_xml, output_dir, output=True)
+    assert row['lang'] == 'engelsk'
+    assert row['cefr'] == 'B1/B2'
+    assert row['age'] == 27
+    assert row['title'] == 'Min helse'
+    assert row['num_tokens'] == 12
+    text = (output_dir / 'sample_doc.txt').read_text(encoding='utf-8')
+    assert text == 'Min helse\n\nJeg er frisk .\nDet er bra .\n\nTakk .\n'
+
+    row = extract_document(test_xml, output_dir, output=False)
+    assert row['num_tokens'] == 13  # Counts every word element
+
+
+def test_is_fresh(tmpdir):
+    xml_dir = Path(str(tmpdir)) / 'xml'
+    xml_dir.mkdir()
+    input_file = xml_dir / test_xml.name
+    shutil.copy(str(test_xml), str(input_file))
+    entry = {
+        'sha1': file_digest(input_file),
+        'mtime': input_file.stat().st_mtime - 10,
+        'output': False,
+        'row': {},
+    }
+    assert is_fresh(entry, input_file)
+    assert entry['mtime'] == input_file.stat().st_mtime
+    assert not is_fresh(entry, input_file, Path(str(tmpdir)) / 'sample_doc.txt')
+    assert not is_fresh(None, input_file)
+
+    entry['sha1'] = 'changed'
+    entry['mtime'] = 0
+    assert not is_fresh(entry, input_file)
+
+
+def test_cache_version(tmpdir):
+    cache_file = Path(str(tmpdir)) / 'xml-cache.json'
+    entries = {'sample_doc': {'sha1': 'abc', 'mtime': 1.0, 'output': False, 'row': {}}}
+    with patch('masterthesis.data.preprocess.CACHE_FILE', new=cache_file):
+        assert load_cache() == {}
+        save_cache(entries)
+        assert load_cache() == entries
+        with patch('masterthesis.data.preprocess.CACHE_VERSION', new=2):
+            assert load_cache() == {}
+        # Caches from before the version field
+        cache_file.write_text(json.dumps(entries))
+        assert load_cache() == {}
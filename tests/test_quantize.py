@@ -0,0 +1,58 @@
+from pathlib import Path
+
+from keras.layers import Conv1D, Dense, Embedding, GlobalMaxPooling1D, Input, LSTM
+from keras.models import Model
+import numpy as np
+
+from masterthesis.models.quantize import (
+    is_quantized,
+    load_quantized,
+    original_stem,
+    quantize_int8,
+    quantized_path,
+    save_quantized,
+)
+
+
+def make_model():
+    inputs = Input(shape=(12,), dtype='int32')
+    embedded = Embedding(50, 8)(inputs)
+    conv = Conv1D(6, 3)(embedded)
+    hidden = LSTM(4, return_sequences=True)(conv)
+    output = Dense(1, activation='sigmoid')(GlobalMaxPooling1D()(hidden))
+    return Model(inputs=inputs, outputs=output)
+
+
+def test_quantize_int8():
+    weights = np.random.RandomState(0).normal(size=(5, 3)).astype(np.float32)
+    weights[:, 1] = 0
+    quantized = quantize_int8(weights, axis=-1)
+    assert quantized['values'].dtype == np.int8
+    assert quantized['scale'].shape == (1, 3)
+    restored = quantized['values'] * quantized['scale']
+    assert np.allclose(restored, weights, atol=quantized['scale'].max() / 2)
+    assert not restored[:, 1].any()
+    assert np.abs(quantized['values']).max(axis=0).tolist() == [127, 0, 127]
+    assert quantize_int8(weights, axis=0)['scale'].shape == (5, 1)
+
+
+def test_save_and_load_quantized(tmpdir):
+    model = make_model()
+    x = np.random.RandomState(1).randint(0, 50, size=(16, 12))
+    expected = model.predict(x, verbose=0)
+    model_path = Path(str(tmpdir)) / 'cnn-123_model.h5'
+    for dtype, tolerance in (('float16', 1e-3), ('int8', 2e-2)):
+        path = quantized_path(model_path, dtype)
+        save_quantized(model, path, dtype)
+        assert is_quantized(path)
+        assert original_stem(path) == 'cnn-123_model'
+        loaded = load_quantized(path)
+        for weight, original, restored in zip(
+            model.weights, model.get_weights(), loaded.get_weights()
+        ):
+            assert restored.dtype == np.float32
+            if 'bias' in weight.name:
+                assert np.array_equal(original, restored)
+        assert np.allclose(loaded.predict(x, verbose=0), expected, atol=tolerance)
+    assert not is_quantized(model_path)
+    assert original_stem(model_path) == 'cnn-123_model'
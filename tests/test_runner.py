@@ -0,0 +1,65 @@
+from argparse import Namespace
+from unittest.mock import patch
+
+from masterthesis.models import utils
+from masterthesis.models.runner import configurations, run_all
+
+
+def test_configurations():
+    lines = ['--method classification', '--method regression --include-pos']
+    assert configurations(lines) == [
+        ['--method', 'classification'],
+        ['--method', 'regression', '--include-pos'],
+    ]
+    grid = ['--method classification | --method ranked', '| --include-pos | --mixed-pos']
+    assert configurations(grid, grid=True) == [
+        ['--method', 'classification'],
+        ['--method', 'classification', '--include-pos'],
+        ['--method', 'classification', '--mixed-pos'],
+        ['--method', 'ranked'],
+        ['--method', 'ranked', '--include-pos'],
+        ['--method', 'ranked', '--mixed-pos'],
+    ]
+
+
+def seq_args(**kwargs):
+    defaults = dict(
+        train_split='train',
+        dev_split='dev',
+        doc_length=700,
+        vocab_size=None,
+        include_pos=False,
+        mixed_pos=False,
+    )
+    defaults.update(kwargs)
+    return Namespace(**defaults)
+
+
+class FakeModelModule:
+    def __init__(self):
+        self.runs = []
+
+    def parse_args(self, argv):
+        return seq_args(include_pos='--include-pos' in argv, argv=argv)
+
+    def run(self, args, name_suffix=''):
+        reps = utils.get_sequence_input_reps(args)
+        self.runs.append((args.argv, name_suffix, reps))
+
+
+def test_run_all_shares_inputs():
+    module = FakeModelModule()
+    configs = [['--method', 'classification'], ['--include-pos'], ['--method', 'ranked']]
+    with patch('masterthesis.models.runner.import_module', return_value=module), \
+            patch('masterthesis.models.runner.K') as backend, \
+            patch('masterthesis.models.utils._make_sequence_input_reps',
+                  side_effect=lambda args: object()) as make:
+        run_all('cnn', configs)
+        assert make.call_count == 2
+        assert backend.clear_session.call_count == 3
+
+        utils.get_sequence_input_reps(seq_args())
+        assert make.call_count == 3
+    assert [suffix for __, suffix, __ in module.runs] == ['_1', '_2', '_3']
+    assert module.runs[0][2] is module.runs[2][2]
+    assert module.runs[0][2] is not module.runs[1][2]
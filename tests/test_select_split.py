@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from masterthesis.data.select_split import (
+    evaluate_candidate,
+    evolution,
+    evolve,
+    initial_state,
+    load_checkpoint,
+    save_checkpoint,
+    SplitProblem,
+)
+from masterthesis.utils import DATA_DIR
+
+
+def _load_df():
+    return pd.read_csv(str(DATA_DIR / 'metadata.csv')).dropna(subset=['cefr'])
+
+
+def test_score_matches_evaluate_candidate():
+    df = _load_df()
+    problem = SplitProblem(df)
+    population = initial_state(len(problem.topics), pop_size=20, seed=1).population
+    penalties, entropies, sizes = problem.score(population)
+    for i, candidate in enumerate(population):
+        expected = evaluate_candidate(
+            df, candidate, problem.topics, problem.overall_cefr, problem.overall_lang
+        )
+        assert np.isclose(penalties[i], expected['penalty'])
+        assert np.allclose(entropies[i], expected['entropies'])
+        assert tuple(sizes[i]) == expected['sample_sizes']
+        assert problem.describe(candidate)['dev_topics'] == expected['dev_topics']
+
+    empty_test = np.zeros((1, len(problem.topics)), dtype=int)
+    empty_test[0, 0] = 1
+    assert np.isinf(problem.score(empty_test)[0][0])
+
+
+def test_evolve_resume(tmpdir):
+    problem = SplitProblem(_load_df())
+    uninterrupted = evolve(problem, initial_state(len(problem.topics), seed=3), max_generations=20)
+
+    state = evolve(problem, initial_state(len(problem.topics), seed=3), max_generations=10)
+    checkpoint = Path(str(tmpdir)) / 'checkpoint.pkl'
+    save_checkpoint(checkpoint, [state])
+    (state,) = load_checkpoint(checkpoint)
+    resumed = evolve(problem, state, max_generations=20)
+
+    assert resumed.generations == 20
+    assert resumed.best_penalty == uninterrupted.best_penalty
+    assert (resumed.best == uninterrupted.best).all()
+    assert (resumed.population == uninterrupted.population).all()
+
+
+def test_evolution_without_candidate():
+    df = _load_df()
+    assert evolution(df, df.topic.unique(), max_generations=0) is None
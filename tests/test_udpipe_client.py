@@ -0,0 +1,123 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from pathlib import Path
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs
+
+import pytest
+
+from masterthesis.data.conll_cache import ConllCache
+from masterthesis.data.udpipe_client import split_conllu, UDPipeClient, UDPipeError
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UDPipeHandler(BaseHTTPRequestHandler):
+    """Mimics the process endpoint: every line is a sentence, every token an X."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+        server = self.server
+        server.requests.append(params)
+        if server.failures > 0:
+            server.failures -= 1
+            self._respond(503, b'Service unavailable')
+            return
+        if params['model'][0] != 'test-model':
+            self._respond(400, b'Unknown model')
+            return
+        blocks = []
+        lines = [line for line in params['data'][0].split('\n') if line.strip()]
+        for sent_id, line in enumerate(lines, start=1):
+            rows = ['# sent_id = %d' % sent_id, '# text = ' + line]
+            for i, token in enumerate(line.split(), start=1):
+                rows.append('\t'.join([str(i), token, '_', 'X', '_', '_', '0', 'dep', '_', '_']))
+            blocks.append('\n'.join(rows) + '\n\n')
+        body = json.dumps({'model': 'test-model', 'result': ''.join(blocks)})
+        self._respond(200, body.encode('utf-8'))
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = _Server(('127.0.0.1', 0), _UDPipeHandler)
+    server.requests = []
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, **kwargs):
+    url = 'http://127.0.0.1:%d/process' % server.server_address[1]
+    return UDPipeClient(url, 'test-model', backoff=0.01, **kwargs)
+
+
+def test_process_many_batched(server):
+    texts = ['a b\nc\n', '\n', 'd e f\n\ng\n', 'h\n']
+    with _client(server, max_workers=2) as client:
+        results = dict(client.process_many(texts, batch_size=3))
+    assert len(server.requests) == 2
+    assert sorted(results) == [0, 1, 2, 3]
+    assert results[1] == ''
+    assert results[2].count('\n\n') == 2
+    assert '# sent_id = 1\n# text = d e f\n' in results[2]
+    assert '\tg\t' in results[2].split('# sent_id = 2')[1]
+    single = dict(_client(server).process_many(texts))
+    assert single == results
+
+
+def test_retry(server):
+    server.failures = 2
+    with _client(server, retries=2) as client:
+        assert client.process('a\n').startswith('# sent_id = 1')
+    assert len(server.requests) == 3
+
+    server.failures = 2
+    with _client(server, retries=1) as client:
+        with pytest.raises(UDPipeError):
+            client.process('a\n')
+
+
+def test_client_error_is_not_retried(server):
+    url = 'http://127.0.0.1:%d/process' % server.server_address[1]
+    with UDPipeClient(url, 'missing-model', backoff=0.01) as client:
+        assert list(client.process_many(['a\n'])) == []
+    assert len(server.requests) == 1
+
+
+def test_split_conllu_mismatch():
+    with pytest.raises(UDPipeError):
+        split_conllu('1\ta\n\n', [1, 1])
+
+
+def test_cache(server, tmpdir):
+    cache = ConllCache(Path(str(tmpdir)))
+    texts = ['a b\n', 'c\n']
+    with _client(server, cache=cache) as client:
+        first = dict(client.process_many(texts))
+        assert len(server.requests) == 2
+        second = dict(client.process_many(texts + ['d\n']))
+    assert len(server.requests) == 3
+    assert second[0] == first[0] and second[1] == first[1]
+    assert cache.get('c\n', 'other-model') is None
+
+    assert cache.evict(max_bytes=0) == 3
+    assert cache.size() == 0
+    assert cache.get('a b\n', 'test-model') is None
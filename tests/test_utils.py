@@ -1,7 +1,23 @@
+from pathlib import Path
+
 import numpy as np
 from numpy.testing import assert_array_equal
+import pytest
 
-from masterthesis.utils import rescale_regression_results, round_cefr_score
+from masterthesis.utils import (
+    atomic_write,
+    CEFR_LABELS,
+    conll_reader,
+    fold_split_name,
+    get_split_len,
+    iso639_3,
+    load_split,
+    parse_fold_split,
+    read_conll_columns,
+    rescale_regression_results,
+    ROUND_CEFR_LABELS,
+    round_cefr_score,
+)
 
 
 def test_round_cefr_score():
@@ -15,3 +31,90 @@ def test_rescale_regression_results():
     y = np.array([1, 2, 6, 4, 0, 2, 1, 5, 1, 0, 4, 4, 6, 2, 5])
     norm_y = y / num_class
     assert_array_equal(rescale_regression_results(norm_y, num_class), y)
+
+
+def test_read_conll_columns():
+    conll_file = Path(__file__).parent / 'test_data' / 'conll' / 'sample_doc.conll'
+    for tags in (False, True):
+        sents = list(conll_reader(conll_file, cols=['FORM', 'UPOS'], tags=tags))
+        conll = read_conll_columns([conll_file, conll_file], cols=['FORM', 'UPOS'], tags=tags)
+        num_tokens = sum(len(sent) for sent in sents)
+        assert_array_equal(conll.doc_offsets, [0, num_tokens, 2 * num_tokens])
+        assert len(conll.sent_offsets) == 2 * len(sents) + 1
+        for i, sent in enumerate(sents):
+            start, end = conll.sent_offsets[i:i + 2]
+            assert list(conll.columns['FORM'][start:end]) == [form for form, __ in sent]
+            assert list(conll.columns['UPOS'][start:end]) == [pos for __, pos in sent]
+
+
+def test_read_conll_without_trailing_blank_line(tmpdir):
+    """The last sentence gets its tags even without an empty line after it."""
+    conll_file = Path(__file__).parent / 'test_data' / 'conll' / 'sample_doc.conll'
+    truncated = Path(str(tmpdir)) / 'truncated.conll'
+    truncated.write_text(conll_file.read_text(encoding='utf-8').rstrip('\n'), encoding='utf-8')
+    expected = list(conll_reader(conll_file, cols=['FORM'], tags=True))
+    sents = list(conll_reader(truncated, cols=['FORM'], tags=True))
+    assert sents == expected
+    assert sents[-1][0] == ('<s>',) and sents[-1][-1] == ('</s>',)
+    conll = read_conll_columns([truncated], cols=['FORM'], tags=True)
+    assert list(conll.columns['FORM']) == [form for sent in sents for (form,) in sent]
+
+
+def test_load_split():
+    train = load_split('train')
+    assert len(train) == get_split_len('train')
+    assert set(train.cefr.unique()) <= set(CEFR_LABELS)
+    assert train.cefr.dtype == object
+    rounded = load_split('train', round_cefr=True)
+    assert set(rounded.cefr.unique()) <= set(ROUND_CEFR_LABELS)
+    assert (rounded.filename.values == train.filename.values).all()
+    assert len(load_split('train,dev')) == get_split_len('train') + get_split_len('dev')
+
+    # Callers get their own copy
+    train['cefr'] = 'X'
+    assert (load_split('train').cefr != 'X').all()
+
+
+def test_load_split_consumers():
+    # As in visualize_embeddings, and the label encoding of the models
+    meta = load_split('dev')
+    meta['lang'] = meta['lang'].replace(iso639_3)
+    assert set(meta.lang) <= set(iso639_3.values())
+    train = load_split('train', round_cefr=True)
+    labels = sorted(train.cefr.unique())
+    assert [labels.index(c) for c in train.cefr] == [labels.index(c) for c in train.cefr.tolist()]
+    for col in ('lang', 'cefr', 'split', 'topic'):
+        assert train[col].dtype == object
+
+
+def test_fold_splits():
+    assert parse_fold_split(fold_split_name('topic', 5, 4, 'dev')) == ('topic', 5, 4, 'dev')
+    assert parse_fold_split('cv-topic-5-5-dev') is None
+    assert parse_fold_split('train') is None
+
+    filenames = set(load_split('train,dev').filename)
+    for strategy in ('stratified', 'topic'):
+        dev_filenames = []
+        for fold in range(3):
+            train = load_split(fold_split_name(strategy, 3, fold, 'train'))
+            dev = load_split(fold_split_name(strategy, 3, fold, 'dev'), round_cefr=True)
+            assert get_split_len(fold_split_name(strategy, 3, fold, 'dev')) == len(dev)
+            assert set(train.filename) | set(dev.filename) == filenames
+            assert not set(train.filename) & set(dev.filename)
+            if strategy == 'topic':
+                assert not set(train.topic) & set(dev.topic)
+            dev_filenames.extend(dev.filename)
+        assert sorted(dev_filenames) == sorted(filenames)
+
+
+def test_atomic_write(tmpdir):
+    path = Path(str(tmpdir)) / 'folder' / 'file.bin'
+    with atomic_write(path) as f:
+        f.write(b'first')
+    assert path.read_bytes() == b'first'
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as f:
+            f.write(b'partial')
+            raise RuntimeError
+    assert path.read_bytes() == b'first'
+    assert [p.name for p in path.parent.iterdir()] == ['file.bin']
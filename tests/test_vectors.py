@@ -0,0 +1,47 @@
+from pathlib import Path
+
+from gensim.models import KeyedVectors
+import numpy as np
+import pytest
+
+from masterthesis.gensim_utils import load_embeddings
+from masterthesis.models.utils import embedding_matrix
+from masterthesis.vectors import convert, load_vectors, save_vectors, vocab_path
+
+WORDS = ['__PAD__', '__UNK__', 'og', 'jeg', 'huset', 'blåbær']
+
+
+def test_convert(tmpdir):
+    folder = Path(str(tmpdir))
+    rng = np.random.RandomState(0)
+    kv = KeyedVectors(5)
+    kv.add_vectors(WORDS, rng.normal(size=(len(WORDS), 5)))
+    kv.save(str(folder / 'vectors.pkl'))
+
+    path = convert(folder / 'vectors.pkl')
+    assert path == folder / 'vectors.npy'
+    assert vocab_path(path).is_file()
+    vectors = load_embeddings(path)
+    assert isinstance(vectors.vectors, np.memmap)
+    assert vectors.vectors.dtype == np.float32
+    assert vectors.vector_size == 5
+    assert np.allclose(np.linalg.norm(vectors.vectors, axis=1), 1)
+    for word in WORDS:
+        expected = kv.get_vector(word) / np.linalg.norm(kv.get_vector(word))
+        assert np.allclose(vectors[word], expected)
+    with pytest.raises(KeyError):
+        vectors.get_vector('ukjent')
+
+    w2i = {'__PAD__': 0, 'blåbær': 1, 'ukjent': 2}
+    matrix = embedding_matrix(vectors, w2i)
+    assert np.allclose(matrix[1], vectors['blåbær'])
+    assert not matrix[2].any()
+
+
+def test_zero_vectors(tmpdir):
+    path = Path(str(tmpdir)) / 'zeros.npy'
+    save_vectors(path, ['a', 'b'], np.array([[0, 0], [3, 4]]))
+    vectors = load_vectors(path)
+    assert np.allclose(vectors.vectors, [[0, 0], [0.6, 0.8]])
+    assert 'b' in vectors
+    assert len(vectors) == 2